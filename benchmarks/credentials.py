@@ -0,0 +1,116 @@
+#
+# Copyright (c) Elliot Peele <elliot@bentlogic.net>
+#
+# This program is distributed under the terms of the MIT License as found
+# in a file called LICENSE. If it is not present, the license
+# is always available at http://www.opensource.org/licenses/mit-license.php.
+#
+# This program is distributed in the hope that it will be useful, but
+# without any warrenty; without even the implied warranty of merchantability
+# or fitness for a particular purpose. See the MIT License for full details.
+#
+
+"""
+Compare Authorization header parses per second of the previous parser,
+which decoded the header again on every call, and get_credentials, which
+decodes it once per request. Each request asks for its credentials three
+times, as the authentication policy and the token endpoint do. The header
+mix is mostly bearer tokens with some basic credentials, malformed values
+and requests without a header.
+
+usage: python benchmarks/credentials.py [requests]
+"""
+
+import gc
+import sys
+import time
+import base64
+import random
+
+from pyramid.request import Request
+
+from pyramid_oauth2_provider.util import get_credentials
+from pyramid_oauth2_provider.generators import gen_tokens
+
+
+def legacy_get_credentials(request):
+    if 'Authorization' in request.headers:
+        auth = request.headers.get('Authorization')
+    elif 'authorization' in request.headers:
+        auth = request.headers.get('authorization')
+    else:
+        return False
+
+    if (not auth.lower().startswith('bearer') and
+        not auth.lower().startswith('basic')):
+        return False
+
+    parts = auth.split()
+    if len(parts) != 2:
+        return False
+
+    token_type = parts[0].lower()
+    try:
+        token = base64.b64decode(parts[1]).decode('utf8')
+    except ValueError:
+        return False
+
+    if token_type == 'basic':
+        try:
+            client_id, client_secret = token.split(':')
+        except ValueError:
+            return False
+        request.client_id = client_id
+        request.client_secret = client_secret
+
+    return token_type, token
+
+def _encode(value):
+    return base64.b64encode(value.encode('utf8')).decode('ascii')
+
+def make_headers(count):
+    tokens = gen_tokens(count * 2)
+    headers = []
+    for i in range(count):
+        kind = random.random()
+        if kind < 0.75:
+            auth = 'Bearer %s' % _encode(tokens[i])
+        elif kind < 0.9:
+            auth = 'Basic %s' % _encode('%s:%s' % (tokens[2 * i],
+                                                   tokens[2 * i + 1]))
+        elif kind < 0.95:
+            auth = 'Basic %s!' % _encode(tokens[i])
+        else:
+            auth = None
+        headers.append(auth and {'Authorization': auth} or {})
+    return headers
+
+def bench(func, headers, calls=3):
+    requests = [Request.blank('/', headers=x) for x in headers]
+    gc.disable()
+    try:
+        start = time.time()
+        for request in requests:
+            for i in range(calls):
+                func(request)
+        return len(requests) / (time.time() - start)
+    finally:
+        gc.enable()
+
+def main(args):
+    count = len(args) > 1 and int(args[1]) or 100000
+    random.seed(0)
+    headers = make_headers(count)
+    results = [
+        ('legacy', bench(legacy_get_credentials, headers)),
+        ('memoized', bench(get_credentials, headers)),
+        ('single call', bench(get_credentials, headers, calls=1)),
+    ]
+
+    print('%-12s %14s' % ('parser', 'requests/sec'))
+    for name, rate in results:
+        print('%-12s %14.1f' % (name, rate))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,96 @@
+#
+# Copyright (c) Elliot Peele <elliot@bentlogic.net>
+#
+# This program is distributed under the terms of the MIT License as found
+# in a file called LICENSE. If it is not present, the license
+# is always available at http://www.opensource.org/licenses/mit-license.php.
+#
+# This program is distributed in the hope that it will be useful, but
+# without any warrenty; without even the implied warranty of merchantability
+# or fitness for a particular purpose. See the MIT License for full details.
+#
+
+"""
+Compare JSON error responses rendered per second by the previous template
+based prepare, which escaped the whole WSGI environ into the template
+arguments, and the current encoder with its cache of rendered bodies.
+
+usage: python benchmarks/errors.py [count]
+"""
+
+import sys
+import time
+from string import Template
+
+from webob import Request
+from pyramid import httpexceptions
+from pyramid.httpexceptions import _no_escape
+
+from pyramid_oauth2_provider import errors
+from pyramid_oauth2_provider import jsonerrors
+
+
+def _quote_escape(value):
+    return _no_escape(value).replace('"', '\\"')
+
+class LegacyUnauthorized(httpexceptions.HTTPUnauthorized):
+    json_template_obj = Template('''\
+{
+    "status": "${status}",
+    "code": ${code},
+    "explanation": "${explanation}",
+    "detail": "${detail}"
+}
+${html_comment}
+''')
+
+    def prepare(self, environ):
+        self.content_type = 'aplication/json'
+        args = {
+            'br': '\n',
+            'explanation': _quote_escape(self.explanation),
+            'detail': _quote_escape(self.detail or ''),
+            'comment': '',
+            'html_comment': '',
+        }
+        for k, v in list(environ.items()):
+            if (not k.startswith('wsgi.')) and ('.' in k):
+                continue
+            args[k] = _quote_escape(v)
+        for k, v in list(self.headers.items()):
+            args[k.lower()] = _quote_escape(v)
+        page = self.json_template_obj.substitute(status=self.status,
+            code=self.code, **args)
+        self.body = page.encode('utf-8')
+
+def bench(cls, error, count):
+    environ = Request.blank('/api', headers={
+        'Authorization': 'Bearer abc',
+        'Accept': 'application/json',
+        'User-Agent': 'bench/1.0',
+    }).environ
+    start_response = lambda status, headers: None
+    start = time.time()
+    for i in range(count):
+        b''.join(cls(error())(dict(environ), start_response))
+    return count / (time.time() - start)
+
+def main(args):
+    count = len(args) > 1 and int(args[1]) or 50000
+    described = lambda: errors.InvalidRequest(
+        error_description='Invalid client credentials')
+    results = [
+        ('legacy', bench(LegacyUnauthorized, errors.InvalidToken, count)),
+        ('json', bench(jsonerrors.HTTPUnauthorized, errors.InvalidToken,
+                       count)),
+        ('json described', bench(jsonerrors.HTTPBadRequest, described,
+                                 count)),
+    ]
+
+    print('%-15s %12s' % ('renderer', 'errors/sec'))
+    for name, rate in results:
+        print('%-15s %12.1f' % (name, rate))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,65 @@
+#
+# Copyright (c) Elliot Peele <elliot@bentlogic.net>
+#
+# This program is distributed under the terms of the MIT License as found
+# in a file called LICENSE. If it is not present, the license
+# is always available at http://www.opensource.org/licenses/mit-license.php.
+#
+# This program is distributed in the hope that it will be useful, but
+# without any warrenty; without even the implied warranty of merchantability
+# or fitness for a particular purpose. See the MIT License for full details.
+#
+
+"""
+Compare tokens generated per second by the previous random.random and
+time.time based generator, secrets.token_urlsafe and TokenGenerator, one at
+a time and in batches.
+
+usage: python benchmarks/generators.py [count]
+"""
+
+import sys
+import time
+import random
+import hashlib
+import secrets
+
+from pyramid_oauth2_provider.generators import TokenGenerator
+
+
+def legacy_gen_token(client_id='client'):
+    sha = hashlib.sha256()
+    sha.update(str(random.random()).encode('utf8'))
+    sha.update(str(time.time()).encode('utf8'))
+    sha.update(client_id.encode('utf8'))
+    return sha.hexdigest()
+
+def bench(func, count):
+    start = time.time()
+    for i in range(count):
+        func()
+    return count / (time.time() - start)
+
+def bench_batch(generator, count, batch=100):
+    start = time.time()
+    for i in range(count // batch):
+        generator.gen_tokens(batch)
+    return count / (time.time() - start)
+
+def main(args):
+    count = len(args) > 1 and int(args[1]) or 200000
+    generator = TokenGenerator()
+    results = [
+        ('legacy sha256', bench(legacy_gen_token, count)),
+        ('token_urlsafe', bench(lambda: secrets.token_urlsafe(32), count)),
+        ('buffered', bench(generator.gen_token, count)),
+        ('buffered x100', bench_batch(generator, count)),
+    ]
+
+    print('%-14s %12s' % ('generator', 'tokens/sec'))
+    for name, rate in results:
+        print('%-14s %12.1f' % (name, rate))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,46 @@
+#
+# Copyright (c) Elliot Peele <elliot@bentlogic.net>
+#
+# This program is distributed under the terms of the MIT License as found
+# in a file called LICENSE. If it is not present, the license
+# is always available at http://www.opensource.org/licenses/mit-license.php.
+#
+# This program is distributed in the hope that it will be useful, but
+# without any warrenty; without even the implied warranty of merchantability
+# or fitness for a particular purpose. See the MIT License for full details.
+#
+
+"""
+Report client secret verify latency for every registered hasher.
+
+usage: python benchmarks/hashers.py [iterations]
+"""
+
+import sys
+import time
+
+from pyramid_oauth2_provider import hashers
+from pyramid_oauth2_provider.generators import gen_client_secret
+
+
+def bench(algorithm, iterations):
+    hasher = hashers.get_hasher(algorithm)
+    secret = gen_client_secret().encode('utf-8')
+    encoded = hasher.encode(secret)
+
+    start = time.time()
+    for i in range(iterations):
+        hasher.verify(secret, encoded)
+    return (time.time() - start) / iterations
+
+def main(args):
+    iterations = len(args) > 1 and int(args[1]) or 20
+    print('%-14s %12s %12s' % ('hasher', 'ms/verify', 'verify/sec'))
+    for algorithm in hashers.available_hashers():
+        elapsed = bench(algorithm, iterations)
+        print('%-14s %12.3f %12.1f' % (algorithm, elapsed * 1000,
+                                        1 / elapsed))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,145 @@
+#
+# Copyright (c) Elliot Peele <elliot@bentlogic.net>
+#
+# This program is distributed under the terms of the MIT License as found
+# in a file called LICENSE. If it is not present, the license
+# is always available at http://www.opensource.org/licenses/mit-license.php.
+#
+# This program is distributed in the hope that it will be useful, but
+# without any warrenty; without even the implied warranty of merchantability
+# or fitness for a particular purpose. See the MIT License for full details.
+#
+
+"""
+Compare the size of the plaintext and digest indexes of the tokens table
+and the latency of looking tokens up through them in SQLite.
+
+The table is filled in dual storage mode, so every row has both the
+plaintext tokens and their digests and both indexes cover the same rows.
+Index sizes come from the dbstat virtual table.
+
+usage: python benchmarks/token_storage.py [rows] [lookups]
+"""
+
+import os
+import sys
+import time
+import random
+import shutil
+import sqlite3
+import tempfile
+from datetime import datetime
+from datetime import timedelta
+
+from sqlalchemy import create_engine
+
+from pyramid_oauth2_provider.models import Base
+from pyramid_oauth2_provider.models import Oauth2Token
+from pyramid_oauth2_provider.models import hash_token
+from pyramid_oauth2_provider.generators import gen_tokens
+
+
+def fill(conn, rows, sample, batch_size=50000):
+    """
+    Insert rows tokens and return a random sample of their access tokens.
+    """
+
+    table = Oauth2Token.__table__.name
+    insert = ('INSERT INTO %s (user_id, access_token, refresh_token, '
+              'access_token_hash, refresh_token_hash, expires_in, revoked, '
+              'creation_date, expires_at, client_id) VALUES '
+              '(?, ?, ?, ?, ?, 3600, 0, ?, ?, 1)' % table)
+    now = datetime.utcnow()
+    created = now.isoformat(' ')
+    expires = (now + timedelta(hours=1)).isoformat(' ')
+    keep = float(sample) / rows
+    sampled = []
+    started = time.time()
+    for i in range(0, rows, batch_size):
+        count = min(batch_size, rows - i)
+        tokens = gen_tokens(count * 2)
+        values = []
+        for j in range(count):
+            access_token = tokens[2 * j]
+            refresh_token = tokens[2 * j + 1]
+            values.append((i + j, access_token, refresh_token,
+                           hash_token(access_token),
+                           hash_token(refresh_token), created, expires))
+            if random.random() < keep:
+                sampled.append(access_token)
+        conn.executemany(insert, values)
+        conn.commit()
+        if (i // batch_size) % 20 == 0:
+            sys.stderr.write('%d rows in %.1fs\n'
+                             % (i + count, time.time() - started))
+    return sampled
+
+def index_sizes(conn):
+    table = Oauth2Token.__table__.name
+    names = dict(conn.execute(
+        "SELECT name, sql FROM sqlite_master WHERE type = 'index' AND "
+        "tbl_name = ?", (table,)).fetchall())
+    sizes = dict((x[0], x[1:]) for x in conn.execute(
+        'SELECT name, SUM(pgsize), COUNT(*) FROM dbstat GROUP BY name'))
+
+    # The unique constraints of the plaintext columns are autoindexes,
+    # find them through index_info.
+    result = {}
+    for name in names:
+        columns = [x[2] for x in conn.execute(
+            'PRAGMA index_info(%s)' % name)]
+        if columns in (['access_token'], ['access_token_hash']):
+            result[columns[0]] = sizes[name]
+    return result
+
+def bench(conn, column, tokens, convert):
+    query = ('SELECT id FROM %s WHERE %s = ?'
+             % (Oauth2Token.__table__.name, column))
+    start = time.time()
+    for token in tokens:
+        if conn.execute(query, (convert(token),)).fetchone() is None:
+            raise AssertionError('token not found')
+    return (time.time() - start) / len(tokens) * 1e6
+
+def main(args):
+    rows = len(args) > 1 and int(args[1]) or 10 * 1000 * 1000
+    lookups = len(args) > 2 and int(args[2]) or 20000
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmpdir, 'tokens.db')
+        engine = create_engine('sqlite:///%s' % path)
+        Base.metadata.create_all(engine)
+        engine.dispose()
+
+        conn = sqlite3.connect(path)
+        conn.execute('PRAGMA journal_mode = OFF')
+        conn.execute('PRAGMA synchronous = OFF')
+        tokens = fill(conn, rows, lookups)
+        random.shuffle(tokens)
+        conn.close()
+
+        conn = sqlite3.connect(path)
+        sizes = index_sizes(conn)
+        # Warm the page cache for both indexes alike.
+        bench(conn, 'access_token', tokens, lambda x: x)
+        bench(conn, 'access_token_hash', tokens, hash_token)
+        results = [
+            ('plaintext', 'access_token',
+             bench(conn, 'access_token', tokens, lambda x: x)),
+            ('sha256 digest', 'access_token_hash',
+             bench(conn, 'access_token_hash', tokens, hash_token)),
+        ]
+        conn.close()
+
+        print('%d rows, %d lookups' % (rows, len(tokens)))
+        print('%-14s %14s %10s %14s' % ('index', 'bytes', 'pages',
+                                        'us/lookup'))
+        for name, column, latency in results:
+            size, pages = sizes[column]
+            print('%-14s %14d %10d %14.2f' % (name, size, pages, latency))
+    finally:
+        shutil.rmtree(tmpdir)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,79 @@
+#
+# Copyright (c) Elliot Peele <elliot@bentlogic.net>
+#
+# This program is distributed under the terms of the MIT License as found
+# in a file called LICENSE. If it is not present, the license
+# is always available at http://www.opensource.org/licenses/mit-license.php.
+#
+# This program is distributed in the hope that it will be useful, but
+# without any warrenty; without even the implied warranty of merchantability
+# or fitness for a particular purpose. See the MIT License for full details.
+#
+
+"""
+Compare bearer token validations per second through OauthAuthenticationPolicy
+for opaque tokens looked up in the database, opaque tokens served from the
+token cache and signed tokens.
+
+usage: python benchmarks/token_validation.py [iterations]
+"""
+
+import sys
+import time
+import base64
+
+import transaction
+from sqlalchemy import create_engine
+from pyramid import testing
+
+from pyramid_oauth2_provider import signing
+from pyramid_oauth2_provider.cache import token_cache
+from pyramid_oauth2_provider.models import DBSession
+from pyramid_oauth2_provider.models import Oauth2Token
+from pyramid_oauth2_provider.models import Oauth2Client
+from pyramid_oauth2_provider.models import initialize_sql
+from pyramid_oauth2_provider.authentication import OauthAuthenticationPolicy
+
+
+def request_for(token):
+    encoded = base64.b64encode(token.encode('utf8')).decode('utf8')
+    return testing.DummyRequest(
+        headers={'Authorization': 'Bearer %s' % encoded})
+
+def bench(policy, token, iterations):
+    start = time.time()
+    for i in range(iterations):
+        policy.unauthenticated_userid(request_for(token))
+    return iterations / (time.time() - start)
+
+def main(args):
+    iterations = len(args) > 1 and int(args[1]) or 5000
+    testing.setUp(settings={})
+    initialize_sql(create_engine('sqlite://'), {})
+
+    with transaction.manager:
+        client = Oauth2Client()
+        DBSession.add(client)
+        auth_token = Oauth2Token(client, 1)
+        DBSession.add(auth_token)
+        DBSession.flush()
+        opaque = auth_token.access_token
+        signer = signing.TokenSigner({'a': b'k' * 32}, 'a')
+        signed = signer.sign_token(auth_token)
+
+    policy = OauthAuthenticationPolicy()
+
+    token_cache.configure(ttl=0)
+    results = [('opaque', bench(policy, opaque, iterations))]
+    token_cache.configure(ttl=60)
+    results.append(('opaque cached', bench(policy, opaque, iterations)))
+    signing.configure(signer)
+    results.append(('signed HS256', bench(policy, signed, iterations)))
+
+    print('%-14s %12s' % ('token', 'req/sec'))
+    for name, rate in results:
+        print('%-14s %12.1f' % (name, rate))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
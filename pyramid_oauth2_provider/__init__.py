@@ -10,29 +10,252 @@
 # or fitness for a particular purpose. See the MIT License for full details.
 #
 
+import os
+import time
+import weakref
+import logging
+import threading
+from datetime import timedelta
+
 from sqlalchemy import engine_from_config
 
 from pyramid.config import Configurator
+from pyramid.events import NewRequest
 from pyramid.exceptions import ConfigurationError
 from pyramid.interfaces import IAuthenticationPolicy
 
+from .kdf import kdf_pool
+from . import admin
+from . import hashers
+from . import generators
+from . import signing
+from . import ratelimit
+from . import revocation
+from .purge import PurgeScheduler
+from .throttle import client_failures
+from .dedup import request_dedup
+from .cache import secret_cache
+from .cache import token_cache
+from .cache import client_cache
+from .util import Oauth2Settings
+from .models import Oauth2Token
 from .models import initialize_sql
+from .models import configure_token_storage
 from .interfaces import IAuthCheck
 from .authentication import OauthAuthenticationPolicy
 
 # imported to make the test runnner happy
 from . import tests
 
+log = logging.getLogger('pyramid_oauth2_provider')
+
+_pool_options = (
+    ('pool_size', 'pool_size'),
+    ('pool_max_overflow', 'max_overflow'),
+    ('pool_timeout', 'pool_timeout'),
+    ('pool_recycle', 'pool_recycle'),
+    ('pool_pre_ping', 'pool_pre_ping'),
+)
+
+def create_engines(settings, oauth2_settings):
+    """
+    Create the engine of the sqlalchemy.* settings and one engine for each
+    url in oauth2_provider.replicas, which share the other sqlalchemy.*
+    settings. The oauth2_provider.pool.* settings that are set apply to all
+    of them. Returns the primary engine and the list of replica engines.
+    """
+
+    options = {}
+    for name, option in _pool_options:
+        value = getattr(oauth2_settings, name)
+        if value is not None:
+            options[option] = value
+
+    engine = engine_from_config(settings, 'sqlalchemy.', **options)
+    replicas = []
+    for url in oauth2_settings.replicas:
+        replica_settings = dict(settings)
+        replica_settings['sqlalchemy.url'] = url
+        replicas.append(
+            engine_from_config(replica_settings, 'sqlalchemy.', **options))
+    return engine, replicas
+
+
+class _StartupTimer(object):
+    """
+    Records how long each step of includeme takes.
+    """
+
+    def __init__(self):
+        self.started = self.last = time.time()
+        self.timings = []
+
+    def mark(self, step):
+        now = time.time()
+        self.timings.append((step, now - self.last))
+        self.last = now
+
+    def log(self):
+        log.info('oauth2 provider started in %.3fs (%s)' % (
+            self.last - self.started,
+            ', '.join('%s %.3fs' % x for x in self.timings)))
+
+
+# Every _BackgroundStarter, so that their locks can be replaced in forked
+# children.
+_starters = weakref.WeakSet()
+
+def _after_fork():
+    for starter in list(_starters):
+        starter._reset()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork)
+
+
+class _BackgroundStarter(object):
+    """
+    NewRequest subscriber that starts the background threads on the first
+    request of every process. Threads do not survive a fork, so threads
+    started by includeme would be lost in the workers of servers that load
+    the application before forking.
+    """
+
+    def __init__(self, workers):
+        self.workers = workers
+        self.pid = None
+        self._reset()
+        _starters.add(self)
+
+    def _reset(self):
+        self._lock = threading.Lock()
+
+    def __call__(self, event):
+        if self.pid == os.getpid():
+            return
+        with self._lock:
+            if self.pid != os.getpid():
+                for worker in self.workers:
+                    worker.start()
+                self.pid = os.getpid()
+
+
 def includeme(config):
+    timer = _StartupTimer()
     settings = config.registry.settings
-    engine = engine_from_config(settings, 'sqlalchemy.')
 
-    initialize_sql(engine, settings)
+    # Parse and validate the oauth2_provider.* settings once, everything
+    # after this works with the typed values.
+    oauth2_settings = Oauth2Settings.from_settings(settings)
+    config.registry.oauth2_provider_settings = oauth2_settings
+    timer.mark('settings')
+
+    engine, replicas = create_engines(settings, oauth2_settings)
+    config.registry.oauth2_replica_engines = replicas
+    timer.mark('engines')
+
+    initialize_sql(engine, settings,
+                   create_tables=oauth2_settings.create_tables,
+                   replicas=replicas)
+    configure_token_storage(oauth2_settings.token_storage)
+    timer.mark('database')
+
+    secret_cache.configure(
+        max_size=oauth2_settings.secret_cache_max_size,
+        ttl=oauth2_settings.secret_cache_ttl)
+
+    client_cache.configure(
+        max_size=oauth2_settings.client_cache_max_size,
+        ttl=oauth2_settings.client_cache_ttl,
+        negative_ttl=oauth2_settings.client_cache_negative_ttl)
+
+    token_cache.configure(
+        max_size=oauth2_settings.token_cache_max_size,
+        ttl=oauth2_settings.token_cache_ttl,
+        revoked_ttl=oauth2_settings.token_cache_revoked_ttl)
+
+    if not oauth2_settings.revocation_transport and (
+            oauth2_settings.secret_cache_ttl or
+            oauth2_settings.client_cache_ttl or
+            oauth2_settings.token_cache_ttl):
+        log.warning('caches are enabled without oauth2_provider.revocation.'
+                    'transport, revocations in other processes are not seen '
+                    'until cached entries expire')
+
+    client_failures.configure(
+        max_failures=oauth2_settings.throttle_max_failures,
+        window=oauth2_settings.throttle_window,
+        max_size=oauth2_settings.throttle_max_size)
+
+    request_dedup.configure(
+        window=oauth2_settings.dedup_window,
+        max_size=oauth2_settings.dedup_max_size)
+
+    backend = oauth2_settings.ratelimit_backend
+    if backend in ('memory', 'shared'):
+        backend = None
+    else:
+        backend = config.maybe_dotted(backend)(settings)
+    ratelimit.configure(
+        ratelimit.limiter_from_settings(oauth2_settings, backend))
+
+    kdf_pool.configure(
+        executor=oauth2_settings.kdf_executor,
+        workers=oauth2_settings.kdf_workers,
+        max_queue=oauth2_settings.kdf_max_queue)
+    timer.mark('caches')
+
+    if oauth2_settings.generator:
+        generator = config.maybe_dotted(oauth2_settings.generator)(settings)
+    else:
+        generator = generators.TokenGenerator(
+            nbytes=oauth2_settings.generator_nbytes,
+            buffer_size=oauth2_settings.generator_buffer_size)
+    generators.configure(generator)
+
+    hashers.configure_from_settings(oauth2_settings)
+    signing.configure(signing.signer_from_settings(oauth2_settings))
+    if oauth2_settings.token_format == 'signed':
+        # Revoked signed tokens are only rejected while their digest is
+        # remembered.
+        if (oauth2_settings.token_cache_revoked_ttl <
+                Oauth2Token.default_expires_in):
+            raise ConfigurationError('oauth2_provider.token_cache.revoked_ttl '
+                'must be at least the access token lifetime of %d seconds '
+                'with signed tokens' % Oauth2Token.default_expires_in)
+        if not oauth2_settings.revocation_transport:
+            log.warning('signed tokens are used without oauth2_provider.'
+                        'revocation.transport, tokens revoked in other '
+                        'processes are accepted until they expire')
+    timer.mark('keys')
+
+    workers = []
+    transport = revocation.transport_from_settings(oauth2_settings,
+                                                   settings, engine)
+    if transport is not None:
+        revocation.configure(transport)
+        listener = revocation.RevocationListener(transport,
+            interval=oauth2_settings.revocation_interval,
+            batch_size=oauth2_settings.revocation_batch_size,
+            replay=oauth2_settings.token_cache_revoked_ttl)
+        workers.append(listener)
+        config.registry.oauth2_revocation_listener = listener
+
+    if oauth2_settings.purge_interval:
+        scheduler = PurgeScheduler(engine, oauth2_settings.purge_interval,
+            retention=timedelta(seconds=oauth2_settings.purge_retention),
+            batch_size=oauth2_settings.purge_batch_size)
+        workers.append(scheduler)
+        config.registry.oauth2_purge_scheduler = scheduler
+
+    if workers:
+        config.add_subscriber(_BackgroundStarter(workers), NewRequest)
+    timer.mark('background')
 
     if not config.registry.queryUtility(IAuthenticationPolicy):
         config.set_authentication_policy(OauthAuthenticationPolicy())
 
-    auth_check = settings.get('oauth2_provider.auth_checker')
+    auth_check = oauth2_settings.auth_checker
     if not auth_check:
         raise ConfigurationError('You must provide an implementation of the '
             'authentication check interface that is included with '
@@ -45,6 +268,21 @@ def includeme(config):
     config.add_route('oauth2_provider_token', '/oauth2/token')
     config.scan()
 
+    if oauth2_settings.admin:
+        config.add_route('oauth2_provider_admin_revoke',
+                         '/oauth2/admin/revoke')
+        config.add_route('oauth2_provider_admin_issue', '/oauth2/admin/issue')
+        config.add_view(admin.oauth2_admin_revoke,
+                        route_name='oauth2_provider_admin_revoke',
+                        renderer='json', permission=admin.ADMIN_PERMISSION)
+        config.add_view(admin.oauth2_admin_issue,
+                        route_name='oauth2_provider_admin_issue',
+                        renderer='json', permission=admin.ADMIN_PERMISSION)
+    timer.mark('views')
+
+    config.registry.oauth2_startup_timings = timer.timings
+    timer.log()
+
 def main(global_config, **settings):
     """ This function returns a Pyramid WSGI application.
     """
@@ -0,0 +1,155 @@
+#
+# Copyright (c) Elliot Peele <elliot@bentlogic.net>
+#
+# This program is distributed under the terms of the MIT License as found
+# in a file called LICENSE. If it is not present, the license
+# is always available at http://www.opensource.org/licenses/mit-license.php.
+#
+# This program is distributed in the hope that it will be useful, but
+# without any warrenty; without even the implied warranty of merchantability
+# or fitness for a particular purpose. See the MIT License for full details.
+#
+
+"""
+Bulk revocation and issuing of tokens, and the admin views exposing them.
+
+The views are only registered when oauth2_provider.admin is enabled and
+require the oauth2_provider_admin permission, which the authorization
+policy of the application has to grant to administrators.
+"""
+
+import logging
+
+from .models import DBSession as db
+from .models import Oauth2Code
+from .models import Oauth2Token
+from .models import Oauth2Client
+from .errors import InvalidClient
+from .errors import InvalidRequest
+from .views import require_https
+from .views import add_cache_headers
+from .jsonerrors import HTTPBadRequest
+from .jsonerrors import HTTPMethodNotAllowed
+
+log = logging.getLogger('pyramid_oauth2_provider.admin')
+
+ADMIN_PERMISSION = 'oauth2_provider_admin'
+
+
+def revoke_all_for_client(client, session=None):
+    """
+    Revoke every token and authorization code of client. Returns the
+    number of tokens and codes revoked.
+    """
+
+    return {
+        'tokens': Oauth2Token.revoke_all_for_client(client, session),
+        'codes': Oauth2Code.revoke_all_for_client(client, session),
+    }
+
+def revoke_all_for_user(user_id, client=None, session=None):
+    """
+    Revoke every token and authorization code of user_id, optionally only
+    those issued to client. Returns the number of tokens and codes revoked.
+    """
+
+    return {
+        'tokens': Oauth2Token.revoke_all_for_user(user_id, client, session),
+        'codes': Oauth2Code.revoke_all_for_user(user_id, client, session),
+    }
+
+def issue_tokens(client, user_ids, expires_in=None, session=None):
+    """
+    Issue a token to client for every user in user_ids.
+    """
+
+    return Oauth2Token.issue_bulk(client, user_ids, expires_in, session)
+
+
+def _get_client(request):
+    client_id = request.POST.get('client_id')
+    if not client_id:
+        return None
+    return db.query(Oauth2Client).filter_by(client_id=client_id).first()
+
+def _bad_request(description):
+    return HTTPBadRequest(InvalidRequest(error_description=description))
+
+@require_https
+def oauth2_admin_revoke(request):
+    """
+    Revoke tokens and authorization codes in bulk.
+
+        POST /oauth2/admin/revoke HTTP/1.1
+        Content-Type: application/x-www-form-urlencoded
+
+        client_id=aoiuer&user_id=1234
+
+    Either or both of client_id and user_id must be given. The response
+    holds the number of tokens and codes revoked:
+
+        {"tokens": 3, "codes": 0}
+    """
+
+    if request.method != 'POST':
+        return HTTPMethodNotAllowed(
+            'This endpoint only supports the POST method.')
+
+    client = _get_client(request)
+    if request.POST.get('client_id') and client is None:
+        return HTTPBadRequest(InvalidClient(
+            error_description='Unknown client_id.'))
+
+    user_id = request.POST.get('user_id')
+    if user_id:
+        try:
+            user_id = int(user_id)
+        except ValueError:
+            return _bad_request('user_id must be an integer.')
+        counts = revoke_all_for_user(user_id, client)
+    elif client is not None:
+        counts = revoke_all_for_client(client)
+    else:
+        return _bad_request('client_id or user_id is required.')
+
+    log.info('revoked %(tokens)d tokens and %(codes)d codes' % counts)
+    add_cache_headers(request)
+    return counts
+
+@require_https
+def oauth2_admin_issue(request):
+    """
+    Issue tokens to a client for many users.
+
+        POST /oauth2/admin/issue HTTP/1.1
+        Content-Type: application/x-www-form-urlencoded
+
+        client_id=aoiuer&user_id=1&user_id=2&expires_in=3600
+
+    The response lists a token for every user_id, in the order given:
+
+        {"tokens": [{"access_token": ..., "refresh_token": ...,
+                     "user_id": 1, "expires_in": 3600}, ...]}
+    """
+
+    if request.method != 'POST':
+        return HTTPMethodNotAllowed(
+            'This endpoint only supports the POST method.')
+
+    client = _get_client(request)
+    if client is None or client.isRevoked():
+        return HTTPBadRequest(InvalidClient(
+            error_description='Unknown or revoked client_id.'))
+
+    try:
+        user_ids = [int(x) for x in request.POST.getall('user_id')]
+        expires_in = int(request.POST.get('expires_in') or 0) or None
+    except ValueError:
+        return _bad_request('user_id and expires_in must be integers.')
+    if not user_ids:
+        return _bad_request('At least one user_id is required.')
+
+    tokens = issue_tokens(client, user_ids, expires_in)
+    log.info('issued %d tokens' % len(tokens))
+    add_cache_headers(request)
+    return {'tokens': tokens}
@@ -0,0 +1,168 @@
+#
+# Copyright (c) Elliot Peele <elliot@bentlogic.net>
+#
+# This program is distributed under the terms of the MIT License as found
+# in a file called LICENSE. If it is not present, the license
+# is always available at http://www.opensource.org/licenses/mit-license.php.
+#
+# This program is distributed in the hope that it will be useful, but
+# without any warrenty; without even the implied warranty of merchantability
+# or fitness for a particular purpose. See the MIT License for full details.
+#
+
+"""
+Bearer token validation for asyncio applications.
+
+AsyncTokenValidator applies the same rules as OauthAuthenticationPolicy:
+signed tokens and tokens in the token cache are validated in the event
+loop, other tokens are looked up in the database. Unknown tokens raise a
+400 invalid_request and expired or revoked tokens a 401 invalid_token
+error, as pyramid HTTP exceptions carrying the OAuth2 error dict.
+
+The database lookup is a callable taking the token and returning its
+TokenInfo. A coroutine function is awaited, which allows an async database
+driver, any other callable is run on a thread pool. By default it is
+lookup_token_info, which runs on the configured read only session.
+Concurrent validations of the same token share a single lookup.
+
+OauthMiddleware wraps an ASGI application and validates the bearer token
+of every http and websocket connection before the application sees it.
+"""
+
+import asyncio
+import inspect
+import logging
+
+from pyramid.httpexceptions import HTTPBadRequest
+from pyramid.httpexceptions import HTTPUnauthorized
+
+from .cache import token_cache
+from .errors import InvalidToken
+from .errors import InvalidRequest
+from .util import parse_authorization
+from .jsonerrors import render_json
+from .authentication import local_token_info
+from .authentication import lookup_token_info
+
+log = logging.getLogger('pyramid_oauth2_provider.async_validation')
+
+
+class AsyncTokenValidator(object):
+    """
+    Validates bearer tokens without blocking the event loop. lookup is the
+    database lookup, by default run on executor, or on the default executor
+    of the loop when executor is None.
+    """
+
+    def __init__(self, lookup=None, executor=None):
+        self.lookup = lookup or lookup_token_info
+        self.executor = executor
+        self._inflight = {}
+
+    def _run_lookup(self, token):
+        if inspect.iscoroutinefunction(self.lookup):
+            return self.lookup(token)
+        loop = asyncio.get_running_loop()
+        return loop.run_in_executor(self.executor, self.lookup, token)
+
+    async def _lookup(self, token):
+        info = await self._run_lookup(token)
+        token_cache.add(token, info)
+        return info
+
+    async def validate(self, token):
+        """
+        Return the TokenInfo of token.
+        """
+
+        info = local_token_info(token)
+        if info is not None:
+            return info
+
+        future = self._inflight.get(token)
+        if future is None:
+            future = asyncio.ensure_future(self._lookup(token))
+            self._inflight[token] = future
+            future.add_done_callback(
+                lambda f: self._inflight.pop(token, None))
+        # A cancelled caller must not cancel the lookup for the others.
+        return await asyncio.shield(future)
+
+    async def validate_many(self, tokens):
+        """
+        Validate tokens concurrently. Returns a list with the TokenInfo of
+        every token, or the error raised for it, in the order given.
+        """
+
+        return await asyncio.gather(*[self.validate(x) for x in tokens],
+                                    return_exceptions=True)
+
+    def pending(self):
+        """
+        The number of lookups in flight.
+        """
+
+        return len(self._inflight)
+
+
+def _get_authorization(scope):
+    for name, value in scope.get('headers', ()):
+        if name.lower() == b'authorization':
+            return value.decode('latin-1')
+    return None
+
+class OauthMiddleware(object):
+    """
+    ASGI middleware validating the bearer token of each connection. The
+    TokenInfo is put in the scope as oauth2_token_info, None for connections
+    without a bearer token unless required is set, in which case they are
+    rejected. Invalid tokens are answered with the same JSON errors as
+    the pyramid views.
+    """
+
+    def __init__(self, app, validator=None, required=False):
+        self.app = app
+        self.validator = validator or AsyncTokenValidator()
+        self.required = required
+
+    async def _token_info(self, scope):
+        auth = _get_authorization(scope)
+        credentials = parse_authorization(auth) if auth else None
+        if credentials is None or credentials.token_type != 'bearer':
+            if self.required:
+                raise HTTPUnauthorized(InvalidToken(
+                    error_description='A bearer token is required.'))
+            return None
+        if not credentials.valid:
+            raise HTTPBadRequest(InvalidRequest())
+        return await self.validator.validate(credentials.token)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] not in ('http', 'websocket'):
+            return await self.app(scope, receive, send)
+
+        try:
+            info = await self._token_info(scope)
+        except (HTTPBadRequest, HTTPUnauthorized) as e:
+            log.info('rejected bearer token: %s' % e.detail['error'])
+            return await self._send_error(scope, send, e)
+
+        scope = dict(scope, oauth2_token_info=info)
+        return await self.app(scope, receive, send)
+
+    async def _send_error(self, scope, send, error):
+        if scope['type'] == 'websocket':
+            return await send({'type': 'websocket.close', 'code': 1008})
+
+        body = render_json(error)
+        headers = [
+            (b'content-type', b'application/json'),
+            (b'content-length', str(len(body)).encode('ascii')),
+            (b'cache-control', b'no-store'),
+        ]
+        if error.code == 401:
+            headers.append((b'www-authenticate', (
+                'Bearer error="%s"' % error.detail['error']).encode('ascii')))
+        await send({'type': 'http.response.start', 'status': error.code,
+                    'headers': headers})
+        await send({'type': 'http.response.body', 'body': body})
@@ -10,10 +10,14 @@
 # or fitness for a particular purpose. See the MIT License for full details.
 #
 
+import calendar
+import binascii
 import logging
 
 from zope.interface import implementer
 
+from sqlalchemy.orm import joinedload
+
 from pyramid.interfaces import IAuthenticationPolicy
 from pyramid.authentication import AuthTktAuthenticationPolicy
 from pyramid.authentication import CallbackAuthenticationPolicy
@@ -22,43 +26,173 @@ from pyramid.httpexceptions import HTTPBadRequest
 from pyramid.httpexceptions import HTTPUnauthorized
 
 from .models import Oauth2Token
+from .models import Oauth2Client
 from .models import DBSession as db
+from .models import read_only_session
+from .models import lookup_with_fallback
+from .models import get_token_storage
 from .errors import InvalidToken
 from .errors import InvalidRequest
-from .util import getClientCredentials
+from .util import get_credentials
+from .cache import TokenInfo
+from .cache import token_cache
+from .signing import get_signer
+from .signing import looks_signed
+from .signing import InvalidSignedToken
 
 log = logging.getLogger('pyramid_oauth2_provider.authentication')
 
+_missing = object()
+
+def lookup_token(token, session=db):
+    """
+    Return the Oauth2Token row of an opaque access token. Unknown tokens
+    raise a 400 invalid_request and expired or revoked tokens a 401
+    invalid_token error. Tokens a replica does not have yet are looked up
+    on the primary.
+    """
+
+    auth_token = lookup_with_fallback(session,
+        lambda x: Oauth2Token.lookup_access_token(token,
+            x.query(Oauth2Token).options(joinedload(Oauth2Token.client))))
+    # Bad input, return 400 Invalid Request
+    if not auth_token:
+        raise HTTPBadRequest(InvalidRequest())
+    # Expired or revoked token, return 401 invalid token
+    if auth_token.isRevoked():
+        raise HTTPUnauthorized(InvalidToken())
+
+    return auth_token
+
+def lookup_token_info(token):
+    """
+    Look up an opaque access token in a read only session and return its
+    TokenInfo. Raises like lookup_token.
+    """
+
+    with read_only_session() as session:
+        auth_token = lookup_token(token, session)
+        return TokenInfo(auth_token.user_id, auth_token.client.client_id,
+            calendar.timegm(auth_token.getExpiry().utctimetuple()))
+
+def verify_signed_token(signer, token):
+    """
+    Return the claims of a signed access token, raising a 401 invalid_token
+    error when it is invalid, expired or revoked.
+    """
+
+    try:
+        claims = signer.verify(token)
+    except InvalidSignedToken as e:
+        log.info('rejected signed token: %s' % e)
+        raise HTTPUnauthorized(InvalidToken())
+    if token_cache.is_revoked_digest(claims['jti']):
+        raise HTTPUnauthorized(InvalidToken())
+    return claims
+
+def local_token_info(token):
+    """
+    Return the TokenInfo of token if it can be validated without the
+    database, that is when it is a signed token or in the token cache,
+    otherwise None.
+    """
+
+    signer = get_signer()
+    if signer is not None and looks_signed(token):
+        # Signed tokens are validated without touching the database.
+        claims = verify_signed_token(signer, token)
+        return TokenInfo(claims['sub'], claims['client_id'], claims['exp'])
+    return token_cache.get(token)
+
+def validate_token(token):
+    """
+    Return the TokenInfo of a bearer token. Valid opaque tokens are kept in
+    the process wide token cache, so the database is only consulted on a
+    cache miss.
+    """
+
+    info = local_token_info(token)
+    if info is None:
+        info = lookup_token_info(token)
+        token_cache.add(token, info)
+    return info
+
+
 @implementer(IAuthenticationPolicy)
 class OauthAuthenticationPolicy(CallbackAuthenticationPolicy):
     def _isOauth(self, request):
-        return bool(getClientCredentials(request))
+        return get_credentials(request) is not None
 
-    def _get_auth_token(self, request):
-        try:
-            token_type, token = getClientCredentials(request)
-        except TypeError:
+    def _get_bearer_token(self, request):
+        credentials = get_credentials(request)
+        if credentials is None or not credentials.valid:
             raise HTTPBadRequest(InvalidRequest())
 
-        if token_type != 'bearer':
+        if credentials.token_type != 'bearer':
             return None
+        return credentials.token
 
-        auth_token = db.query(Oauth2Token).filter_by(access_token=token).first()
-        # Bad input, return 400 Invalid Request
-        if not auth_token:
-            raise HTTPBadRequest(InvalidRequest())
-        # Expired or revoked token, return 401 invalid token
-        if auth_token.isRevoked():
-            raise HTTPUnauthorized(InvalidToken())
+    def _lookup_token(self, token, session=db):
+        return lookup_token(token, session)
 
+    def _lookup_signed_token(self, claims):
+        tokens = db.query(Oauth2Token).join(Oauth2Client).filter(
+            Oauth2Client.client_id == claims['client_id'],
+            Oauth2Token.user_id == claims['sub'])
+        try:
+            token_hash = binascii.unhexlify(claims['jti'])
+        except (TypeError, ValueError):
+            raise HTTPBadRequest(InvalidRequest())
+        auth_token = tokens.filter(
+            Oauth2Token.access_token_hash == token_hash).first()
+        if auth_token is None and get_token_storage() == 'dual':
+            # Rows whose digest has not been backfilled yet.
+            for row in tokens.filter(Oauth2Token.access_token_hash == None):
+                if row.token_digest == claims['jti']:
+                    return row
+        if auth_token is None:
+            raise HTTPBadRequest(InvalidRequest())
         return auth_token
 
+    def _verify_signed_token(self, signer, token):
+        return verify_signed_token(signer, token)
+
+    def _get_auth_token(self, request):
+        token = self._get_bearer_token(request)
+        if token is None:
+            return None
+
+        signer = get_signer()
+        if signer is not None and looks_signed(token):
+            return self._lookup_signed_token(
+                self._verify_signed_token(signer, token))
+        return self._lookup_token(token)
+
+    def _get_token_info(self, request):
+        """
+        Validate the bearer token of a request. The result is memoized on
+        the request and valid tokens are kept in the process wide token
+        cache, so the database is only consulted on a cache miss.
+        """
+
+        info = getattr(request, 'oauth2_token_info', _missing)
+        if info is not _missing:
+            return info
+
+        token = self._get_bearer_token(request)
+        info = None
+        if token is not None:
+            info = validate_token(token)
+
+        request.oauth2_token_info = info
+        return info
+
     def unauthenticated_userid(self, request):
-        auth_token = self._get_auth_token(request)
-        if not auth_token:
+        info = self._get_token_info(request)
+        if not info:
             return None
 
-        return auth_token.user_id
+        return info.user_id
 
     def remember(self, request, principal, **kw):
         """
@@ -71,6 +205,7 @@ class OauthAuthenticationPolicy(CallbackAuthenticationPolicy):
             return None
 
         auth_token.revoke()
+        request.oauth2_token_info = _missing
 
 
 @implementer(IAuthenticationPolicy)
@@ -0,0 +1,392 @@
+#
+# Copyright (c) Elliot Peele <elliot@bentlogic.net>
+#
+# This program is distributed under the terms of the MIT License as found
+# in a file called LICENSE. If it is not present, the license
+# is always available at http://www.opensource.org/licenses/mit-license.php.
+#
+# This program is distributed in the hope that it will be useful, but
+# without any warrenty; without even the implied warranty of merchantability
+# or fitness for a particular purpose. See the MIT License for full details.
+#
+
+"""
+In process caches used to keep expensive work off of the request path.
+"""
+
+import os
+import hmac
+import time
+import hashlib
+import logging
+import threading
+from collections import namedtuple
+from collections import OrderedDict
+
+from .util import normalize_uri
+
+log = logging.getLogger('pyramid_oauth2_provider.cache')
+
+_missing = object()
+
+
+def _to_bytes(value):
+    if isinstance(value, bytes):
+        return value
+    return value.encode('utf-8')
+
+
+class TTLCache(object):
+    """
+    Thread safe, size bounded LRU mapping where every entry also expires
+    after a time to live. A ttl of zero disables the cache entirely.
+    """
+
+    def __init__(self, max_size=1024, ttl=300, clock=time.time):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def configure(self, max_size=None, ttl=None):
+        with self._lock:
+            if max_size is not None:
+                self.max_size = max_size
+            if ttl is not None:
+                self.ttl = ttl
+            self._data.clear()
+
+    @property
+    def enabled(self):
+        return self.max_size > 0 and self.ttl > 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key, _missing)
+            if entry is not _missing:
+                expires, value = entry
+                if expires > self.clock():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value, ttl=None):
+        if not self.enabled:
+            return
+        if ttl is None or ttl > self.ttl:
+            ttl = self.ttl
+        if ttl <= 0:
+            self.invalidate(key)
+            return
+        with self._lock:
+            self._data[key] = (self.clock() + ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._data),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': lookups and float(self.hits) / lookups or 0.0,
+        }
+
+
+class ClientSecretCache(object):
+    """
+    Remembers recently verified client credentials so that the token
+    endpoint does not have to run the key derivation function for every
+    request.
+
+    Plain text secrets are never stored. Each entry holds the stored secret
+    hash the credentials were checked against and an HMAC-SHA256 of the
+    presented secret keyed with a random per process key. Entries for a
+    client whose stored hash has since changed simply miss.
+    """
+
+    def __init__(self, max_size=1024, ttl=300):
+        self._key = os.urandom(32)
+        self._cache = TTLCache(max_size=max_size, ttl=ttl)
+        self.hits = 0
+        self.misses = 0
+
+    def configure(self, max_size=None, ttl=None):
+        self._cache.configure(max_size=max_size, ttl=ttl)
+
+    def _mac(self, client_id, client_secret):
+        mac = hmac.new(self._key, digestmod=hashlib.sha256)
+        mac.update(_to_bytes(client_id))
+        mac.update(b'\x00')
+        mac.update(_to_bytes(client_secret))
+        return mac.digest()
+
+    def check(self, client_id, secret_hash, client_secret):
+        """
+        Return True if the given credentials were verified against
+        secret_hash recently.
+        """
+
+        entry = self._cache.get(client_id)
+        if entry is not None:
+            cached_hash, mac = entry
+            if (hmac.compare_digest(cached_hash, _to_bytes(secret_hash)) and
+                    hmac.compare_digest(
+                        mac, self._mac(client_id, client_secret))):
+                self.hits += 1
+                return True
+        self.misses += 1
+        return False
+
+    def add(self, client_id, secret_hash, client_secret):
+        self._cache.set(client_id, (_to_bytes(secret_hash),
+            self._mac(client_id, client_secret)))
+
+    def invalidate(self, client_id):
+        self._cache.invalidate(client_id)
+
+    def clear(self):
+        self._cache.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._cache)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._cache),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': lookups and float(self.hits) / lookups or 0.0,
+        }
+
+
+class DenyList(object):
+    """
+    Thread safe set whose entries are each kept for ttl seconds. Unlike
+    TTLCache it is not size bounded, since dropping an entry early would
+    accept a revoked token again. Expired entries are pruned as the set
+    grows.
+    """
+
+    min_prune_size = 1024
+
+    def __init__(self, ttl=3600, clock=time.time):
+        self.ttl = ttl
+        self.clock = clock
+        self._expires = {}
+        self._prune_at = self.min_prune_size
+        self._lock = threading.Lock()
+
+    def configure(self, ttl=None):
+        if ttl is not None:
+            self.ttl = ttl
+
+    def add(self, key):
+        with self._lock:
+            now = self.clock()
+            self._expires[key] = now + self.ttl
+            if len(self._expires) >= self._prune_at:
+                self._prune(now)
+
+    def _prune(self, now):
+        self._expires = dict((x, y) for x, y in self._expires.items()
+                             if y > now)
+        self._prune_at = max(self.min_prune_size, 2 * len(self._expires))
+
+    def __contains__(self, key):
+        expires = self._expires.get(key)
+        return expires is not None and expires > self.clock()
+
+    def clear(self):
+        with self._lock:
+            self._expires.clear()
+            self._prune_at = self.min_prune_size
+
+    def __len__(self):
+        return len(self._expires)
+
+
+class TokenInfo(namedtuple('TokenInfo', 'user_id client_id expires_at')):
+    """
+    The parts of a validated access token needed to authenticate a request.
+    expires_at is in seconds since the epoch.
+    """
+    __slots__ = ()
+
+
+class TokenCache(object):
+    """
+    Cache of validated access tokens, keyed by the SHA-256 digest of the
+    token so that bearer credentials are not kept in memory. An entry never
+    outlives the expiry of the token it describes.
+
+    Digests of revoked tokens are also remembered for revoked_ttl seconds,
+    which has to cover the lifetime of an access token, so that signed
+    tokens, which are validated without a database lookup, can be rejected
+    once revoked. They are kept however many tokens are revoked, and tokens
+    with a remembered digest are neither cached nor served from the cache.
+    """
+
+    def __init__(self, max_size=10000, ttl=60, revoked_ttl=3600):
+        self._cache = TTLCache(max_size=max_size, ttl=ttl)
+        self._revoked = DenyList(ttl=revoked_ttl)
+
+    def configure(self, max_size=None, ttl=None, revoked_ttl=None):
+        self._cache.configure(max_size=max_size, ttl=ttl)
+        self._revoked.configure(ttl=revoked_ttl)
+
+    def _key(self, token):
+        return hashlib.sha256(_to_bytes(token)).digest()
+
+    def get(self, token):
+        key = self._key(token)
+        info = self._cache.get(key)
+        if info is not None and (info.expires_at <= time.time() or
+                                 key.hex() in self._revoked):
+            self._cache.invalidate(key)
+            return None
+        return info
+
+    def add(self, token, info):
+        # A revocation applied while the token was looked up must not be
+        # undone by caching the result of the lookup.
+        key = self._key(token)
+        if key.hex() in self._revoked:
+            return
+        self._cache.set(key, info, ttl=info.expires_at - time.time())
+
+    def invalidate(self, token):
+        self._cache.invalidate(self._key(token))
+
+    def invalidate_digest(self, hexdigest):
+        self._cache.invalidate(bytes(bytearray.fromhex(hexdigest)))
+
+    def revoke(self, token):
+        self.revoke_digest(hashlib.sha256(_to_bytes(token)).hexdigest())
+
+    def revoke_digest(self, hexdigest):
+        self.invalidate_digest(hexdigest)
+        self._revoked.add(hexdigest)
+
+    def is_revoked_digest(self, hexdigest):
+        return hexdigest in self._revoked
+
+    def clear(self):
+        self._cache.clear()
+        self._revoked.clear()
+
+    def __len__(self):
+        return len(self._cache)
+
+    def stats(self):
+        return self._cache.stats()
+
+
+class ClientInfo(namedtuple('ClientInfo',
+        'id client_id revoked secret_hash redirect_uris normalized_uris')):
+    """
+    Immutable snapshot of an Oauth2Client. normalized_uris holds the
+    normalized form of each of redirect_uris, in the same order.
+    """
+    __slots__ = ()
+
+    def match_redirect_uri(self, redirect_uri=None):
+        """
+        Return the registered redirect uri matching redirect_uri, compared
+        after normalization, or None. Without a redirect_uri the only
+        registered uri is returned, if there is exactly one.
+        """
+
+        if not redirect_uri:
+            return len(self.redirect_uris) == 1 and \
+                self.redirect_uris[0] or None
+        try:
+            index = self.normalized_uris.index(normalize_uri(redirect_uri))
+        except ValueError:
+            return None
+        return self.redirect_uris[index]
+
+
+# Cached in place of a ClientInfo for client_ids that do not exist.
+_unknown = object()
+
+
+class ClientCache(object):
+    """
+    Read through cache of ClientInfo snapshots by client_id. Unknown
+    client_ids are remembered for negative_ttl seconds, so repeated
+    requests with made up client_ids do not reach the database either.
+    Unknown client_ids are remembered even when ttl is zero, as there is no
+    revocation that could make them stale.
+    """
+
+    def __init__(self, max_size=1024, ttl=300, negative_ttl=30):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._cache = TTLCache(max_size=max_size,
+                               ttl=max(ttl, negative_ttl))
+
+    def configure(self, max_size=None, ttl=None, negative_ttl=None):
+        if ttl is not None:
+            self.ttl = ttl
+        if negative_ttl is not None:
+            self.negative_ttl = negative_ttl
+        self._cache.configure(max_size=max_size,
+                              ttl=max(self.ttl, self.negative_ttl))
+
+    def get(self, client_id, loader):
+        """
+        Return the ClientInfo of client_id, or None if there is no such
+        client, calling loader(client_id) on a miss.
+        """
+
+        info = self._cache.get(client_id, _missing)
+        if info is _missing:
+            info = loader(client_id)
+            if info is None:
+                self._cache.set(client_id, _unknown, ttl=self.negative_ttl)
+            else:
+                self._cache.set(client_id, info, ttl=self.ttl)
+        elif info is _unknown:
+            info = None
+        return info
+
+    def invalidate(self, client_id):
+        self._cache.invalidate(client_id)
+
+    def clear(self):
+        self._cache.clear()
+
+    def __len__(self):
+        return len(self._cache)
+
+    def stats(self):
+        return self._cache.stats()
+
+
+secret_cache = ClientSecretCache()
+token_cache = TokenCache()
+client_cache = ClientCache()
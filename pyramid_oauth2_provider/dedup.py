@@ -0,0 +1,154 @@
+#
+# Copyright (c) Elliot Peele <elliot@bentlogic.net>
+#
+# This program is distributed under the terms of the MIT License as found
+# in a file called LICENSE. If it is not present, the license
+# is always available at http://www.opensource.org/licenses/mit-license.php.
+#
+# This program is distributed in the hope that it will be useful, but
+# without any warrenty; without even the implied warranty of merchantability
+# or fitness for a particular purpose. See the MIT License for full details.
+#
+
+"""
+Deduplication of identical token requests.
+
+Clients retrying a token request, or sending it twice from racing threads,
+would otherwise be issued two tokens, or lose the race for a refresh token
+and be told it is invalid. Within a short window identical requests of a
+client are answered with the response to the first one instead.
+"""
+
+import os
+import hmac
+import json
+import time
+import hashlib
+import logging
+import threading
+
+import transaction
+
+from .cache import TTLCache
+
+log = logging.getLogger('pyramid_oauth2_provider.dedup')
+
+
+class RequestDeduplicator(object):
+    """
+    Answers identical requests made within window seconds of each other
+    with the response to the first. Requests arriving while the first is
+    still in progress wait up to window seconds for it to commit. Only
+    successful responses are shared, after their transaction commits, a
+    request that fails or is rolled back lets the next one run. A window of
+    zero disables deduplication.
+
+    Requests are identified by an HMAC of the client and the grant
+    parameters keyed with a random per process key, so that the passwords
+    and refresh tokens they carry are not kept in memory. The shared
+    responses, with the access and refresh tokens they issue, are kept for
+    window seconds.
+    """
+
+    def __init__(self, window=0, max_size=10000, clock=time.time):
+        self._key = os.urandom(32)
+        self._responses = TTLCache(max_size=max_size, ttl=window, clock=clock)
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def configure(self, window=None, max_size=None):
+        self._responses.configure(max_size=max_size, ttl=window)
+
+    @property
+    def window(self):
+        return self._responses.ttl
+
+    @property
+    def enabled(self):
+        return self._responses.enabled
+
+    def key(self, client_id, params):
+        """
+        The key of a request of client_id with the grant parameters params,
+        a mapping or a sequence of pairs.
+        """
+
+        if hasattr(params, 'items'):
+            params = params.items()
+        message = json.dumps([client_id, sorted(params)])
+        return hmac.new(self._key, message.encode('utf-8'),
+                        hashlib.sha256).digest()
+
+    def _claim(self, key):
+        """
+        Return the stored response for key, or the event of the request in
+        progress to wait on, or a new event for the caller to finish, as a
+        tuple of the response, the event and whether the caller owns it.
+        """
+
+        with self._lock:
+            response = self._responses.get(key)
+            if response is not None:
+                return response, None, False
+            event = self._pending.get(key)
+            if event is not None:
+                return None, event, False
+            event = self._pending[key] = threading.Event()
+            return None, event, True
+
+    def _finish(self, committed, key, event, response):
+        if committed and response is not None:
+            self._responses.set(key, response)
+        with self._lock:
+            if self._pending.get(key) is event:
+                del self._pending[key]
+        event.set()
+
+    def run(self, key, func, request=None):
+        """
+        Return the response of an earlier identical request, or run func to
+        answer this one. A dict returned by func is shared with identical
+        requests once the current transaction commits. Identical requests
+        stop waiting for it when the transaction ends or, if request is
+        given, when the request finishes.
+        """
+
+        if not self.enabled:
+            return func()
+
+        while True:
+            response, event, owner = self._claim(key)
+            if response is not None:
+                log.info('answered duplicate request')
+                return dict(response)
+            if owner:
+                break
+            if not event.wait(self.window):
+                # The first request is taking too long, or ended without a
+                # transaction outcome, answer this one on its own.
+                self._finish(False, key, event, None)
+                return func()
+
+        response = None
+        try:
+            response = func()
+        finally:
+            if isinstance(response, dict):
+                txn = transaction.get()
+                txn.addAfterCommitHook(self._finish,
+                                       args=(key, event, dict(response)))
+                txn.addAfterAbortHook(self._finish,
+                                      args=(False, key, event, None))
+                if request is not None:
+                    # Runs after pyramid_tm committed or aborted.
+                    request.add_finished_callback(
+                        lambda request: self._finish(False, key, event, None))
+            else:
+                self._finish(False, key, event, None)
+        return response
+
+    def clear(self):
+        self._responses.clear()
+
+
+request_dedup = RequestDeduplicator()
@@ -46,6 +46,18 @@ class InvalidClient(BaseOauth2Error):
     error_name = 'invalid_client'
 
 
+class InvalidGrant(BaseOauth2Error):
+    """
+    The provided authorization grant (e.g. authorization code, resource
+    owner credentials) or refresh token is invalid, expired, revoked, does
+    not match the redirection URI used in the authorization request, or was
+    issued to another client.
+
+    http://tools.ietf.org/html/draft-ietf-oauth-v2-31#section-5.2
+    """
+    error_name = 'invalid_grant'
+
+
 class UnauthorizedClient(BaseOauth2Error):
     """
     The authenticated user is not authorized to use this authorization
@@ -76,3 +88,13 @@ class InvalidToken(BaseOauth2Error):
     http://tools.ietf.org/html/draft-ietf-oauth-v2-bearer-23#section-3.1
     """
     error_name = 'invalid_token'
+
+
+class TemporarilyUnavailable(BaseOauth2Error):
+    """
+    The authorization server is currently unable to handle the request
+    due to a temporary overloading or maintenance of the server.
+
+    http://tools.ietf.org/html/draft-ietf-oauth-v2-31#section-4.1.2.1
+    """
+    error_name = 'temporarily_unavailable'
@@ -10,25 +10,138 @@
 # or fitness for a particular purpose. See the MIT License for full details.
 #
 
+"""
+Generation of client ids, client secrets, authorization codes and tokens.
 
-import time
-import random
-import hashlib
+Values are url safe base64 strings of random bytes from os.urandom. The
+default generator reads entropy in bulk into a buffer and hands out slices
+of it, so each token costs a slice and an encode rather than a system call.
+"""
 
-def _get_hash():
-    sha = hashlib.sha256()
-    sha.update(str(random.random()).encode('utf8'))
-    sha.update(str(time.time()).encode('utf8'))
-    return sha
+import os
+import logging
+import weakref
+import threading
+from base64 import urlsafe_b64encode
+
+from zope.interface import implementer
+
+from .interfaces import ITokenGenerator
+
+log = logging.getLogger('pyramid_oauth2_provider.generators')
+
+# Client ids and tokens are stored in 64 character columns.
+MAX_TOKEN_LENGTH = 64
+
+# Refresh tokens are <family>.<token>, with a family id of FAMILY_ID_BYTES
+# random bytes.
+FAMILY_ID_BYTES = 12
+
+# Every TokenGenerator, so that their buffers can be dropped in forked
+# children.
+_generators = weakref.WeakSet()
+
+def _after_fork():
+    for generator in list(_generators):
+        generator._reset()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork)
+
+def _encode(data):
+    return urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+def _encoded_length(nbytes):
+    return (nbytes * 4 + 2) // 3
+
+# Characters a refresh token adds in front of a generated token.
+REFRESH_PREFIX_LENGTH = _encoded_length(FAMILY_ID_BYTES) + 1
+
+
+@implementer(ITokenGenerator)
+class TokenGenerator(object):
+    """
+    Makes url safe tokens from nbytes random bytes each, 43 characters for
+    the default 256 bits. Tokens have to leave room for the family prefix of
+    refresh tokens, which limits nbytes to 35. Entropy is read from
+    os.urandom buffer_size bytes at a time. The buffer is dropped after a
+    fork so that processes never share random bytes.
+    """
+
+    def __init__(self, nbytes=32, buffer_size=4096):
+        if nbytes < 16:
+            raise ValueError('tokens need at least 16 random bytes')
+        if (_encoded_length(nbytes) + REFRESH_PREFIX_LENGTH >
+                MAX_TOKEN_LENGTH):
+            raise ValueError('refresh tokens of %d bytes do not fit in %d '
+                             'characters' % (nbytes, MAX_TOKEN_LENGTH))
+        self.nbytes = nbytes
+        self.buffer_size = max(buffer_size, nbytes)
+        self._lock = threading.Lock()
+        self._reset()
+        _generators.add(self)
+
+    def _reset(self):
+        self._buffer = b''
+        self._offset = 0
+
+    def _read(self, size):
+        with self._lock:
+            if size > self.buffer_size:
+                return os.urandom(size)
+            if self._offset + size > len(self._buffer):
+                self._buffer = os.urandom(self.buffer_size)
+                self._offset = 0
+            data = self._buffer[self._offset:self._offset + size]
+            self._offset += size
+            return data
+
+    def gen_token(self):
+        return _encode(self._read(self.nbytes))
+
+    def gen_tokens(self, count):
+        """
+        Return a list of count distinct tokens.
+        """
+
+        nbytes = self.nbytes
+        tokens = []
+        seen = set()
+        while len(tokens) < count:
+            data = self._read((count - len(tokens)) * nbytes)
+            for i in range(0, len(data), nbytes):
+                token = _encode(data[i:i + nbytes])
+                if token not in seen:
+                    seen.add(token)
+                    tokens.append(token)
+        return tokens
+
+
+_generator = TokenGenerator()
+
+def configure(generator):
+    global _generator
+    _generator = generator
+
+def get_generator():
+    return _generator
 
 def gen_client_id():
-    return _get_hash().hexdigest()
+    return _generator.gen_token()
 
 def gen_client_secret():
-    return _get_hash().hexdigest()
+    return _generator.gen_token()
+
+def gen_token(client=None):
+    return _generator.gen_token()
+
+def gen_tokens(count):
+    return _generator.gen_tokens(count)
 
-def gen_token(client):
-    sha = _get_hash()
-    sha.update(client.client_id.encode('utf8'))
-    return sha.hexdigest()
+def gen_family_id(nbytes=FAMILY_ID_BYTES):
+    """
+    Return a short random id for a refresh token family. It is part of
+    every refresh token of the family, 96 bits keep it unguessable.
+    """
 
+    return _encode(os.urandom(nbytes))
@@ -0,0 +1,276 @@
+#
+# Copyright (c) Elliot Peele <elliot@bentlogic.net>
+#
+# This program is distributed under the terms of the MIT License as found
+# in a file called LICENSE. If it is not present, the license
+# is always available at http://www.opensource.org/licenses/mit-license.php.
+#
+# This program is distributed in the hope that it will be useful, but
+# without any warrenty; without even the implied warranty of merchantability
+# or fitness for a particular purpose. See the MIT License for full details.
+#
+
+"""
+Pluggable, versioned hashing of client secrets.
+
+Stored hashes carry the algorithm, its cost parameters and a per row salt:
+
+    <algorithm>$<name>=<value>,...$<base64 salt>$<base64 hash>
+
+Hashes written before this format existed are raw 64 byte scrypt digests
+using the global oauth2_provider.salt setting. They are still verified and
+are rewritten in the current format the next time they verify successfully.
+"""
+
+import os
+import hmac
+import hashlib
+import logging
+from base64 import b64encode
+from base64 import b64decode
+
+from cryptography.exceptions import InvalidKey
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives.kdf.scrypt import Scrypt
+
+try:
+    from cryptography.hazmat.primitives.kdf.argon2 import Argon2id
+except ImportError:
+    Argon2id = None
+
+from .kdf import kdf_pool
+
+log = logging.getLogger('pyramid_oauth2_provider.hashers')
+
+_hashers = {}
+
+
+def register_hasher(cls):
+    """
+    Make a hasher class available by its algorithm name. May be used as a
+    class decorator.
+    """
+
+    _hashers[cls.algorithm] = cls
+    return cls
+
+def get_hasher(algorithm, **params):
+    try:
+        cls = _hashers[algorithm]
+    except KeyError:
+        raise ValueError('unknown client secret hasher: %s' % algorithm)
+    return cls(**params)
+
+def available_hashers():
+    return sorted(_hashers)
+
+
+class BaseHasher(object):
+    """
+    A hasher derives a stored hash from a secret and verifies secrets
+    against stored hashes. Subclasses define the algorithm name, the
+    default cost parameters and the derive method.
+    """
+
+    algorithm = None
+    defaults = {}
+    salt_size = 16
+    # Cheap hashers are run inline rather than on the kdf pool.
+    expensive = True
+
+    def __init__(self, **params):
+        self.params = dict(self.defaults)
+        for key, value in params.items():
+            if key not in self.defaults:
+                raise ValueError('unknown parameter %s for hasher %s'
+                                 % (key, self.algorithm))
+            self.params[key] = int(value)
+
+    def derive(self, secret, salt):
+        raise NotImplementedError
+
+    def encode(self, secret, salt=None):
+        if salt is None:
+            salt = os.urandom(self.salt_size)
+        params = ','.join('%s=%d' % (k, v)
+                          for k, v in sorted(self.params.items()))
+        return b'$'.join([
+            self.algorithm.encode('ascii'),
+            params.encode('ascii'),
+            b64encode(salt),
+            b64encode(self.derive(secret, salt)),
+        ])
+
+    @classmethod
+    def decode(cls, encoded):
+        """
+        Split a stored hash into a hasher configured with the stored cost
+        parameters, the salt and the digest.
+        """
+
+        algorithm, params, salt, digest = encoded.split(b'$')
+        params = dict(x.split('=') for x in
+                      params.decode('ascii').split(',') if x)
+        return cls(**params), b64decode(salt), b64decode(digest)
+
+    def verify(self, secret, encoded):
+        hasher, salt, digest = self.decode(encoded)
+        return hmac.compare_digest(hasher.derive(secret, salt), digest)
+
+    def needs_upgrade(self, encoded):
+        """
+        True when encoded was not produced by this hasher with these
+        parameters.
+        """
+
+        if not encoded.startswith(self.algorithm.encode('ascii') + b'$'):
+            return True
+        hasher = self.decode(encoded)[0]
+        return hasher.params != self.params
+
+
+@register_hasher
+class ScryptHasher(BaseHasher):
+    algorithm = 'scrypt'
+    defaults = {'n': 2 ** 14, 'r': 8, 'p': 1, 'length': 64}
+
+    def derive(self, secret, salt):
+        return Scrypt(
+            salt=salt,
+            length=self.params['length'],
+            n=self.params['n'],
+            r=self.params['r'],
+            p=self.params['p'],
+            backend=default_backend()
+        ).derive(secret)
+
+
+if Argon2id is not None:
+    @register_hasher
+    class Argon2idHasher(BaseHasher):
+        algorithm = 'argon2id'
+        defaults = {'iterations': 2, 'lanes': 1, 'memory_cost': 19 * 1024,
+                    'length': 32}
+
+        def derive(self, secret, salt):
+            return Argon2id(
+                salt=salt,
+                length=self.params['length'],
+                iterations=self.params['iterations'],
+                lanes=self.params['lanes'],
+                memory_cost=self.params['memory_cost'],
+            ).derive(secret)
+
+
+@register_hasher
+class HMACSHA256Hasher(BaseHasher):
+    """
+    Salted HMAC-SHA256. Only suitable when every secret is a high entropy
+    random value, such as the 256 bit secrets from gen_client_secret, since
+    it offers no protection against guessing low entropy secrets.
+    """
+
+    algorithm = 'hmac_sha256'
+    salt_size = 32
+    expensive = False
+
+    def derive(self, secret, salt):
+        return hmac.new(salt, secret, hashlib.sha256).digest()
+
+
+class LegacyScryptHasher(ScryptHasher):
+    """
+    Verifies unversioned hashes, which are a bare scrypt digest under the
+    global salt.
+    """
+
+    algorithm = 'scrypt_legacy'
+
+    def __init__(self, salt):
+        ScryptHasher.__init__(self)
+        self.salt = salt
+
+    def verify(self, secret, encoded):
+        return hmac.compare_digest(self.derive(secret, self.salt), encoded)
+
+    def needs_upgrade(self, encoded):
+        return True
+
+
+_default_hasher = ScryptHasher()
+
+def configure(algorithm='scrypt', **params):
+    """
+    Set the hasher used for new client secrets.
+    """
+
+    global _default_hasher
+    _default_hasher = get_hasher(algorithm, **params)
+    return _default_hasher
+
+def configure_from_settings(settings):
+    """
+    Configure the hasher from parsed Oauth2Settings.
+    """
+
+    return configure(settings.hasher, **settings.prefixed('hasher.'))
+
+def get_default_hasher():
+    return _default_hasher
+
+def identify_hasher(encoded, legacy_salt=None):
+    """
+    Return a hasher able to verify encoded.
+    """
+
+    algorithm = encoded.split(b'$', 1)[0].decode('ascii', 'replace')
+    if b'$' in encoded and algorithm in _hashers:
+        return _hashers[algorithm]()
+    if not legacy_salt:
+        raise ValueError('oauth2_provider.salt configuration required.')
+    return LegacyScryptHasher(legacy_salt)
+
+def _run(hasher, func, *args):
+    if hasher.expensive:
+        return kdf_pool.run(func, *args)
+    return func(*args)
+
+def make_secret_hash(secret, hasher=None):
+    """
+    Hash secret for storage with the configured hasher.
+    """
+
+    hasher = hasher or _default_hasher
+    return _run(hasher, hasher.encode, secret)
+
+_dummy_hashes = {}
+
+def dummy_verify(secret):
+    """
+    Verify secret against a throw away hash made by the configured hasher,
+    so that rejecting an unknown client costs as much as rejecting a bad
+    secret for a known one. Always returns False.
+    """
+
+    hasher = _default_hasher
+    key = (hasher.algorithm, tuple(sorted(hasher.params.items())))
+    encoded = _dummy_hashes.get(key)
+    if encoded is None:
+        encoded = _dummy_hashes[key] = hasher.encode(os.urandom(32))
+    _run(hasher, hasher.verify, secret, encoded)
+    return False
+
+def check_secret_hash(secret, encoded, legacy_salt=None):
+    """
+    Verify secret against a stored hash. Returns a tuple of whether the
+    secret matched and whether the stored hash should be rewritten with the
+    configured hasher.
+    """
+
+    hasher = identify_hasher(encoded, legacy_salt)
+    try:
+        valid = _run(hasher, hasher.verify, secret, encoded)
+    except (InvalidKey, ValueError, TypeError):
+        log.info('unable to verify malformed client secret hash')
+        valid = False
+    return valid, valid and _default_hasher.needs_upgrade(encoded)
@@ -26,3 +26,64 @@ class IAuthCheck(Interface):
         usually a relational database. Return the users user_id if credentials
         are valid, otherwise False or None.
         """
+
+
+class IRevocationTransport(Interface):
+    """
+    Carries token and client revocation events between worker processes so
+    that every worker can evict them from its in process caches.
+    """
+
+    def publish(self, kind, key):
+        """
+        Record that the cached entry of the given kind ('token' or 'client')
+        identified by key has been revoked.
+        """
+
+    def head(self):
+        """
+        Return the id of the most recent event, or 0 if there are none.
+        """
+
+    def since(self, created):
+        """
+        Optional. Return the id just before the first event created at or
+        after created, seconds since the epoch, or the head if there is
+        none. Transports without it cannot replay events to new workers.
+        """
+
+    def poll(self, after, limit):
+        """
+        Return up to limit RevocationEvents with an id greater than after,
+        oldest first.
+        """
+
+
+class ITokenGenerator(Interface):
+    """
+    Makes the random values used for client ids, client secrets,
+    authorization codes and tokens.
+    """
+
+    def gen_token(self):
+        """
+        Return a new url safe token of at most 64 characters.
+        """
+
+    def gen_tokens(self, count):
+        """
+        Return a list of count distinct tokens.
+        """
+
+
+class IRateLimitBackend(Interface):
+    """
+    Keeps the request counts that rate limits are enforced with.
+    """
+
+    def hit(self, key, limit, period):
+        """
+        Count a request for key, which is allowed limit requests every
+        period seconds. Return 0 when the request is allowed, otherwise the
+        number of seconds until it would be.
+        """
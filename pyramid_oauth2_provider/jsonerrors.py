@@ -17,16 +17,68 @@ Custom HTTP exceptions that support rendering to JSON by default.
 # NOTE: If you need to add more errors, please subclass errors from
 #       httpexceptions as has been done below.
 
-from string import Template
+import json
+import threading
+from collections import OrderedDict
 
 from pyramid import httpexceptions
-from pyramid.httpexceptions import text_type
-from pyramid.httpexceptions import _no_escape
 from pyramid.httpexceptions import WSGIHTTPException
 
-def _quote_escape(value):
-    v = _no_escape(value)
-    return v.replace('"', '\\"')
+_encoder = json.JSONEncoder(sort_keys=True, separators=(',', ':'),
+                            default=str)
+
+# Encoded bodies of recently rendered errors. Most error responses carry
+# one of a handful of fixed OAuth2 error dicts, so their bodies are only
+# encoded once.
+MAX_RENDERED = 256
+_rendered = OrderedDict()
+_rendered_lock = threading.Lock()
+
+def _cache_key(error):
+    detail = error.detail
+    if isinstance(detail, dict):
+        detail = tuple(sorted(detail.items()))
+    key = (error.code, error.explanation, detail)
+    try:
+        hash(key)
+    except TypeError:
+        return None
+    return key
+
+def render_json(error):
+    """
+    Return the encoded JSON body for error. The detail of errors raised by
+    this package is an OAuth2 error dict, which is included as an object.
+    """
+
+    key = error.comment is None and _cache_key(error) or None
+    if key is not None:
+        with _rendered_lock:
+            page = _rendered.get(key)
+            if page is not None:
+                _rendered.move_to_end(key)
+                return page
+
+    body = {
+        'status': error.status,
+        'code': error.code,
+        'explanation': error.explanation,
+        'detail': error.detail or '',
+    }
+    if error.comment is not None:
+        body['comment'] = error.comment
+    page = _encoder.encode(body).encode('ascii')
+
+    if key is not None:
+        with _rendered_lock:
+            _rendered[key] = page
+            if len(_rendered) > MAX_RENDERED:
+                _rendered.popitem(last=False)
+    return page
+
+def render_plain(error):
+    return ('%s\n\n%s\n\n%s\n%s\n' % (error.status, error.explanation,
+        error.detail or '', error.comment or '')).encode('utf-8')
 
 
 class BaseJsonHTTPError(WSGIHTTPException):
@@ -34,58 +86,19 @@ class BaseJsonHTTPError(WSGIHTTPException):
     Base error class for rendering errors in JSON.
     """
 
-    json_template_obj = Template('''\
-{
-    "status": "${status}",
-    "code": ${code},
-    "explanation": "${explanation}",
-    "detail": "${detail}"
-}
-${html_comment}
-''')
-
     def prepare(self, environ):
         """
-        Always return errors in JSON.
+        Always return errors in JSON, unless plain text is asked for.
         """
 
-        if not self.body and not self.empty_body:
-            html_comment = ''
-            comment = self.comment or ''
-            accept = environ.get('HTTP_ACCEPT', '')
-            if 'text/plain' in accept:
-                self.content_type = 'text/plain'
-                escape = _no_escape
-                page_template = self.plain_template_obj
-                br = '\n'
-                if comment:
-                    html_comment = escape(comment)
-            else:
-                self.content_type = 'aplication/json'
-                escape = _quote_escape
-                page_template = self.json_template_obj
-                br = '\n'
-                if comment:
-                    html_comment = '# %s' % comment
-            args = {
-                'br': br,
-                'explanation': escape(self.explanation),
-                'detail': escape(self.detail or ''),
-                'comment': escape(comment),
-                'html_comment': html_comment,
-                }
-            for k, v in list(environ.items()):
-                if (not k.startswith('wsgi.')) and ('.' in k):
-                    continue
-                args[k] = escape(v)
-            for k, v in list(self.headers.items()):
-                args[k.lower()] = escape(v)
-            page = page_template.substitute(status=self.status,
-                code=self.code, **args)
-            if isinstance(page, text_type):
-                page = page.encode(self.charset)
-            self.app_iter = [page]
-            self.body = page
+        if self.has_body or self.empty_body:
+            return
+        if 'text/plain' in environ.get('HTTP_ACCEPT', ''):
+            self.content_type = 'text/plain'
+            self.body = render_plain(self)
+        else:
+            self.content_type = 'application/json'
+            self.body = render_json(self)
 
 
 class HTTPBadRequest(httpexceptions.HTTPBadRequest, BaseJsonHTTPError):
@@ -99,3 +112,13 @@ class HTTPUnauthorized(httpexceptions.HTTPUnauthorized, BaseJsonHTTPError):
 class HTTPMethodNotAllowed(httpexceptions.HTTPMethodNotAllowed,
     BaseJsonHTTPError):
     pass
+
+
+class HTTPTooManyRequests(httpexceptions.HTTPTooManyRequests,
+    BaseJsonHTTPError):
+    pass
+
+
+class HTTPServiceUnavailable(httpexceptions.HTTPServiceUnavailable,
+    BaseJsonHTTPError):
+    pass
@@ -0,0 +1,161 @@
+#
+# Copyright (c) Elliot Peele <elliot@bentlogic.net>
+#
+# This program is distributed under the terms of the MIT License as found
+# in a file called LICENSE. If it is not present, the license
+# is always available at http://www.opensource.org/licenses/mit-license.php.
+#
+# This program is distributed in the hope that it will be useful, but
+# without any warrenty; without even the implied warranty of merchantability
+# or fitness for a particular purpose. See the MIT License for full details.
+#
+
+"""
+Bounded worker pool for running key derivation functions off of the HTTP
+worker threads.
+"""
+
+import time
+import logging
+import threading
+
+from concurrent.futures import Future
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ProcessPoolExecutor
+
+log = logging.getLogger('pyramid_oauth2_provider.kdf')
+
+
+class KDFPoolSaturated(Exception):
+    """
+    Raised when the pool already has as much work outstanding as it is
+    configured to accept.
+    """
+
+
+def _timed(func, *args):
+    started = time.time()
+    result = func(*args)
+    return started, time.time(), result
+
+
+class _InlineExecutor(object):
+    """
+    Executor that runs work in the calling thread, useful for scripts and
+    tests.
+    """
+
+    def submit(self, func, *args):
+        future = Future()
+        try:
+            future.set_result(func(*args))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def shutdown(self, wait=True):
+        pass
+
+
+class KDFPool(object):
+    """
+    Runs key derivation work on a thread or process pool. At most workers
+    plus max_queue calls may be outstanding at any time, anything more is
+    rejected with KDFPoolSaturated instead of piling up behind the pool.
+
+    Time spent waiting for a worker and time spent in the KDF itself are
+    tracked separately so that the pool can be sized independently of the
+    HTTP threads.
+    """
+
+    executors = {
+        'thread': ThreadPoolExecutor,
+        'process': ProcessPoolExecutor,
+    }
+
+    def __init__(self, executor='thread', workers=2, max_queue=16):
+        self._lock = threading.Lock()
+        self._executor = None
+        self.pending = 0
+        self.configure(executor=executor, workers=workers,
+                       max_queue=max_queue)
+
+    def configure(self, executor=None, workers=None, max_queue=None):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False)
+                self._executor = None
+            if executor is not None:
+                if executor != 'inline' and executor not in self.executors:
+                    raise ValueError('unknown kdf executor: %s' % executor)
+                self.executor_type = executor
+            if workers is not None:
+                self.workers = workers
+            if max_queue is not None:
+                self.max_queue = max_queue
+            self.reset_stats()
+
+    def reset_stats(self):
+        self.completed = 0
+        self.rejected = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+        self.kdf_time = 0.0
+        self.max_kdf_time = 0.0
+
+    def _get_executor(self):
+        if self._executor is None:
+            if self.executor_type == 'inline' or self.workers < 1:
+                self._executor = _InlineExecutor()
+            else:
+                cls = self.executors[self.executor_type]
+                self._executor = cls(max_workers=self.workers)
+        return self._executor
+
+    def run(self, func, *args):
+        """
+        Run func(*args) on the pool and wait for the result.
+        """
+
+        with self._lock:
+            if self.pending >= max(self.workers, 1) + self.max_queue:
+                self.rejected += 1
+                raise KDFPoolSaturated()
+            self.pending += 1
+            executor = self._get_executor()
+
+        submitted = time.time()
+        try:
+            started, finished, result = executor.submit(
+                _timed, func, *args).result()
+        finally:
+            with self._lock:
+                self.pending -= 1
+
+        with self._lock:
+            wait = max(started - submitted, 0.0)
+            elapsed = finished - started
+            self.completed += 1
+            self.wait_time += wait
+            self.kdf_time += elapsed
+            self.max_wait_time = max(self.max_wait_time, wait)
+            self.max_kdf_time = max(self.max_kdf_time, elapsed)
+        return result
+
+    def stats(self):
+        completed = self.completed or 1
+        return {
+            'executor': self.executor_type,
+            'workers': self.workers,
+            'max_queue': self.max_queue,
+            'pending': self.pending,
+            'completed': self.completed,
+            'rejected': self.rejected,
+            'avg_wait_time': self.wait_time / completed,
+            'max_wait_time': self.max_wait_time,
+            'avg_kdf_time': self.kdf_time / completed,
+            'max_kdf_time': self.max_kdf_time,
+        }
+
+
+kdf_pool = KDFPool()
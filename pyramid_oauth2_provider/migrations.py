@@ -0,0 +1,220 @@
+#
+# Copyright (c) Elliot Peele <elliot@bentlogic.net>
+#
+# This program is distributed under the terms of the MIT License as found
+# in a file called LICENSE. If it is not present, the license
+# is always available at http://www.opensource.org/licenses/mit-license.php.
+#
+# This program is distributed in the hope that it will be useful, but
+# without any warrenty; without even the implied warranty of merchantability
+# or fitness for a particular purpose. See the MIT License for full details.
+#
+
+"""
+Bring a database created by an earlier release up to the current schema.
+
+initialize_sql only creates missing tables, it never changes existing ones.
+upgrade adds missing columns, backfills them and creates missing indexes.
+Every step checks the current schema first, so it is safe to run repeatedly.
+
+Tokens written by earlier releases are stored in plaintext. upgrade fills
+in their SHA-256 digests, and with clear_plaintext also removes the
+plaintext once the digests are in place.
+"""
+
+import logging
+from datetime import timedelta
+
+from sqlalchemy import inspect
+from sqlalchemy import select
+from sqlalchemy import bindparam
+
+from .models import Base
+from .models import Oauth2Code
+from .models import Oauth2Token
+from .models import hash_token
+
+log = logging.getLogger('pyramid_oauth2_provider.migrations')
+
+
+def _add_column(engine, table, column):
+    log.info('adding column %s.%s' % (table.name, column.name))
+    engine.execute('ALTER TABLE %s ADD COLUMN %s %s' % (
+        table.name, column.name, column.type.compile(dialect=engine.dialect)))
+
+def backfill_expires_at(engine, model, batch_size=1000):
+    """
+    Fill in expires_at from creation_date and expires_in in batches of
+    batch_size rows. Returns the number of rows updated.
+    """
+
+    table = model.__table__
+    query = select([table.c.id, table.c.creation_date, table.c.expires_in])\
+        .where(table.c.expires_at == None).order_by(table.c.id)\
+        .limit(batch_size)
+    update = table.update().where(table.c.id == bindparam('row_id'))\
+        .values(expires_at=bindparam('row_expires_at'))
+
+    count = 0
+    while True:
+        with engine.begin() as conn:
+            rows = conn.execute(query).fetchall()
+            if not rows:
+                break
+            conn.execute(update, [
+                {'row_id': id,
+                 'row_expires_at': creation_date +
+                    timedelta(seconds=expires_in)}
+                for id, creation_date, expires_in in rows])
+        count += len(rows)
+    if count:
+        log.info('backfilled expires_at for %d rows of %s'
+                 % (count, table.name))
+    return count
+
+def backfill_token_hashes(engine, batch_size=1000):
+    """
+    Fill in the access and refresh token digests of rows that only store
+    the plaintext tokens, in batches of batch_size rows. Returns the number
+    of rows updated.
+    """
+
+    table = Oauth2Token.__table__
+    query = select([table.c.id, table.c.access_token, table.c.refresh_token])\
+        .where(table.c.access_token_hash == None)\
+        .where(table.c.access_token != None)\
+        .order_by(table.c.id).limit(batch_size)
+    update = table.update().where(table.c.id == bindparam('row_id'))\
+        .values(access_token_hash=bindparam('row_access_token_hash'),
+                refresh_token_hash=bindparam('row_refresh_token_hash'))
+
+    count = 0
+    while True:
+        with engine.begin() as conn:
+            rows = conn.execute(query).fetchall()
+            if not rows:
+                break
+            conn.execute(update, [
+                {'row_id': id,
+                 'row_access_token_hash': hash_token(access_token),
+                 'row_refresh_token_hash': hash_token(refresh_token)}
+                for id, access_token, refresh_token in rows])
+        count += len(rows)
+    if count:
+        log.info('backfilled token digests for %d rows' % count)
+    return count
+
+_drop_not_null = {
+    'postgresql': 'ALTER TABLE %(table)s ALTER COLUMN %(column)s '
+                  'DROP NOT NULL',
+    'mysql': 'ALTER TABLE %(table)s MODIFY %(column)s %(type)s NULL',
+}
+
+def _rebuild_sqlite_table(engine, table):
+    """
+    Recreate table with its current definition and copy its rows over.
+    SQLite can not change the constraints of existing columns, so this is
+    how they are brought up to date there.
+    """
+
+    inspector = inspect(engine)
+    existing = [x['name'] for x in inspector.get_columns(table.name)]
+    indexes = [x['name'] for x in inspector.get_indexes(table.name)]
+    columns = ', '.join(x.name for x in table.columns if x.name in existing)
+    old_name = '_old_%s' % table.name
+    log.info('rebuilding table %s' % table.name)
+    with engine.begin() as conn:
+        # Index names are global, the new table creates them again.
+        for name in indexes:
+            conn.execute('DROP INDEX %s' % name)
+        conn.execute('ALTER TABLE %s RENAME TO %s' % (table.name, old_name))
+        table.create(conn)
+        conn.execute('INSERT INTO %s (%s) SELECT %s FROM %s'
+                     % (table.name, columns, columns, old_name))
+        conn.execute('DROP TABLE %s' % old_name)
+
+def clear_plaintext_tokens(engine, batch_size=1000):
+    """
+    Remove the plaintext of tokens whose digests are stored, in batches of
+    batch_size rows. The plaintext columns are made nullable first, on
+    SQLite by rebuilding the table. Returns the number of rows updated.
+    """
+
+    table = Oauth2Token.__table__
+    columns = dict((x['name'], x) for x in
+                   inspect(engine).get_columns(table.name))
+    for name in ('access_token', 'refresh_token'):
+        if columns[name]['nullable']:
+            continue
+        if engine.dialect.name == 'sqlite':
+            _rebuild_sqlite_table(engine, table)
+            break
+        statement = _drop_not_null.get(engine.dialect.name)
+        if statement is None:
+            raise RuntimeError('unable to make %(table)s.%(column)s nullable '
+                'on %(dialect)s, drop its NOT NULL constraint by hand, e.g. '
+                'ALTER TABLE %(table)s ALTER COLUMN %(column)s DROP NOT NULL, '
+                'and run the upgrade again, or keep oauth2_provider.'
+                'token_storage = dual on this database'
+                % {'table': table.name, 'column': name,
+                   'dialect': engine.dialect.name})
+        column = table.c[name]
+        log.info('making column %s.%s nullable' % (table.name, name))
+        engine.execute(statement % {'table': table.name, 'column': name,
+            'type': column.type.compile(dialect=engine.dialect)})
+
+    query = select([table.c.id]).where(table.c.access_token != None)\
+        .where(table.c.access_token_hash != None)\
+        .order_by(table.c.id).limit(batch_size)
+    count = 0
+    while True:
+        with engine.begin() as conn:
+            ids = [x[0] for x in conn.execute(query).fetchall()]
+            if not ids:
+                break
+            conn.execute(table.update().where(table.c.id.in_(ids))
+                         .values(access_token=None, refresh_token=None))
+        count += len(ids)
+    if count:
+        log.info('cleared plaintext tokens of %d rows' % count)
+    return count
+
+def create_missing_indexes(engine):
+    inspector = inspect(engine)
+    created = []
+    for table in Base.metadata.sorted_tables:
+        existing = set(x['name'] for x in inspector.get_indexes(table.name))
+        for index in table.indexes:
+            if index.name not in existing:
+                log.info('creating index %s' % index.name)
+                index.create(engine)
+                created.append(index.name)
+    return created
+
+def upgrade(engine, batch_size=1000, clear_plaintext=False):
+    """
+    Upgrade the schema in place. With clear_plaintext the plaintext of
+    tokens is removed once their digests have been backfilled.
+    """
+
+    Base.metadata.create_all(engine)
+
+    inspector = inspect(engine)
+    for model in (Oauth2Token, Oauth2Code):
+        table = model.__table__
+        columns = set(x['name'] for x in inspector.get_columns(table.name))
+        if 'expires_at' not in columns:
+            _add_column(engine, table, table.c.expires_at)
+        backfill_expires_at(engine, model, batch_size)
+
+    table = Oauth2Token.__table__
+    columns = set(x['name'] for x in inspector.get_columns(table.name))
+    for column in (table.c.access_token_hash, table.c.refresh_token_hash,
+                   table.c.refresh_family, table.c.generation):
+        if column.name not in columns:
+            _add_column(engine, table, column)
+    backfill_token_hashes(engine, batch_size)
+    if clear_plaintext:
+        clear_plaintext_tokens(engine, batch_size)
+
+    create_missing_indexes(engine)
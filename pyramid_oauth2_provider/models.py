@@ -10,10 +10,17 @@
 # or fitness for a particular purpose. See the MIT License for full details.
 #
 
-import time
+import hmac
+import hashlib
+import binascii
+import itertools
 from datetime import datetime
+from datetime import timedelta
 from base64 import b64decode
+from contextlib import contextmanager
 
+from sqlalchemy import event
+from sqlalchemy import Index
 from sqlalchemy import Column
 from sqlalchemy import ForeignKey
 
@@ -24,6 +31,7 @@ from sqlalchemy import Boolean
 from sqlalchemy import DateTime
 from sqlalchemy import Unicode
 
+from sqlalchemy.ext.declarative import declared_attr
 from sqlalchemy.ext.declarative import declarative_base
 
 from sqlalchemy.orm import backref
@@ -31,22 +39,91 @@ from sqlalchemy.orm import relationship
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.orm import scoped_session
 from sqlalchemy.orm import synonym
+from sqlalchemy.orm import validates
+from sqlalchemy.orm import Session
+from sqlalchemy.orm import joinedload
+from sqlalchemy.orm import make_transient_to_detached
+from sqlalchemy.orm.attributes import set_committed_value
 
+from zope.sqlalchemy import mark_changed
 from zope.sqlalchemy import ZopeTransactionExtension
 
-from cryptography.hazmat.primitives.kdf.scrypt import Scrypt
 from cryptography.hazmat.backends import default_backend
-from .util import oauth2_settings
+from .util import normalize_uri
+from .util import get_oauth2_settings
+from .cache import secret_cache
+from .cache import token_cache
+from .cache import client_cache
+from .cache import ClientInfo
+from .revocation import token_key
+from .revocation import publish_revocation
+from .revocation import publish_revocations
+from .hashers import make_secret_hash
+from .hashers import check_secret_hash
 
 from .generators import gen_token
+from .generators import gen_tokens
+from .generators import gen_family_id
 from .generators import gen_client_id
 from .generators import gen_client_secret
 
+
+class RoutingSession(Session):
+    """
+    Session for read only lookups. Queries go to one of the replica engines,
+    which take turns for each read_only_session block, or to the primary
+    engine when there are no replicas or after use_primary.
+    """
+
+    _turns = itertools.count()
+
+    def __init__(self, primary=None, replicas=(), **kwargs):
+        Session.__init__(self, **kwargs)
+        self.primary = primary
+        self.replicas = tuple(replicas)
+        self.target = primary
+        self.use_replica()
+
+    def use_replica(self):
+        """
+        Send the following queries to the next replica, if there are any.
+        """
+
+        if self.replicas:
+            turn = next(self._turns)
+            self.target = self.replicas[turn % len(self.replicas)]
+
+    def use_primary(self):
+        """
+        Send the following queries to the primary. Returns whether they were
+        going to a replica.
+        """
+
+        on_replica = self.target is not self.primary
+        self.target = self.primary
+        return on_replica
+
+    def get_bind(self, mapper=None, clause=None):
+        if self.target is None:
+            return Session.get_bind(self, mapper, clause)
+        return self.target
+
+
 DBSession = scoped_session(sessionmaker(extension=ZopeTransactionExtension()))
+# Session for read only lookups that should not join the request transaction.
+ReadOnlySession = scoped_session(sessionmaker(class_=RoutingSession,
+                                              autoflush=False))
 Base = declarative_base()
 backend = default_backend()
 
 
+def _mark_changed(session):
+    # Statements run through session.execute are invisible to the
+    # transaction manager, which would otherwise skip the commit.
+    if session is DBSession:
+        mark_changed(DBSession())
+
+
 class Oauth2Client(Base):
     __tablename__ = 'oauth2_provider_clients'
     id = Column(Integer, primary_key=True)
@@ -70,32 +147,41 @@ class Oauth2Client(Base):
         return self._client_secret
 
     def _set_client_secret(self, client_secret):
-        if self._salt:
-            salt = b64decode(self._salt.encode('utf-8'))
-        else:
-            try:
-                if not oauth2_settings('salt'):
-                    raise ValueError(
-                        'oauth2_provider.salt configuration required.'
-                    )
-                salt = b64decode(oauth2_settings('salt').encode('utf-8'))
-            except AttributeError:
-                return
-
-        kdf = Scrypt(
-            salt=salt,
-            length=64,
-            n=2 ** 14,
-            r=8,
-            p=1,
-            backend=backend
-        )
+        try:
+            client_secret = bytes(client_secret, 'utf-8')
+        except TypeError:
+            pass
+        replacing = self._client_secret is not None
+        self._client_secret = make_secret_hash(client_secret)
+        if replacing:
+            self._invalidate_caches()
+
+    def _invalidate_caches(self):
+        secret_cache.invalidate(self.client_id)
+        client_cache.invalidate(self.client_id)
+        publish_revocation('client', self.client_id)
+
+    def _get_legacy_salt(self):
+        salt = self._salt or get_oauth2_settings().salt
+        if salt:
+            return b64decode(salt.encode('utf-8'))
+
+    def check_secret(self, client_secret):
+        """
+        Verify client_secret against the stored hash. Hashes made with an
+        older algorithm or cost parameters are rewritten with the configured
+        hasher when the secret matches.
+        """
 
         try:
             client_secret = bytes(client_secret, 'utf-8')
         except TypeError:
             pass
-        self._client_secret = kdf.derive(client_secret)
+        valid, upgrade = check_secret_hash(
+            client_secret, self._client_secret, self._get_legacy_salt())
+        if upgrade:
+            self.client_secret = client_secret
+        return valid
 
     client_secret = synonym('_client_secret', descriptor=property(
         _get_client_secret, _set_client_secret))
@@ -103,13 +189,78 @@ class Oauth2Client(Base):
     def revoke(self):
         self.revoked = True
         self.revocation_date = datetime.utcnow()
+        self._invalidate_caches()
 
     def isRevoked(self):
         return self.revoked
 
+    def snapshot(self):
+        """
+        Return an immutable ClientInfo of this client and its redirect uris.
+        """
+
+        uris = tuple(x.uri for x in self.redirect_uris)
+        return ClientInfo(self.id, self.client_id, bool(self.revoked),
+                          self._client_secret, uris,
+                          tuple(normalize_uri(x) for x in uris))
+
+    def match_redirect_uri(self, redirect_uri=None):
+        """
+        Return the registered redirect uri matching redirect_uri, compared
+        after normalization, or None.
+        """
+
+        return self.snapshot().match_redirect_uri(redirect_uri)
+
+    @classmethod
+    def from_snapshot(cls, info, session=None):
+        """
+        Return the client described by a ClientInfo as a persistent object
+        of session, without querying the database. Its redirect_uris are
+        loaded lazily if they are used.
+        """
+
+        client = cls.__mapper__.class_manager.new_instance()
+        client.id = info.id
+        client.client_id = info.client_id
+        client._client_secret = info.secret_hash
+        client.revoked = info.revoked
+        make_transient_to_detached(client)
+        return (session or DBSession).merge(client, load=False)
+
+
+def _query_client_info(session, client_id):
+    client = session.query(Oauth2Client).options(
+        joinedload(Oauth2Client.redirect_uris)).filter_by(
+            client_id=client_id).first()
+    return client is not None and client.snapshot() or None
+
+def _load_client_info(client_id, session=None):
+    if session is None and ReadOnlySession().replicas:
+        with read_only_session() as session:
+            return lookup_with_fallback(session,
+                lambda x: _query_client_info(x, client_id))
+    return _query_client_info(session or DBSession, client_id)
+
+def lookup_client(client_id, session=None):
+    """
+    Return a ClientInfo snapshot of the client with client_id, or None when
+    there is no such client, through the client cache. A miss loads the
+    client and its redirect uris in one query.
+    """
+
+    if not client_id:
+        return None
+    return client_cache.get(client_id,
+        lambda x: _load_client_info(x, session))
+
 
 class Oauth2RedirectUri(Base):
     __tablename__ = 'oauth2_provider_redirect_uris'
+    __table_args__ = (
+        Index('ix_oauth2_provider_redirect_uris_client_uri',
+              'client_id', 'uri'),
+    )
     id = Column(Integer, primary_key=True)
     uri = Column(Unicode(256), unique=True, nullable=False)
 
@@ -121,17 +272,151 @@ class Oauth2RedirectUri(Base):
         self.uri = uri
 
 
-class Oauth2Code(Base):
+@event.listens_for(Session, 'before_flush')
+def _invalidate_redirect_uri_changes(session, flush_context, instances):
+    """
+    Evict clients whose redirect uris are added, changed or deleted from
+    the client caches of every worker.
+    """
+
+    changed = [x for x in session.new | session.dirty | session.deleted
+               if isinstance(x, Oauth2RedirectUri)]
+    if not changed:
+        return
+    with session.no_autoflush:
+        for client in set(x.client for x in changed):
+            if client is not None:
+                client._invalidate_caches()
+
+
+class ExpiryMixin(object):
+    """
+    Expiry handling shared by tokens and authorization codes. expires_at is
+    kept in step with creation_date and expires_in so that expiry can be
+    checked, and filtered on in the database, without any arithmetic.
+    """
+
+    default_expires_in = None
+
+    @declared_attr
+    def __table_args__(cls):
+        # Indexes for the lookups by client and user and for finding
+        # expired or revoked rows.
+        return (
+            Index('ix_%s_client_user' % cls.__tablename__,
+                  'client_id', 'user_id'),
+            Index('ix_%s_revoked_expires_at' % cls.__tablename__,
+                  'revoked', 'expires_at'),
+        )
+
+    def _init_expiry(self):
+        self.creation_date = datetime.utcnow()
+        self.expires_in = self.default_expires_in
+
+    @validates('creation_date', 'expires_in')
+    def _update_expiry(self, key, value):
+        creation_date = self.creation_date
+        expires_in = self.expires_in
+        if key == 'creation_date':
+            creation_date = value
+        else:
+            expires_in = value
+        if creation_date is not None and expires_in is not None:
+            self.expires_at = creation_date + timedelta(seconds=expires_in)
+        return value
+
+    def getExpiry(self):
+        if self.expires_at is None:
+            # Rows created before expires_at was stored.
+            return self.creation_date + timedelta(seconds=self.expires_in)
+        return self.expires_at
+
+    def isExpired(self, now=None):
+        return self.getExpiry() <= (now or datetime.utcnow())
+
+    def isRevoked(self):
+        """
+        True once revoked or expired. This never modifies the row, expiry
+        is only ever evaluated from expires_at and revoked is set by
+        explicit revocation alone.
+        """
+
+        return bool(self.revoked) or self.isExpired()
+
+    # Columns holding the values that identify a row to the caches.
+    _revocation_columns = ()
+    # Further values written to rows revoked in bulk.
+    _revoked_values = {}
+
+    @classmethod
+    def _bulk_revoked(cls, rows):
+        """
+        Called with the _revocation_columns values of rows revoked in bulk.
+        """
+
+    @classmethod
+    def _revoke_all(cls, criteria, session=None, batch_size=500):
+        session = session or DBSession
+        now = datetime.utcnow()
+        columns = [cls.id] + [getattr(cls, x)
+                              for x in cls._revocation_columns]
+        # The matching rows are read first so that exactly the rows that
+        # are revoked can be evicted from the caches.
+        rows = session.query(*columns).filter(
+            cls.revoked == False, *criteria).all()
+
+        values = dict(cls._revoked_values, revoked=True, revocation_date=now)
+        count = 0
+        for i in range(0, len(rows), batch_size):
+            chunk = rows[i:i + batch_size]
+            count += session.query(cls).filter(
+                cls.id.in_([x[0] for x in chunk]), cls.revoked == False
+                ).update(values, synchronize_session=False)
+            if cls._revocation_columns:
+                cls._bulk_revoked([x[1:] for x in chunk])
+
+        for obj in list(session.identity_map.values()):
+            if isinstance(obj, cls):
+                session.expire(obj, list(values))
+        return count
+
+    @classmethod
+    def revoke_all_for_client(cls, client, session=None, batch_size=500):
+        """
+        Revoke every row of client, batch_size rows per UPDATE. Returns the
+        number of rows revoked.
+        """
+
+        return cls._revoke_all([cls.client_id == client.id], session,
+                               batch_size)
+
+    @classmethod
+    def revoke_all_for_user(cls, user_id, client=None, session=None,
+                            batch_size=500):
+        """
+        Revoke every row of user_id, optionally only those of client.
+        Returns the number of rows revoked.
+        """
+
+        criteria = [cls.user_id == user_id]
+        if client is not None:
+            criteria.append(cls.client_id == client.id)
+        return cls._revoke_all(criteria, session, batch_size)
+
+
+class Oauth2Code(ExpiryMixin, Base):
     __tablename__ = 'oauth2_provider_codes'
     id = Column(Integer, primary_key=True)
     user_id = Column(Integer, nullable=False)
     authcode = Column(Unicode(64), unique=True, nullable=False)
     expires_in = Column(Integer, nullable=False, default=10*60)
+    default_expires_in = 10*60
 
     revoked = Column(Boolean, default=False)
     revocation_date = Column(DateTime)
 
     creation_date = Column(DateTime, default=datetime.utcnow)
+    expires_at = Column(DateTime, index=True)
 
     client_id = Column(Integer, ForeignKey(Oauth2Client.id))
     client = relationship(Oauth2Client, backref=backref('authcode'))
@@ -139,6 +424,7 @@ class Oauth2Code(Base):
     def __init__(self, client, user_id):
         self.client = client
         self.user_id = user_id
+        self._init_expiry()
 
         self.authcode = gen_token(self.client)
 
@@ -146,53 +432,325 @@ class Oauth2Code(Base):
         self.revoked = True
         self.revocation_date = datetime.utcnow()
 
-    def isRevoked(self):
-        expiry = time.mktime(self.create_date.timetuple()) + self.expires_in
-        if datetime.frometimestamp(expiry) < datetime.utcnow():
-            self.revoke()
-        return self.revoked
 
+TOKEN_STORAGE_MODES = ('hashed', 'dual')
+_token_storage = 'hashed'
+
+def configure_token_storage(mode):
+    """
+    Choose how access and refresh tokens are stored. 'hashed' stores only
+    their SHA-256 digests. 'dual' also stores the plaintext tokens and
+    falls back to looking tokens up by plaintext, for databases with rows
+    written before the digests were backfilled and for rolling upgrades
+    from releases that only read the plaintext.
+    """
+
+    global _token_storage
+    if mode not in TOKEN_STORAGE_MODES:
+        raise ValueError('unknown token storage mode: %s' % mode)
+    _token_storage = mode
+
+def get_token_storage():
+    return _token_storage
+
+def hash_token(token):
+    """
+    The SHA-256 digest a token is stored and looked up by.
+    """
+
+    return hashlib.sha256(token.encode('utf-8')).digest()
 
-class Oauth2Token(Base):
+def _family_of(refresh_token):
+    family, sep, secret = refresh_token.partition('.')
+    return sep and family or None
+
+
+class Oauth2Token(ExpiryMixin, Base):
     __tablename__ = 'oauth2_provider_tokens'
     id = Column(Integer, primary_key=True)
     user_id = Column(Integer, nullable=False)
-    access_token = Column(Unicode(64), unique=True, nullable=False)
-    refresh_token = Column(Unicode(64), unique=True, nullable=False)
+    access_token_hash = Column(Binary(32), unique=True, index=True)
+    refresh_token_hash = Column(Binary(32), unique=True, index=True)
+    # Plaintext tokens, only written in dual storage mode.
+    _access_token = Column('access_token', Unicode(64), unique=True)
+    _refresh_token = Column('refresh_token', Unicode(64), unique=True)
+    # Refresh tokens are <refresh_family>.<secret>. The family stays the
+    # same when the tokens of the row are rotated, generation counts the
+    # rotations.
+    refresh_family = Column(Unicode(16), unique=True, index=True)
+    generation = Column(Integer, default=0)
     expires_in = Column(Integer, nullable=False, default=60*60)
+    default_expires_in = 60*60
 
     revoked = Column(Boolean, default=False)
     revocation_date = Column(DateTime)
 
     creation_date = Column(DateTime, default=datetime.utcnow)
+    expires_at = Column(DateTime, index=True)
 
     client_id = Column(Integer, ForeignKey(Oauth2Client.id))
     client = relationship(Oauth2Client, backref=backref('tokens'))
 
+    # Plaintext of tokens issued by this process.
+    _issued = (None, None)
+
     def __init__(self, client, user_id):
         self.client = client
         self.user_id = user_id
+        self._init_expiry()
+
+        self.generation = 0
+        self._set_tokens()
+
+    def _token_values(self):
+        """
+        Generate new tokens for this row. Returns their plaintext and the
+        column values storing them.
+        """
+
+        access_token, secret = gen_tokens(2)
+        family = self.refresh_family or gen_family_id()
+        refresh_token = '%s.%s' % (family, secret)
+        values = {
+            'refresh_family': family,
+            'access_token_hash': hash_token(access_token),
+            'refresh_token_hash': hash_token(refresh_token),
+        }
+        if _token_storage == 'dual':
+            values['_access_token'] = access_token
+            values['_refresh_token'] = refresh_token
+        return (access_token, refresh_token), values
+
+    def _set_tokens(self):
+        self._issued, values = self._token_values()
+        for key, value in values.items():
+            setattr(self, key, value)
+
+    @property
+    def access_token(self):
+        """
+        The access token, only known for tokens issued by this process and
+        rows that store the plaintext.
+        """
+
+        return self._issued[0] or self._access_token
+
+    @property
+    def refresh_token(self):
+        return self._issued[1] or self._refresh_token
+
+    @staticmethod
+    def _digest(token_hash, token):
+        if token_hash is not None:
+            return binascii.hexlify(token_hash).decode('ascii')
+        return token_key(token)
+
+    @property
+    def token_digest(self):
+        """
+        Hex SHA-256 digest of the access token, which identifies the token
+        in the token cache, revocation events and signed tokens.
+        """
+
+        return self._digest(self.access_token_hash, self._access_token)
+
+    @classmethod
+    def _lookup(cls, name, token, query):
+        query = query or DBSession.query(cls)
+        row = query.filter(
+            getattr(cls, name + '_hash') == hash_token(token)).first()
+        if row is None and _token_storage == 'dual':
+            # Rows whose digest has not been backfilled yet.
+            row = query.filter(getattr(cls, '_' + name) == token).first()
+        return row
+
+    @classmethod
+    def lookup_access_token(cls, token, query=None):
+        """
+        Return the row of an access token, or None. query may be given to
+        use another session or add loader options.
+        """
 
-        self.access_token = gen_token(self.client)
-        self.refresh_token = gen_token(self.client)
+        return cls._lookup('access_token', token, query)
+
+    @classmethod
+    def lookup_refresh_token(cls, token, query=None):
+        return cls._lookup('refresh_token', token, query)
+
+    @classmethod
+    def lookup_refresh_family(cls, token, query=None):
+        """
+        Return the row of the family of a refresh token, whether or not
+        token is the current refresh token of the row, or None. Refresh
+        tokens without a family, issued by earlier releases, are looked up
+        as with lookup_refresh_token.
+        """
+
+        family = _family_of(token)
+        if family is None:
+            return cls.lookup_refresh_token(token, query)
+        query = query or DBSession.query(cls)
+        return query.filter(cls.refresh_family == family).first()
+
+    def is_current_refresh_token(self, token):
+        if self.refresh_token_hash is not None:
+            return hmac.compare_digest(self.refresh_token_hash,
+                                       hash_token(token))
+        # Rows whose digest has not been backfilled yet.
+        return (self._refresh_token is not None and
+                hmac.compare_digest(self._refresh_token, token))
+
+    def _compare_and_set(self, session, values):
+        """
+        Write values to this row in a single UPDATE that only matches while
+        the row is not revoked and still holds the refresh token it was
+        loaded with. Returns False, without changing anything, when a
+        concurrent request has used the refresh token or revoked the row
+        since.
+        """
+
+        cls = self.__class__
+        if self.refresh_token_hash is not None:
+            current = cls.refresh_token_hash == self.refresh_token_hash
+        else:
+            # Rows whose digest has not been backfilled yet.
+            current = cls._refresh_token == self._refresh_token
+        count = session.query(cls).filter(
+            cls.id == self.id, cls.revoked == False, current).update(
+                values, synchronize_session=False)
+        if not count:
+            return False
+        for key, value in values.items():
+            set_committed_value(self, key, value)
+        return True
+
+    def rotate(self, session=None):
+        """
+        Replace the access and refresh tokens of this row with new ones,
+        rather than revoking it and inserting a new row as refresh does,
+        so a session keeps a single row however often it is refreshed. The
+        previous access token stops working and the expiry restarts. Revoked
+        rows stay revoked, callers must not rotate them.
+
+        Returns None when a concurrent request has rotated the row first.
+        """
+
+        session = session or DBSession
+        digest = self.token_digest
+        issued, values = self._token_values()
+        now = datetime.utcnow()
+        values.update({
+            'generation': (self.generation or 0) + 1,
+            'creation_date': now,
+            'expires_at': now + timedelta(seconds=self.expires_in),
+        })
+        if not self._compare_and_set(session, values):
+            return None
+
+        self._issued = issued
+        token_cache.revoke_digest(digest)
+        publish_revocation('token', digest)
+        return self
+
+    def revoke_family(self):
+        """
+        Revoke the access token and the refresh token of this row. Used
+        when an earlier refresh token of the family is presented, which
+        means a refresh token has leaked.
+        """
+
+        self.revoke()
+        self.refresh_token_hash = None
+        self._refresh_token = None
 
     def revoke(self):
         self.revoked = True
         self.revocation_date = datetime.utcnow()
+        digest = self.token_digest
+        token_cache.revoke_digest(digest)
+        publish_revocation('token', digest)
+
+    _revocation_columns = ('access_token_hash', '_access_token')
+    # Bulk revoked sessions can not be refreshed, as with revoke_family.
+    _revoked_values = {'refresh_token_hash': None, '_refresh_token': None}
+
+    @classmethod
+    def _bulk_revoked(cls, rows):
+        digests = [cls._digest(*x) for x in rows]
+        for digest in digests:
+            token_cache.revoke_digest(digest)
+        publish_revocations('token', digests)
+
+    @classmethod
+    def issue_bulk(cls, client, user_ids, expires_in=None, session=None,
+                   batch_size=500):
+        """
+        Issue a token to client for every user in user_ids, inserting
+        batch_size rows per statement. Returns the tokens as asJSON would,
+        in the order of user_ids.
+        """
 
-    def isRevoked(self):
-        expiry = time.mktime(self.creation_date.timetuple()) + self.expires_in
-        if datetime.fromtimestamp(expiry) < datetime.utcnow():
-            self.revoke()
-        return self.revoked
-
-    def refresh(self):
+        session = session or DBSession
+        expires_in = expires_in or cls.default_expires_in
+        table = cls.__table__
+        dual = _token_storage == 'dual'
+        issued = []
+        user_ids = list(user_ids)
+        for i in range(0, len(user_ids), batch_size):
+            chunk = user_ids[i:i + batch_size]
+            now = datetime.utcnow()
+            expires_at = now + timedelta(seconds=expires_in)
+            tokens = gen_tokens(len(chunk) * 2)
+            rows = []
+            for user_id, access_token, secret in zip(
+                    chunk, tokens[::2], tokens[1::2]):
+                family = gen_family_id()
+                refresh_token = '%s.%s' % (family, secret)
+                rows.append({
+                    'user_id': user_id,
+                    'access_token_hash': hash_token(access_token),
+                    'refresh_token_hash': hash_token(refresh_token),
+                    'access_token': dual and access_token or None,
+                    'refresh_token': dual and refresh_token or None,
+                    'refresh_family': family,
+                    'generation': 0,
+                    'expires_in': expires_in,
+                    'revoked': False,
+                    'creation_date': now,
+                    'expires_at': expires_at,
+                    'client_id': client.id,
+                })
+                issued.append({
+                    'access_token': access_token,
+                    'refresh_token': refresh_token,
+                    'user_id': user_id,
+                    'expires_in': expires_in,
+                })
+            session.execute(table.insert(), rows)
+            _mark_changed(session)
+        return issued
+
+    def refresh(self, session=None):
         """
-        Generate a new token for this client.
+        Generate a new token for this client. The refresh token of this row
+        is used up and the row revoked. Returns None when a concurrent
+        request has used the refresh token first.
         """
 
+        session = session or DBSession
         cls = self.__class__
-        self.revoke()
+        values = {
+            'revoked': True,
+            'revocation_date': datetime.utcnow(),
+            'refresh_token_hash': None,
+            '_refresh_token': None,
+        }
+        if not self._compare_and_set(session, values):
+            return None
+
+        digest = self.token_digest
+        token_cache.revoke_digest(digest)
+        publish_revocation('token', digest)
         return cls(self.client, self.user_id)
 
     def asJSON(self, **kwargs):
@@ -206,7 +764,68 @@ class Oauth2Token(Base):
         return kwargs
 
 
-def initialize_sql(engine, settings):
+class Oauth2Revocation(Base):
+    """
+    Append only log of revocations, polled by every worker to evict revoked
+    tokens and clients from its caches.
+    """
+
+    __tablename__ = 'oauth2_provider_revocations'
+    id = Column(Integer, primary_key=True)
+    kind = Column(Unicode(16), nullable=False)
+    key = Column(Unicode(64), nullable=False)
+    creation_date = Column(DateTime, default=datetime.utcnow, index=True)
+
+    def __init__(self, kind, key):
+        self.kind = kind
+        self.key = key
+
+
+@contextmanager
+def read_only_session():
+    """
+    Provide a session for lookups that must not write. It runs outside of
+    the request transaction, is never flushed and is always rolled back.
+    Loaded objects are detached, so everything needed from them has to be
+    loaded inside the block.
+    """
+
+    session = ReadOnlySession()
+    session.use_replica()
+    try:
+        if session.get_bind().dialect.name == 'postgresql':
+            session.execute('SET TRANSACTION READ ONLY')
+        yield session
+    finally:
+        session.expunge_all()
+        session.rollback()
+
+
+def lookup_with_fallback(session, lookup):
+    """
+    Return lookup(session). When session reads from a replica and lookup
+    finds nothing it is run again on the primary, so that rows which have
+    not reached the replica yet are still found.
+    """
+
+    result = lookup(session)
+    if (result is None and isinstance(session, RoutingSession) and
+        session.use_primary()):
+        result = lookup(session)
+    return result
+
+
+def initialize_sql(engine, settings, create_tables=True, replicas=()):
+    """
+    Bind the sessions to engine. Read only lookups are spread over the
+    replica engines when given. The tables are created unless
+    create_tables is false, which saves the schema reflection round trips
+    of create_all for databases that are known to be initialized.
+    """
+
     DBSession.configure(bind=engine)
+    ReadOnlySession.remove()
+    ReadOnlySession.configure(primary=engine, replicas=replicas)
     Base.metadata.bind = engine
-    Base.metadata.create_all(engine)
+    if create_tables:
+        Base.metadata.create_all(engine)
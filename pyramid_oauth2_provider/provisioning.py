@@ -0,0 +1,155 @@
+#
+# Copyright (c) Elliot Peele <elliot@bentlogic.net>
+#
+# This program is distributed under the terms of the MIT License as found
+# in a file called LICENSE. If it is not present, the license
+# is always available at http://www.opensource.org/licenses/mit-license.php.
+#
+# This program is distributed in the hope that it will be useful, but
+# without any warrenty; without even the implied warranty of merchantability
+# or fitness for a particular purpose. See the MIT License for full details.
+#
+
+"""
+Creation of many clients at once.
+
+Clients are created in chunks. The secrets of a chunk are hashed in
+parallel, then the clients and their redirect uris are inserted in one
+transaction and the new credentials are written out as JSON lines before
+the next chunk is started, so only one chunk is ever held in memory. A
+failing chunk is rolled back, the chunks before it stay committed and their
+credentials have already been written.
+"""
+
+import csv
+import json
+import time
+import logging
+from itertools import islice
+from collections import namedtuple
+
+from concurrent.futures import ProcessPoolExecutor
+
+from sqlalchemy import select
+
+from .hashers import get_default_hasher
+from .generators import gen_tokens
+from .models import Oauth2Client
+from .models import Oauth2RedirectUri
+
+log = logging.getLogger('pyramid_oauth2_provider.provisioning')
+
+
+class ClientSpec(namedtuple('ClientSpec', 'name redirect_uris')):
+    """
+    Description of a client to create. name is only used to tell the
+    created credentials apart in the output and may be None.
+    """
+    __slots__ = ()
+
+
+def _split_uris(value):
+    if not value:
+        return ()
+    if isinstance(value, (list, tuple)):
+        return tuple(value)
+    return tuple(value.split())
+
+def read_specs(fh, format='jsonl'):
+    """
+    Yield ClientSpecs from a file. JSON lines files hold one object per line
+    with optional name and redirect_uris (a list) members. CSV files have a
+    header row with name and redirect_uris columns, where redirect uris are
+    separated by whitespace.
+    """
+
+    if format == 'csv':
+        rows = csv.DictReader(fh)
+    elif format == 'jsonl':
+        rows = (json.loads(x) for x in fh if x.strip())
+    else:
+        raise ValueError('unknown client spec format: %s' % format)
+
+    for row in rows:
+        yield ClientSpec(row.get('name') or None,
+                         _split_uris(row.get('redirect_uris')))
+
+def count_specs(count):
+    """
+    Yield count ClientSpecs without a name or redirect uris.
+    """
+
+    for i in range(count):
+        yield ClientSpec(None, ())
+
+def _encode(hasher, secret):
+    return hasher.encode(secret)
+
+def _insert_chunk(engine, specs, hashed, credentials):
+    clients = Oauth2Client.__table__
+    uris = Oauth2RedirectUri.__table__
+    client_ids = [x[0] for x in credentials]
+    with engine.begin() as conn:
+        conn.execute(clients.insert(), [
+            {'client_id': client_id, '_client_secret': secret_hash,
+             'revoked': False}
+            for client_id, secret_hash in zip(client_ids, hashed)])
+        uri_rows = [(spec, client_id)
+                    for spec, client_id in zip(specs, client_ids)
+                    if spec.redirect_uris]
+        if uri_rows:
+            ids = dict((y, x) for x, y in conn.execute(
+                select([clients.c.id, clients.c.client_id])
+                .where(clients.c.client_id.in_(
+                    [x[1] for x in uri_rows]))))
+            conn.execute(uris.insert(), [
+                {'client_id': ids[client_id], 'uri': uri}
+                for spec, client_id in uri_rows
+                for uri in spec.redirect_uris])
+
+def provision_clients(engine, specs, output, chunk_size=500, workers=None,
+                      hasher=None):
+    """
+    Create a client for every ClientSpec in specs and write a JSON object
+    with its client_id, client_secret, name and redirect_uris to output,
+    one per line. Secrets are hashed on workers processes, all cores when
+    None, or in this process when 0. Returns the number of clients created.
+    """
+
+    hasher = hasher or get_default_hasher()
+    executor = None
+    if workers == 0:
+        hash_all = lambda secrets: [_encode(hasher, x) for x in secrets]
+    else:
+        executor = ProcessPoolExecutor(max_workers=workers)
+        hash_all = lambda secrets: list(executor.map(_encode,
+            [hasher] * len(secrets), secrets, chunksize=16))
+
+    specs = iter(specs)
+    count = 0
+    started = time.time()
+    try:
+        while True:
+            chunk = list(islice(specs, chunk_size))
+            if not chunk:
+                break
+            tokens = gen_tokens(len(chunk) * 2)
+            credentials = list(zip(tokens[::2], tokens[1::2]))
+            hashed = hash_all([x[1].encode('utf-8') for x in credentials])
+            _insert_chunk(engine, chunk, hashed, credentials)
+
+            for spec, (client_id, client_secret) in zip(chunk, credentials):
+                output.write(json.dumps({
+                    'client_id': client_id,
+                    'client_secret': client_secret,
+                    'name': spec.name,
+                    'redirect_uris': list(spec.redirect_uris),
+                }) + '\n')
+            output.flush()
+            count += len(chunk)
+            log.info('created %d clients in %.3fs'
+                     % (count, time.time() - started))
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    return count
@@ -0,0 +1,145 @@
+#
+# Copyright (c) Elliot Peele <elliot@bentlogic.net>
+#
+# This program is distributed under the terms of the MIT License as found
+# in a file called LICENSE. If it is not present, the license
+# is always available at http://www.opensource.org/licenses/mit-license.php.
+#
+# This program is distributed in the hope that it will be useful, but
+# without any warrenty; without even the implied warranty of merchantability
+# or fitness for a particular purpose. See the MIT License for full details.
+#
+
+"""
+Deletion of expired and revoked tokens, authorization codes and old
+revocation events.
+
+Rows are deleted in id ranges, one short transaction per range, so a purge
+never holds locks for long and can be stopped and restarted at any point.
+A row is purged once it expired, or was revoked, more than the retention
+window ago. Since a refresh token lives in the same row as its access
+token, the retention window is also how long a refresh token stays usable
+after its access token expires.
+"""
+
+import time
+import logging
+import threading
+from datetime import datetime
+from datetime import timedelta
+from collections import namedtuple
+
+from sqlalchemy import or_
+from sqlalchemy import and_
+from sqlalchemy import func
+from sqlalchemy import select
+
+from .models import Oauth2Code
+from .models import Oauth2Token
+from .models import Oauth2Revocation
+
+log = logging.getLogger('pyramid_oauth2_provider.purge')
+
+
+class PurgeBatch(namedtuple('PurgeBatch',
+        'table first_id last_id deleted elapsed')):
+    """
+    Outcome of deleting one id range [first_id, last_id] of table.
+    """
+    __slots__ = ()
+
+
+def _purge_condition(model, cutoff):
+    table = model.__table__
+    if model is Oauth2Revocation:
+        return table.c.creation_date < cutoff
+    return or_(table.c.expires_at < cutoff,
+               and_(table.c.revoked == True,
+                    table.c.revocation_date < cutoff))
+
+def purge_table(engine, model, cutoff, batch_size=1000, start_id=0):
+    """
+    Delete purgeable rows of model with an id of at least start_id,
+    batch_size ids at a time. Yields a PurgeBatch for every range.
+    """
+
+    table = model.__table__
+    with engine.connect() as conn:
+        low, high = conn.execute(
+            select([func.min(table.c.id), func.max(table.c.id)])).first()
+    if low is None:
+        return
+
+    condition = _purge_condition(model, cutoff)
+    first_id = max(low, start_id)
+    while first_id <= high:
+        last_id = first_id + batch_size - 1
+        started = time.time()
+        with engine.begin() as conn:
+            deleted = conn.execute(table.delete().where(and_(
+                table.c.id >= first_id, table.c.id <= last_id,
+                condition))).rowcount
+        batch = PurgeBatch(table.name, first_id, last_id, deleted,
+                           time.time() - started)
+        log.debug('purged %d rows from %s with ids %d-%d in %.3fs' % (
+            batch.deleted, batch.table, first_id, last_id, batch.elapsed))
+        yield batch
+        first_id = last_id + 1
+
+def purge(engine, retention=timedelta(days=30), batch_size=1000, now=None):
+    """
+    Purge tokens, authorization codes and revocation events that are past
+    the retention window. Yields a PurgeBatch for every id range.
+    """
+
+    cutoff = (now or datetime.utcnow()) - retention
+    for model in (Oauth2Token, Oauth2Code, Oauth2Revocation):
+        for batch in purge_table(engine, model, cutoff, batch_size):
+            yield batch
+
+
+class PurgeScheduler(object):
+    """
+    Runs purge in a background thread every interval seconds.
+    """
+
+    def __init__(self, engine, interval, retention=timedelta(days=30),
+                 batch_size=1000):
+        self.engine = engine
+        self.interval = interval
+        self.retention = retention
+        self.batch_size = batch_size
+        self.runs = 0
+        self.deleted = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def run_once(self):
+        started = time.time()
+        deleted = 0
+        for batch in purge(self.engine, self.retention, self.batch_size):
+            deleted += batch.deleted
+        self.runs += 1
+        self.deleted += deleted
+        log.info('purged %d rows in %.3fs' % (deleted, time.time() - started))
+        return deleted
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.run_once()
+            except Exception:
+                log.exception('failed to purge expired tokens')
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run,
+            name='oauth2-purge')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
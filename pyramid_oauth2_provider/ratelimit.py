@@ -0,0 +1,225 @@
+#
+# Copyright (c) Elliot Peele <elliot@bentlogic.net>
+#
+# This program is distributed under the terms of the MIT License as found
+# in a file called LICENSE. If it is not present, the license
+# is always available at http://www.opensource.org/licenses/mit-license.php.
+#
+# This program is distributed in the hope that it will be useful, but
+# without any warrenty; without even the implied warranty of merchantability
+# or fitness for a particular purpose. See the MIT License for full details.
+#
+
+"""
+Request rate limiting for the authorize and token endpoints.
+
+Limits are given per scope, the client_id, the client IP address and, for
+password grants, the username, as a number of requests per period. Each
+scope and value gets its own bucket in a backend. MemoryRateLimitBackend
+keeps token buckets in process. SharedRateLimitBackend keeps sliding window
+counters in a counter store shared by every worker, such as Redis, with
+LocalCounterStore as an in process stand in.
+"""
+
+import time
+import logging
+import threading
+from collections import OrderedDict
+
+from zope.interface import implementer
+
+from .interfaces import IRateLimitBackend
+
+log = logging.getLogger('pyramid_oauth2_provider.ratelimit')
+
+@implementer(IRateLimitBackend)
+class MemoryRateLimitBackend(object):
+    """
+    Token buckets holding up to limit tokens and refilled at limit tokens
+    per period. Each key costs one entry of a bounded LRU, buckets of the
+    least recently seen keys are evicted first, which at worst resets them
+    to full.
+    """
+
+    def __init__(self, max_size=10000, clock=time.time):
+        self.max_size = max_size
+        self.clock = clock
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def hit(self, key, limit, period):
+        rate = float(limit) / period
+        with self._lock:
+            now = self.clock()
+            tokens, last = self._buckets.pop(key, (limit, now))
+            tokens = min(limit, tokens + (now - last) * rate)
+            if tokens >= 1:
+                tokens -= 1
+                retry_after = 0
+            else:
+                retry_after = (1 - tokens) / rate
+            self._buckets[key] = (tokens, now)
+            while len(self._buckets) > self.max_size:
+                self._buckets.popitem(last=False)
+        return retry_after
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+    def __len__(self):
+        return len(self._buckets)
+
+
+class LocalCounterStore(object):
+    """
+    In process counter store with expiring keys, standing in for a shared
+    store in tests and single process deployments. At most max_size
+    counters are kept, the least recently used are evicted first.
+    """
+
+    def __init__(self, max_size=10000, clock=time.time):
+        self.max_size = max_size
+        self.clock = clock
+        self._counters = OrderedDict()
+        self._lock = threading.Lock()
+
+    def incr(self, key, ttl):
+        with self._lock:
+            now = self.clock()
+            expires, value = self._counters.pop(key, (None, 0))
+            if expires is None or expires <= now:
+                expires, value = now + ttl, 0
+            self._counters[key] = (expires, value + 1)
+            while len(self._counters) > self.max_size:
+                self._counters.popitem(last=False)
+            return value + 1
+
+    def get(self, key):
+        with self._lock:
+            expires, value = self._counters.get(key, (None, 0))
+            if expires is None or expires <= self.clock():
+                return 0
+            return value
+
+    def clear(self):
+        with self._lock:
+            self._counters.clear()
+
+    def __len__(self):
+        return len(self._counters)
+
+
+class RedisCounterStore(object):
+    """
+    Counter store on a redis client, or anything offering the same
+    pipeline, incr, expire and get methods.
+    """
+
+    def __init__(self, client, prefix='oauth2_provider:ratelimit:'):
+        self.client = client
+        self.prefix = prefix
+
+    def incr(self, key, ttl):
+        pipe = self.client.pipeline()
+        pipe.incr(self.prefix + key)
+        pipe.expire(self.prefix + key, int(ttl) + 1)
+        return pipe.execute()[0]
+
+    def get(self, key):
+        return int(self.client.get(self.prefix + key) or 0)
+
+
+@implementer(IRateLimitBackend)
+class SharedRateLimitBackend(object):
+    """
+    Sliding window limits on a counter store. Requests are counted in
+    fixed windows of period seconds and the count of the previous window
+    is weighted by how much of it still overlaps the sliding window. Every
+    attempt is counted, so clients that keep retrying stay limited.
+    """
+
+    def __init__(self, store, clock=time.time):
+        self.store = store
+        self.clock = clock
+
+    def hit(self, key, limit, period):
+        now = self.clock()
+        window = int(now // period)
+        elapsed = now - window * period
+        current = self.store.incr('%s:%d' % (key, window), period * 2)
+        previous = self.store.get('%s:%d' % (key, window - 1))
+        if previous * (period - elapsed) / period + current > limit:
+            return period - elapsed
+        return 0
+
+
+class RateLimiter(object):
+    """
+    Applies the limits of each scope to a request. limits maps a scope,
+    'client', 'ip' or 'username', to a tuple of requests and period.
+    """
+
+    scopes = ('client', 'ip', 'username')
+
+    def __init__(self, backend, limits):
+        for scope in limits:
+            if scope not in self.scopes:
+                raise ValueError('unknown rate limit scope: %s' % scope)
+        self.backend = backend
+        self.limits = dict(limits)
+
+    @property
+    def enabled(self):
+        return bool(self.limits)
+
+    def check(self, endpoint, **values):
+        """
+        Count a request to endpoint by the given scope values and return
+        the number of seconds to wait before retrying when it is over a
+        limit, otherwise 0. Scopes with a value of None are skipped.
+        """
+
+        for scope in self.scopes:
+            value = values.get(scope)
+            if not value or scope not in self.limits:
+                continue
+            limit, period = self.limits[scope]
+            retry_after = self.backend.hit(
+                '%s:%s:%s' % (endpoint, scope, value), limit, period)
+            if retry_after:
+                log.info('rate limited %s by %s' % (endpoint, scope))
+                return retry_after
+        return 0
+
+
+_limiter = RateLimiter(MemoryRateLimitBackend(), {})
+
+def configure(limiter):
+    global _limiter
+    _limiter = limiter
+
+def get_limiter():
+    return _limiter
+
+def limiter_from_settings(settings, backend=None):
+    """
+    Build a RateLimiter from parsed Oauth2Settings. backend defaults to
+    the one named by oauth2_provider.ratelimit.backend, memory or shared.
+    """
+
+    limits = {}
+    for scope in RateLimiter.scopes:
+        value = getattr(settings, 'ratelimit_%s' % scope)
+        if value:
+            limits[scope] = value
+    if backend is None:
+        if settings.ratelimit_backend == 'memory':
+            backend = MemoryRateLimitBackend(settings.ratelimit_max_size)
+        elif settings.ratelimit_backend == 'shared':
+            backend = SharedRateLimitBackend(
+                LocalCounterStore(settings.ratelimit_max_size))
+        else:
+            raise ValueError('unknown rate limit backend: %s'
+                             % settings.ratelimit_backend)
+    return RateLimiter(backend, limits)
@@ -0,0 +1,344 @@
+#
+# Copyright (c) Elliot Peele <elliot@bentlogic.net>
+#
+# This program is distributed under the terms of the MIT License as found
+# in a file called LICENSE. If it is not present, the license
+# is always available at http://www.opensource.org/licenses/mit-license.php.
+#
+# This program is distributed in the hope that it will be useful, but
+# without any warrenty; without even the implied warranty of merchantability
+# or fitness for a particular purpose. See the MIT License for full details.
+#
+
+"""
+Propagation of token and client revocations to the caches of every worker.
+
+Revocations are published to a transport when they happen. Each worker runs
+a RevocationListener that polls the transport for new events and applies
+them to its caches in batches.
+"""
+
+import os
+import json
+import time
+import calendar
+import hashlib
+import logging
+import threading
+from datetime import datetime
+from collections import namedtuple
+
+from zope.interface import implementer
+
+from sqlalchemy import select
+
+from pyramid.path import DottedNameResolver
+
+from .interfaces import IRevocationTransport
+from .cache import token_cache
+from .cache import secret_cache
+from .cache import client_cache
+
+log = logging.getLogger('pyramid_oauth2_provider.revocation')
+
+
+class RevocationEvent(namedtuple('RevocationEvent', 'id kind key created')):
+    """
+    A single revocation. Token keys are the hex SHA-256 digest of the access
+    token, client keys are the client_id. created is in seconds since the
+    epoch.
+    """
+    __slots__ = ()
+
+
+def token_key(access_token):
+    return hashlib.sha256(access_token.encode('utf-8')).hexdigest()
+
+
+@implementer(IRevocationTransport)
+class DBRevocationTransport(object):
+    """
+    Stores events in the append only oauth2_provider_revocations table.
+    Events are written through DBSession, so they are only visible once the
+    transaction that revoked the token commits. Polling reads by id on its
+    own connection.
+    """
+
+    def __init__(self, engine):
+        self.engine = engine
+
+    def publish(self, kind, key):
+        from .models import DBSession
+        from .models import Oauth2Revocation
+        DBSession.add(Oauth2Revocation(kind, key))
+
+    def publish_many(self, kind, keys):
+        from .models import DBSession
+        from .models import Oauth2Revocation
+        from .models import _mark_changed
+        if keys:
+            DBSession.execute(Oauth2Revocation.__table__.insert(),
+                              [{'kind': kind, 'key': x} for x in keys])
+            _mark_changed(DBSession)
+
+    def head(self):
+        from .models import Oauth2Revocation
+        table = Oauth2Revocation.__table__
+        with self.engine.connect() as conn:
+            return conn.execute(
+                select([table.c.id]).order_by(table.c.id.desc()).limit(1)
+            ).scalar() or 0
+
+    def since(self, created):
+        from .models import Oauth2Revocation
+        table = Oauth2Revocation.__table__
+        query = select([table.c.id]).where(
+            table.c.creation_date >= datetime.utcfromtimestamp(created))\
+            .order_by(table.c.id).limit(1)
+        with self.engine.connect() as conn:
+            first = conn.execute(query).scalar()
+        if first is None:
+            return self.head()
+        return first - 1
+
+    def poll(self, after, limit):
+        from .models import Oauth2Revocation
+        table = Oauth2Revocation.__table__
+        query = select([table.c.id, table.c.kind, table.c.key,
+                        table.c.creation_date])\
+            .where(table.c.id > after).order_by(table.c.id).limit(limit)
+        with self.engine.connect() as conn:
+            return [RevocationEvent(id, kind, key,
+                        calendar.timegm(created.utctimetuple()))
+                    for id, kind, key, created in conn.execute(query)]
+
+
+@implementer(IRevocationTransport)
+class FileRevocationTransport(object):
+    """
+    Local stand in for a shared transport. Events are appended as JSON lines
+    to a file and the id of an event is the offset just past its line, so
+    ids grow monotonically. Events are published immediately rather than
+    when the transaction commits.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def publish(self, kind, key):
+        # fcntl is POSIX only, importing it here keeps this module usable
+        # on Windows with other transports.
+        import fcntl
+        line = json.dumps({'kind': kind, 'key': key,
+                           'created': time.time()}) + '\n'
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            os.write(fd, line.encode('utf-8'))
+        finally:
+            os.close(fd)
+
+    def head(self):
+        try:
+            return os.path.getsize(self.path)
+        except OSError:
+            return 0
+
+    def since(self, created):
+        offset = 0
+        try:
+            fh = open(self.path, 'rb')
+        except IOError:
+            return offset
+        with fh:
+            for line in fh:
+                if not line.endswith(b'\n'):
+                    break
+                if json.loads(line.decode('utf-8'))['created'] >= created:
+                    break
+                offset += len(line)
+        return offset
+
+    def poll(self, after, limit):
+        events = []
+        try:
+            fh = open(self.path, 'rb')
+        except IOError:
+            return events
+        with fh:
+            fh.seek(after)
+            while len(events) < limit:
+                line = fh.readline()
+                # Stop at a partially written line, it is read again on the
+                # next poll.
+                if not line.endswith(b'\n'):
+                    break
+                data = json.loads(line.decode('utf-8'))
+                events.append(RevocationEvent(fh.tell(), data['kind'],
+                    data['key'], data['created']))
+        return events
+
+
+def transport_from_settings(oauth2_settings, settings, engine):
+    """
+    Build the transport named by oauth2_provider.revocation.transport from
+    parsed Oauth2Settings, or None if it is not set. Factories named by a
+    dotted name are called with the application settings.
+    """
+
+    transport = oauth2_settings.revocation_transport
+    if not transport:
+        return None
+    if transport == 'db':
+        return DBRevocationTransport(engine)
+    if transport == 'file':
+        return FileRevocationTransport(oauth2_settings.revocation_path)
+    return DottedNameResolver().maybe_resolve(transport)(settings)
+
+
+_transport = None
+
+def configure(transport):
+    global _transport
+    _transport = transport
+
+def get_transport():
+    return _transport
+
+def publish_revocation(kind, key):
+    """
+    Publish a revocation to the configured transport, if any.
+    """
+
+    if _transport is not None:
+        _transport.publish(kind, key)
+
+def publish_revocations(kind, keys):
+    """
+    Publish a revocation for each of keys. Transports with a publish_many
+    method get them all in one call.
+    """
+
+    if _transport is None:
+        return
+    publish_many = getattr(_transport, 'publish_many', None)
+    if publish_many is not None:
+        publish_many(kind, keys)
+    else:
+        for key in keys:
+            _transport.publish(kind, key)
+
+def apply_events(events):
+    """
+    Evict the entries named by events from the in process caches.
+    """
+
+    for event in events:
+        if event.kind == 'token':
+            token_cache.revoke_digest(event.key)
+        elif event.kind == 'client':
+            secret_cache.invalidate(event.key)
+            client_cache.invalidate(event.key)
+        else:
+            log.warning('ignoring unknown revocation kind %s' % event.kind)
+
+
+class RevocationListener(object):
+    """
+    Polls a transport and applies new events to the caches of this worker.
+    Propagation lag is the time between an event being created and being
+    applied here.
+
+    A worker starting with empty caches still has to deny signed tokens
+    revoked before it started, so start replays the events of the last
+    replay seconds, which should cover the lifetime of an access token.
+    """
+
+    def __init__(self, transport, interval=1.0, batch_size=500, replay=0):
+        self.transport = transport
+        self.interval = interval
+        self.batch_size = batch_size
+        self.replay = replay
+        self.last_id = None
+        self.applied = 0
+        self.batches = 0
+        self.lag = 0.0
+        self.max_lag = 0.0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def poll_once(self):
+        """
+        Apply every pending event, one batch at a time. Returns the number
+        of events applied.
+        """
+
+        if self.last_id is None:
+            self.last_id = self._first_id()
+
+        count = 0
+        while True:
+            events = self.transport.poll(self.last_id, self.batch_size)
+            if not events:
+                break
+            apply_events(events)
+            now = time.time()
+            self.lag = max(now - events[0].created, 0.0)
+            self.max_lag = max(self.max_lag, self.lag)
+            self.last_id = events[-1].id
+            self.applied += len(events)
+            self.batches += 1
+            count += len(events)
+            if len(events) < self.batch_size:
+                break
+        return count
+
+    def _first_id(self):
+        """
+        The id to poll after on the first poll, the start of the replay
+        window or the current head.
+        """
+
+        if self.replay:
+            since = getattr(self.transport, 'since', None)
+            if since is not None:
+                return since(time.time() - self.replay)
+            log.warning('revocation transport %r cannot replay events, '
+                        'tokens revoked before this worker started are '
+                        'not denied' % self.transport)
+        return self.transport.head()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.poll_once()
+            except Exception:
+                log.exception('failed to poll for revocations')
+            self._stop.wait(self.interval)
+
+    def start(self):
+        # Replay before serving so that earlier revocations are applied.
+        try:
+            self.poll_once()
+        except Exception:
+            log.exception('failed to replay revocations')
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run,
+            name='oauth2-revocation-listener')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def stats(self):
+        return {
+            'last_id': self.last_id,
+            'applied': self.applied,
+            'batches': self.batches,
+            'lag': self.lag,
+            'max_lag': self.max_lag,
+        }
@@ -22,6 +22,11 @@ from pyramid.paster import (
     setup_logging,
     )
 
+from pyramid_oauth2_provider import hashers
+from pyramid_oauth2_provider.util import Oauth2Settings
+from pyramid_oauth2_provider.provisioning import count_specs
+from pyramid_oauth2_provider.provisioning import read_specs
+from pyramid_oauth2_provider.provisioning import provision_clients
 from pyramid_oauth2_provider.models import (
     DBSession,
     initialize_sql,
@@ -36,26 +41,76 @@ def create_client(salt=None):
 
 def usage(argv):
     cmd = os.path.basename(argv[0])
-    print(('usage: %s <config_uri> <section>\n'
-          '(example: "%s development.ini myproject")' % (cmd, cmd)))
+    print(('usage: %s <config_uri> <section> [options]\n'
+          '(example: "%s development.ini myproject")\n\n'
+          'Creates one client, or many with --count or --specs.\n\n'
+          'options:\n'
+          '  --count N          create N clients\n'
+          '  --specs FILE       create a client per line of a .jsonl or\n'
+          '                     .csv file of names and redirect_uris\n'
+          '  --output FILE      write credentials as JSON lines to FILE\n'
+          '                     instead of stdout\n'
+          '  --chunk-size N     clients per transaction (default 500)\n'
+          '  --workers N        hashing processes (default: all cores)'
+          % (cmd, cmd)))
     sys.exit(1)
 
+def parse_options(argv):
+    options = {}
+    args = []
+    argv = list(argv)
+    while argv:
+        arg = argv.pop(0)
+        if arg.startswith('--'):
+            if arg not in ('--count', '--specs', '--output', '--chunk-size',
+                           '--workers') or not argv:
+                return None, None
+            options[arg[2:].replace('-', '_')] = argv.pop(0)
+        else:
+            args.append(arg)
+    return args, options
+
+def create_clients(engine, options):
+    if 'specs' in options:
+        path = options['specs']
+        fh = open(path)
+        specs = read_specs(fh, path.endswith('.csv') and 'csv' or 'jsonl')
+    else:
+        fh = None
+        specs = count_specs(int(options['count']))
+
+    output = sys.stdout
+    if 'output' in options:
+        output = open(options['output'], 'w')
+    try:
+        workers = options.get('workers')
+        return provision_clients(engine, specs, output,
+            chunk_size=int(options.get('chunk_size', 500)),
+            workers=int(workers) if workers is not None else None)
+    finally:
+        if fh is not None:
+            fh.close()
+        if output is not sys.stdout:
+            output.close()
+
 def main(argv=sys.argv):
-    if len(argv) != 3:
+    args, options = parse_options(argv)
+    if args is None or len(args) != 3:
         usage(argv)
-    config_uri = argv[1]
-    section = argv[2]
+    config_uri = args[1]
+    section = args[2]
     setup_logging(config_uri)
     settings = get_appsettings(config_uri, section)
     engine = engine_from_config(settings, 'sqlalchemy.')
-    try:
-        salt = settings['oauth2_provider.salt']
-    except KeyError:
-        raise ValueError(
-            'oauth2_provider.salt configuration required.'
-        )
+    oauth2_settings = Oauth2Settings.from_settings(settings)
+    salt = oauth2_settings.salt
+    hashers.configure_from_settings(oauth2_settings)
     initialize_sql(engine, settings)
 
+    if 'count' in options or 'specs' in options:
+        create_clients(engine, options)
+        return
+
     with transaction.manager:
         id, secret = create_client(salt=salt)
         print('client_id:', id)
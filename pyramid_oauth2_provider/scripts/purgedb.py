@@ -0,0 +1,49 @@
+#
+# Copyright (c) Elliot Peele <elliot@bentlogic.net>
+#
+# This program is distributed under the terms of the MIT License as found
+# in a file called LICENSE. If it is not present, the license
+# is always available at http://www.opensource.org/licenses/mit-license.php.
+#
+# This program is distributed in the hope that it will be useful, but
+# without any warrenty; without even the implied warranty of merchantability
+# or fitness for a particular purpose. See the MIT License for full details.
+#
+
+import os
+import sys
+import time
+from datetime import timedelta
+
+from sqlalchemy import engine_from_config
+
+from pyramid.paster import (
+    get_appsettings,
+    setup_logging,
+    )
+
+from ..purge import purge
+
+def usage(argv):
+    cmd = os.path.basename(argv[0])
+    print(('usage: %s <config_uri> [retention_days] [batch_size]\n'
+          '(example: "%s development.ini 30 1000")' % (cmd, cmd)))
+    sys.exit(1)
+
+def main(argv=sys.argv):
+    if len(argv) < 2 or len(argv) > 4:
+        usage(argv)
+    config_uri = argv[1]
+    retention = timedelta(days=int(argv[2]) if len(argv) > 2 else 30)
+    batch_size = int(argv[3]) if len(argv) > 3 else 1000
+    setup_logging(config_uri)
+    settings = get_appsettings(config_uri)
+    engine = engine_from_config(settings, 'sqlalchemy.')
+
+    started = time.time()
+    total = 0
+    for batch in purge(engine, retention, batch_size):
+        total += batch.deleted
+        print('%s ids %d-%d: deleted %d rows in %.3fs' % (batch.table,
+            batch.first_id, batch.last_id, batch.deleted, batch.elapsed))
+    print('deleted %d rows in %.3fs' % (total, time.time() - started))
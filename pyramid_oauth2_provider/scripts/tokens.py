@@ -0,0 +1,102 @@
+#
+# Copyright (c) Elliot Peele <elliot@bentlogic.net>
+#
+# This program is distributed under the terms of the MIT License as found
+# in a file called LICENSE. If it is not present, the license
+# is always available at http://www.opensource.org/licenses/mit-license.php.
+#
+# This program is distributed in the hope that it will be useful, but
+# without any warrenty; without even the implied warranty of merchantability
+# or fitness for a particular purpose. See the MIT License for full details.
+#
+
+import os
+import sys
+import json
+from itertools import islice
+
+import transaction
+
+from sqlalchemy import engine_from_config
+
+from pyramid.paster import (
+    get_appsettings,
+    setup_logging,
+    )
+
+from .. import revocation
+from ..admin import issue_tokens
+from ..admin import revoke_all_for_user
+from ..admin import revoke_all_for_client
+from ..models import DBSession
+from ..models import Oauth2Client
+from ..models import initialize_sql
+from ..models import configure_token_storage
+from ..util import Oauth2Settings
+
+def usage(argv):
+    cmd = os.path.basename(argv[0])
+    print(('usage: %s <config_uri> revoke-client <client_id>\n'
+           '       %s <config_uri> revoke-user <user_id> [client_id]\n'
+           '       %s <config_uri> issue <client_id> [user_id_file]\n'
+           '(example: "%s development.ini revoke-user 1234")\n\n'
+           'issue reads user ids, one per line, from user_id_file or stdin\n'
+           'and writes the tokens as JSON lines to stdout.'
+           % (cmd, cmd, cmd, cmd)))
+    sys.exit(1)
+
+def get_client(client_id):
+    client = DBSession.query(Oauth2Client).filter_by(
+        client_id=client_id).first()
+    if client is None:
+        print('unknown client_id: %s' % client_id)
+        sys.exit(1)
+    return client
+
+def issue(client_id, fh, chunk_size=500):
+    user_ids = (int(x) for x in fh if x.strip())
+    count = 0
+    while True:
+        chunk = list(islice(user_ids, chunk_size))
+        if not chunk:
+            break
+        with transaction.manager:
+            tokens = issue_tokens(get_client(client_id), chunk)
+        for token in tokens:
+            sys.stdout.write(json.dumps(token) + '\n')
+        sys.stdout.flush()
+        count += len(tokens)
+    return count
+
+def main(argv=sys.argv):
+    if len(argv) < 4 or len(argv) > 5:
+        usage(argv)
+    config_uri = argv[1]
+    command = argv[2]
+    setup_logging(config_uri)
+    settings = get_appsettings(config_uri)
+    engine = engine_from_config(settings, 'sqlalchemy.')
+    initialize_sql(engine, settings)
+    # Revocations made here have to reach the caches of running workers.
+    oauth2_settings = Oauth2Settings.from_settings(settings)
+    configure_token_storage(oauth2_settings.token_storage)
+    revocation.configure(revocation.transport_from_settings(
+        oauth2_settings, settings, engine))
+
+    if command == 'revoke-client' and len(argv) == 4:
+        with transaction.manager:
+            counts = revoke_all_for_client(get_client(argv[3]))
+    elif command == 'revoke-user':
+        with transaction.manager:
+            client = len(argv) == 5 and get_client(argv[4]) or None
+            counts = revoke_all_for_user(int(argv[3]), client)
+    elif command == 'issue':
+        if len(argv) == 5:
+            with open(argv[4]) as fh:
+                issue(argv[3], fh)
+        else:
+            issue(argv[3], sys.stdin)
+        return
+    else:
+        usage(argv)
+    print('revoked %(tokens)d tokens and %(codes)d codes' % counts)
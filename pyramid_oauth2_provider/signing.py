@@ -0,0 +1,166 @@
+#
+# Copyright (c) Elliot Peele <elliot@bentlogic.net>
+#
+# This program is distributed under the terms of the MIT License as found
+# in a file called LICENSE. If it is not present, the license
+# is always available at http://www.opensource.org/licenses/mit-license.php.
+#
+# This program is distributed in the hope that it will be useful, but
+# without any warrenty; without even the implied warranty of merchantability
+# or fitness for a particular purpose. See the MIT License for full details.
+#
+
+"""
+Self contained, signed access tokens.
+
+Signed tokens use the JWT compact serialization and carry the user_id
+(sub), the client_id, the issue and expiry times and a jti that is the hex
+SHA-256 digest of the opaque access token of the Oauth2Token row. The
+row remains the anchor for refreshing and revoking the token.
+
+Each key has a key id that is put in the token header, so new keys can be
+rolled out while tokens signed with older keys still verify.
+"""
+
+import hmac
+import json
+import time
+import hashlib
+import logging
+from base64 import b64decode
+from base64 import urlsafe_b64encode
+from base64 import urlsafe_b64decode
+
+from cryptography.exceptions import InvalidSignature
+from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey
+
+log = logging.getLogger('pyramid_oauth2_provider.signing')
+
+
+class InvalidSignedToken(ValueError):
+    """
+    Raised for signed tokens that are malformed, have a bad signature or
+    have expired.
+    """
+
+
+def _b64encode(data):
+    return urlsafe_b64encode(data).rstrip(b'=')
+
+def _b64decode(data):
+    return urlsafe_b64decode(data + b'=' * (-len(data) % 4))
+
+def looks_signed(token):
+    return token.count('.') == 2
+
+
+class TokenSigner(object):
+    """
+    Signs and verifies access tokens with HS256 (HMAC-SHA256) or EdDSA
+    (Ed25519). keys maps key ids to raw key bytes, which for EdDSA are the
+    32 byte private keys. New tokens are signed with the key named by kid.
+    """
+
+    algorithms = ('HS256', 'EdDSA')
+
+    def __init__(self, keys, kid, algorithm='HS256'):
+        if algorithm not in self.algorithms:
+            raise ValueError('unsupported signing algorithm: %s' % algorithm)
+        if kid not in keys:
+            raise ValueError('signing key %s is not configured' % kid)
+        self.algorithm = algorithm
+        self.kid = kid
+        if algorithm == 'EdDSA':
+            self.keys = dict((k, Ed25519PrivateKey.from_private_bytes(v))
+                             for k, v in keys.items())
+            self.public_keys = dict((k, v.public_key())
+                                    for k, v in self.keys.items())
+        else:
+            self.keys = dict(keys)
+        self._header = _b64encode(json.dumps(
+            {'alg': algorithm, 'typ': 'JWT', 'kid': kid},
+            sort_keys=True, separators=(',', ':')).encode('utf-8'))
+
+    def _sign(self, kid, signing_input):
+        if self.algorithm == 'EdDSA':
+            return self.keys[kid].sign(signing_input)
+        return hmac.new(self.keys[kid], signing_input, hashlib.sha256).digest()
+
+    def _verify(self, kid, signing_input, signature):
+        if self.algorithm == 'EdDSA':
+            try:
+                self.public_keys[kid].verify(signature, signing_input)
+            except InvalidSignature:
+                return False
+            return True
+        return hmac.compare_digest(self._sign(kid, signing_input), signature)
+
+    def sign(self, claims):
+        payload = _b64encode(json.dumps(
+            claims, sort_keys=True, separators=(',', ':')).encode('utf-8'))
+        signing_input = self._header + b'.' + payload
+        return (signing_input + b'.' +
+                _b64encode(self._sign(self.kid, signing_input))
+                ).decode('ascii')
+
+    def sign_token(self, auth_token, now=None):
+        """
+        Make a signed access token for an Oauth2Token row.
+        """
+
+        now = int(now or time.time())
+        return self.sign({
+            'sub': auth_token.user_id,
+            'client_id': auth_token.client.client_id,
+            'iat': now,
+            'exp': now + auth_token.expires_in,
+            'jti': auth_token.token_digest,
+        })
+
+    def verify(self, token, now=None):
+        """
+        Return the claims of a valid, unexpired token.
+        """
+
+        try:
+            header, payload, signature = token.encode('ascii').split(b'.')
+            headers = json.loads(_b64decode(header).decode('utf-8'))
+            kid = headers.get('kid')
+            if headers.get('alg') != self.algorithm or kid not in self.keys:
+                raise InvalidSignedToken('unknown signing key')
+            if not self._verify(kid, header + b'.' + payload,
+                                _b64decode(signature)):
+                raise InvalidSignedToken('bad signature')
+            claims = json.loads(_b64decode(payload).decode('utf-8'))
+        except (ValueError, TypeError, UnicodeError):
+            raise InvalidSignedToken('malformed token')
+
+        if claims.get('exp', 0) <= (now or time.time()):
+            raise InvalidSignedToken('token has expired')
+        return claims
+
+
+_signer = None
+
+def configure(signer):
+    global _signer
+    _signer = signer
+
+def get_signer():
+    return _signer
+
+def signer_from_settings(settings):
+    """
+    Build a TokenSigner from parsed Oauth2Settings when token_format is
+    'signed'. Keys are given as whitespace separated kid:base64key entries
+    in oauth2_provider.signing.keys.
+    """
+
+    if settings.token_format != 'signed':
+        return None
+
+    keys = {}
+    for entry in settings.signing_keys.split():
+        kid, key = entry.split(':', 1)
+        keys[kid] = b64decode(key.encode('utf-8'))
+    return TokenSigner(keys, settings.signing_kid, settings.signing_algorithm)
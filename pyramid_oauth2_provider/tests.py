@@ -10,29 +10,90 @@
 # or fitness for a particular purpose. See the MIT License for full details.
 #
 
+import os
+import time
 import base64
+import json
+import asyncio
+import shutil
+import tempfile
 import unittest
+import threading
 import transaction
+from datetime import datetime
+from datetime import timedelta
+from six import StringIO
 from six.moves.urllib.parse import urlparse
 from six.moves.urllib.parse import parse_qsl
 
+from sqlalchemy import event
+from sqlalchemy import inspect
 from sqlalchemy import create_engine
 
 from zope.interface import implementer
+from zope.sqlalchemy import mark_changed
 
 from pyramid import testing
+from webob import Request
+from webob.multidict import MultiDict
 from pyramid.response import Response
+from pyramid.authorization import ACLAuthorizationPolicy
+from pyramid.httpexceptions import HTTPBadRequest
+from pyramid.httpexceptions import HTTPUnauthorized
+from pyramid.exceptions import ConfigurationError
 
 from . import jsonerrors
 from .views import oauth2_token
 from .views import oauth2_authorize
 from .models import DBSession
+from .models import ReadOnlySession
 from .models import Oauth2Token
 from .models import Oauth2Client
 from .models import Oauth2Code
 from .models import Oauth2RedirectUri
 from .models import initialize_sql
+from .models import lookup_client
+from .models import hash_token
+from .models import configure_token_storage
 from .interfaces import IAuthCheck
+from .cache import TTLCache
+from .cache import DenyList
+from .cache import TokenCache
+from .cache import secret_cache
+from .cache import token_cache
+from .cache import client_cache
+from .cache import TokenInfo
+from .authentication import OauthAuthenticationPolicy
+from .authentication import lookup_token_info
+from .async_validation import OauthMiddleware
+from .async_validation import AsyncTokenValidator
+from .kdf import KDFPool
+from .kdf import KDFPoolSaturated
+from .kdf import kdf_pool
+from .throttle import FailureCounter
+from .throttle import client_failures
+from .dedup import RequestDeduplicator
+from .dedup import request_dedup
+from . import hashers
+from . import revocation
+from . import signing
+from . import migrations
+from . import purge
+from . import generators
+from . import provisioning
+from . import admin
+from . import ratelimit
+from .errors import InvalidToken
+from .errors import InvalidRequest
+from .models import Oauth2Revocation
+from .util import asduration
+from .util import asrate
+from .util import aschoice
+from .util import get_credentials
+from .util import parse_authorization
+from .util import getClientCredentials
+from .util import Oauth2Settings
+from .util import oauth2_settings
 
 _auth_value = None
 
@@ -51,13 +112,27 @@ class TestCase(unittest.TestCase):
             settings = {'oauth2_provider.salt': 'r+H5LT6EvgSSKFMZ2brdzQ=='})
         self.config.registry.registerUtility(AuthCheck, IAuthCheck)
 
-        engine = create_engine('sqlite://')
-        initialize_sql(engine, self.config)
+        self.engine = create_engine('sqlite://')
+        initialize_sql(self.engine, self.config)
+        # includeme disables the caches without a revocation transport.
+        secret_cache.configure(ttl=300)
+        token_cache.configure(ttl=60)
+        client_cache.configure(ttl=300, negative_ttl=30)
+        secret_cache.clear()
+        token_cache.clear()
+        client_cache.clear()
+        client_failures.configure(max_failures=20, window=60)
+        configure_token_storage('hashed')
+        self.queries = []
+        event.listen(self.engine, 'before_cursor_execute', self._count_query)
 
         self.auth = 1
 
         self.redirect_uri = 'http://localhost'
 
+    def _count_query(self, conn, cursor, statement, *args):
+        self.queries.append(statement)
+
     def _get_auth(self):
         global _auth_value
         return _auth_value
@@ -80,6 +155,7 @@ class TestCase(unittest.TestCase):
 
     def tearDown(self):
         DBSession.remove()
+        ReadOnlySession.remove()
         testing.tearDown()
 
     def getAuthHeader(self, username, password, scheme='Basic'):
@@ -118,6 +194,7 @@ class TestAuthorizeEndpoint(TestCase):
 
         request = testing.DummyRequest(params=data)
         request.scheme = 'https'
+        request.client_addr = '192.0.2.1'
 
         return request
 
@@ -166,6 +243,19 @@ class TestAuthorizeEndpoint(TestCase):
         response = self._process_view()
         self.assertTrue(isinstance(response, jsonerrors.HTTPBadRequest))
 
+    def testRateLimitIp(self):
+        ratelimit.configure(ratelimit.RateLimiter(
+            ratelimit.MemoryRateLimitBackend(), {'ip': (1, 10)}))
+        try:
+            self._validate_authcode_response(self._process_view())
+            self.request = self._create_request()
+            response = self._process_view()
+        finally:
+            ratelimit.configure(ratelimit.RateLimiter(
+                ratelimit.MemoryRateLimitBackend(), {}))
+        self.assertTrue(isinstance(response, jsonerrors.HTTPTooManyRequests))
+        self.assertEqual(response.headers['Retry-After'], '10')
+
     def testDisableSchemeCheck(self):
         self.request.scheme = 'http'
         self.config.get_settings()['oauth2_provider.require_ssl'] = False
@@ -230,6 +320,37 @@ class TestAuthorizeEndpoint(TestCase):
         self.assertTrue('state' in params)
         self.assertEqual(state_value, params['state'])
 
+    def _process_view_counting(self):
+        DBSession.remove()
+        del self.queries[:]
+        response = self._process_view()
+        return response, [x for x in self.queries
+                          if not x.startswith('INSERT')]
+
+    def testSingleQuery(self):
+        with transaction.manager:
+            DBSession.add(Oauth2RedirectUri(self.client, 'https://other/cb'))
+        self.request.params['redirect_uri'] = self.redirect_uri
+        response, queries = self._process_view_counting()
+        self._validate_authcode_response(response)
+        self.assertEqual(len(queries), 1)
+
+    def testSingleQueryRejected(self):
+        self.request.params['redirect_uri'] = 'https://evil/cb'
+        response, queries = self._process_view_counting()
+        self.assertTrue(isinstance(response, jsonerrors.HTTPBadRequest))
+        self.assertEqual(len(queries), 1)
+
+    def testRedirectUriNormalized(self):
+        self.request.params['redirect_uri'] = 'HTTP://LocalHost:80/'
+        response = self._process_view()
+        self._validate_authcode_response(response)
+
+    def testRedirectUriMismatch(self):
+        self.request.params['redirect_uri'] = self.redirect_uri + '/other'
+        response = self._process_view()
+        self.assertTrue(isinstance(response, jsonerrors.HTTPBadRequest))
+
 class TestTokenEndpoint(TestCase):
     def setUp(self):
         TestCase.setUp(self)
@@ -265,6 +386,7 @@ class TestTokenEndpoint(TestCase):
 
         request = testing.DummyRequest(post=data, headers=headers)
         request.scheme = 'https'
+        request.client_addr = '192.0.2.1'
 
         return request
 
@@ -281,6 +403,7 @@ class TestTokenEndpoint(TestCase):
 
         request = testing.DummyRequest(post=data, headers=headers)
         request.scheme = 'https'
+        request.client_addr = '192.0.2.1'
 
         return request
 
@@ -294,17 +417,22 @@ class TestTokenEndpoint(TestCase):
         self.assertEqual(token.get('user_id'), self.auth)
         self.assertEqual(token.get('expires_in'), 3600)
         self.assertEqual(token.get('token_type'), 'bearer')
-        self.assertEqual(len(token.get('access_token')), 64)
-        self.assertEqual(len(token.get('refresh_token')), 64)
+        self.assertEqual(len(token.get('access_token')), 43)
+        self.assertEqual(len(token.get('refresh_token')), 60)
         self.assertEqual(len(token), 5)
 
-        dbtoken = DBSession.query(Oauth2Token).filter_by(
-            access_token=token.get('access_token')).first()
+        dbtoken = Oauth2Token.lookup_access_token(
+            token.get('access_token'))
 
         self.assertEqual(dbtoken.user_id, token.get('user_id'))
         self.assertEqual(dbtoken.expires_in, token.get('expires_in'))
-        self.assertEqual(dbtoken.access_token, token.get('access_token'))
-        self.assertEqual(dbtoken.refresh_token, token.get('refresh_token'))
+        self.assertEqual(dbtoken.access_token_hash,
+                         hash_token(token.get('access_token')))
+        self.assertEqual(dbtoken.refresh_token_hash,
+                         hash_token(token.get('refresh_token')))
+        # Only the digests are stored.
+        self.assertEqual(dbtoken.access_token, None)
+        self.assertEqual(dbtoken.refresh_token, None)
 
     def testTokenRequest(self):
         self.auth = 500
@@ -327,6 +455,21 @@ class TestTokenEndpoint(TestCase):
         token = self._process_view()
         self._validate_token(token)
 
+    def testSettingsParsedOnce(self):
+        from_settings = Oauth2Settings.from_settings
+        calls = []
+        def counting(settings):
+            calls.append(settings)
+            return from_settings(settings)
+        Oauth2Settings.from_settings = staticmethod(counting)
+        try:
+            for _ in range(3):
+                self._validate_token(self._process_view())
+                self.request = self._create_request()
+        finally:
+            Oauth2Settings.from_settings = from_settings
+        self.assertEqual(len(calls), 1)
+
     def testNoClientCreds(self):
         self.request.headers = {}
         token = self._process_view()
@@ -373,6 +516,116 @@ class TestTokenEndpoint(TestCase):
         token = self._process_view()
         self._validate_token(token)
 
+    def _refresh(self, token):
+        self.request = self._create_refresh_token_request(
+            token.get('refresh_token'), token.get('user_id'))
+        return self._process_view()
+
+    def testRefreshInPlace(self):
+        first = token = self._process_view()
+        for i in range(10):
+            token = self._refresh(token)
+            self._validate_token(token)
+        # One row per session, however often it is refreshed.
+        self.assertEqual(DBSession.query(Oauth2Token).count(), 1)
+        dbtoken = Oauth2Token.lookup_access_token(token['access_token'])
+        self.assertEqual(dbtoken.generation, 10)
+        self.assertEqual(token['refresh_token'].split('.')[0],
+                         first['refresh_token'].split('.')[0])
+        self.assertEqual(
+            Oauth2Token.lookup_access_token(first['access_token']), None)
+        self.assertTrue(token_cache.is_revoked_digest(
+            revocation.token_key(first['access_token'])))
+
+    def testRefreshReuseRevokesFamily(self):
+        first = self._process_view()
+        second = self._refresh(first)
+        self._validate_token(second)
+
+        token = self._refresh(first)
+        self.assertTrue(isinstance(token, jsonerrors.HTTPUnauthorized))
+        # The current tokens of the family are revoked as well.
+        token = self._refresh(second)
+        self.assertTrue(isinstance(token, jsonerrors.HTTPUnauthorized))
+        dbtoken = Oauth2Token.lookup_access_token(second['access_token'])
+        self.assertTrue(dbtoken.isRevoked())
+        self.assertEqual(DBSession.query(Oauth2Token).count(), 1)
+
+    def testRefreshRevoked(self):
+        token = self._process_view()
+        with transaction.manager:
+            Oauth2Token.lookup_access_token(token['access_token']).revoke()
+        resp = self._refresh(token)
+        self.assertTrue(isinstance(resp, jsonerrors.HTTPUnauthorized))
+        self.assertEqual(resp.detail['error'], 'invalid_grant')
+        dbtoken = DBSession.query(Oauth2Token).one()
+        self.assertTrue(dbtoken.revoked)
+        self.assertEqual(dbtoken.generation, 0)
+
+    def testRotateLosesToRevocation(self):
+        token = self._process_view()
+        for method in ('rotate', 'refresh'):
+            with transaction.manager:
+                dbtoken = DBSession.query(Oauth2Token).one()
+                # Revoked by another request after the row was loaded.
+                DBSession.query(Oauth2Token).update(
+                    {'revoked': True}, synchronize_session=False)
+                self.assertEqual(getattr(dbtoken, method)(), None)
+                DBSession.query(Oauth2Token).update(
+                    {'revoked': False}, synchronize_session=False)
+        dbtoken = DBSession.query(Oauth2Token).one()
+        self.assertEqual(dbtoken.generation, 0)
+        self.assertEqual(dbtoken.refresh_token_hash,
+                         hash_token(token['refresh_token']))
+
+    def testRefreshAfterBulkRevocation(self):
+        revokers = [
+            lambda: Oauth2Token.revoke_all_for_client(
+                DBSession.query(Oauth2Client).one()),
+            lambda: Oauth2Token.revoke_all_for_user(self.auth),
+        ]
+        for revoke in revokers:
+            self.request = self._create_request()
+            token = self._process_view()
+            with transaction.manager:
+                self.assertEqual(revoke(), 1)
+            dbtoken = Oauth2Token.lookup_access_token(token['access_token'])
+            self.assertEqual(dbtoken.refresh_token_hash, None)
+            self.assertTrue(isinstance(self._refresh(token),
+                                       jsonerrors.HTTPUnauthorized))
+
+    def testRefreshUnknownFamily(self):
+        token = self._process_view()
+        family, secret = token['refresh_token'].split('.')
+        token['refresh_token'] = 'x' * len(family) + '.' + secret
+        self.assertTrue(isinstance(self._refresh(token),
+                                   jsonerrors.HTTPUnauthorized))
+
+    def testRefreshLegacyToken(self):
+        token = self._process_view()
+        with transaction.manager:
+            dbtoken = Oauth2Token.lookup_access_token(token['access_token'])
+            dbtoken.refresh_family = None
+            dbtoken.generation = None
+            dbtoken.refresh_token_hash = hash_token('legacy')
+        token['refresh_token'] = 'legacy'
+        token = self._refresh(token)
+        self._validate_token(token)
+        dbtoken = Oauth2Token.lookup_access_token(token['access_token'])
+        self.assertEqual(dbtoken.generation, 1)
+        self.assertTrue(token['refresh_token'].startswith(
+            dbtoken.refresh_family + '.'))
+
+    def testRefreshNewRow(self):
+        self.config.get_settings()['oauth2_provider.refresh_rotation'] = \
+            'new_row'
+        self.config.registry.oauth2_provider_settings = None
+        token = self._process_view()
+        for i in range(3):
+            token = self._refresh(token)
+            self._validate_token(token)
+        self.assertEqual(DBSession.query(Oauth2Token).count(), 4)
+
     def testMissingRefreshToken(self):
         token = self._process_view()
         self._validate_token(token)
@@ -421,8 +674,8 @@ class TestTokenEndpoint(TestCase):
         token = self._process_view()
         self._validate_token(token)
 
-        dbtoken = DBSession.query(Oauth2Token).filter_by(
-            access_token=token.get('access_token')).first()
+        dbtoken = Oauth2Token.lookup_access_token(
+            token.get('access_token'))
         dbtoken.revoke()
 
         self.request = self._create_refresh_token_request(
@@ -434,8 +687,8 @@ class TestTokenEndpoint(TestCase):
         token = self._process_view()
         self._validate_token(token)
 
-        dbtoken = DBSession.query(Oauth2Token).filter_by(
-            access_token=token.get('access_token')).first()
+        dbtoken = Oauth2Token.lookup_access_token(
+            token.get('access_token'))
         dbtoken.expires_in = 0
 
         self.assertEqual(dbtoken.isRevoked(), True)
@@ -444,8 +697,2396 @@ class TestTokenEndpoint(TestCase):
         token = self._process_view()
         self._validate_token(token)
 
-        dbtoken = DBSession.query(Oauth2Token).filter_by(
-            access_token=token.get('access_token')).first()
+        dbtoken = Oauth2Token.lookup_access_token(
+            token.get('access_token'))
         dbtoken.expires_in = 10
 
         self.assertEqual(dbtoken.isRevoked(), False)
+
+    def testSecretCacheHit(self):
+        self._process_view()
+        self.assertEqual(secret_cache.stats()['misses'], 1)
+        self.assertEqual(len(secret_cache), 1)
+
+        self.request = self._create_request()
+        token = self._process_view()
+        self._validate_token(token)
+        self.assertEqual(secret_cache.hits, 1)
+
+    def testClientCacheNoQueries(self):
+        self._validate_token(self._process_view())
+        DBSession.remove()
+        del self.queries[:]
+        self.request = self._create_request()
+        token = self._process_view()
+        self.assertEqual([x for x in self.queries
+                          if x.startswith('SELECT')], [])
+        self._validate_token(token)
+
+    def testSecretCacheNoPlaintext(self):
+        self._process_view()
+        for key, (expires, value) in secret_cache._cache._data.items():
+            self.assertFalse(self.client_secret.encode('utf-8') in value[0])
+            self.assertFalse(self.client_secret.encode('utf-8') in value[1])
+
+    def testSecretCacheBadSecret(self):
+        self._process_view()
+        self.request.headers = self.getAuthHeader(
+            self.client.client_id, 'abcde')
+        token = self._process_view()
+        self.assertTrue(isinstance(token, jsonerrors.HTTPBadRequest))
+        self.assertEqual(secret_cache.hits, 0)
+
+    def testSecretCacheInvalidatedByNewSecret(self):
+        self._process_view()
+        self.assertEqual(len(secret_cache), 1)
+        with transaction.manager:
+            client = DBSession.query(Oauth2Client).filter_by(
+                client_id=self.client.client_id).first()
+            client.new_client_secret()
+        self.assertEqual(len(secret_cache), 0)
+
+        self.request = self._create_request()
+        token = self._process_view()
+        self.assertTrue(isinstance(token, jsonerrors.HTTPBadRequest))
+
+    def testSecretCacheInvalidatedByRevoke(self):
+        self._process_view()
+        self.assertEqual(len(secret_cache), 1)
+        with transaction.manager:
+            client = DBSession.query(Oauth2Client).filter_by(
+                client_id=self.client.client_id).first()
+            client.revoke()
+        self.assertEqual(len(secret_cache), 0)
+
+    def testSignedTokenRequest(self):
+        signer = signing.TokenSigner({'a': b'k' * 32}, 'a')
+        signing.configure(signer)
+        try:
+            token = self._process_view()
+            claims = signer.verify(token['access_token'])
+            self.assertEqual(claims['sub'], self.auth)
+            self.assertEqual(claims['client_id'], self.client.client_id)
+            self.assertEqual(claims['exp'] - claims['iat'], 3600)
+
+            self.request = self._create_refresh_token_request(
+                token.get('refresh_token'), token.get('user_id'))
+            token = self._process_view()
+            self.assertTrue(signing.looks_signed(token['access_token']))
+        finally:
+            signing.configure(None)
+
+    def testKDFPoolSaturated(self):
+        kdf_pool.pending = kdf_pool.workers + kdf_pool.max_queue
+        try:
+            token = self._process_view()
+        finally:
+            kdf_pool.pending = 0
+        self.assertTrue(isinstance(token, jsonerrors.HTTPServiceUnavailable))
+        self.assertEqual(token.headers.get('Retry-After'), '1')
+        self.assertEqual(token.detail['error'], 'temporarily_unavailable')
+
+    def testKDFPoolStats(self):
+        kdf_pool.reset_stats()
+        self._process_view()
+        stats = kdf_pool.stats()
+        self.assertEqual(stats['completed'], 1)
+        self.assertEqual(stats['pending'], 0)
+        self.assertTrue(stats['avg_kdf_time'] > 0)
+
+    def _set_credentials(self, client_id, client_secret):
+        self.request = self._create_request()
+        self.request.headers = self.getAuthHeader(client_id, client_secret)
+
+    def testMalformedAuthHeader(self):
+        for header in ('Basic !!!notbase64', 'Basic', 'Basic Zm9v',
+                       'Basic \u00e9t\u00e9'):
+            self.request = self._create_request()
+            self.request.headers = {'Authorization': header}
+            token = self._process_view()
+            self.assertTrue(isinstance(token, jsonerrors.HTTPUnauthorized))
+
+    def testSecretWithColon(self):
+        with transaction.manager:
+            DBSession.query(Oauth2Client).filter_by(
+                client_id=self.client.client_id).one().client_secret = 'a:b:c'
+        self._set_credentials(self.client.client_id, 'a:b:c')
+        self._validate_token(self._process_view())
+
+    def testUnknownClientDummyVerify(self):
+        kdf_pool.reset_stats()
+        self._set_credentials('unknown', self.client_secret)
+        token = self._process_view()
+        self.assertTrue(isinstance(token, jsonerrors.HTTPBadRequest))
+        self.assertEqual(token.detail['error_description'],
+                         'Invalid client credentials')
+        # The same key derivation work as for a known client.
+        self.assertEqual(kdf_pool.stats()['completed'], 1)
+
+    def testRevokedClientSkipsKDF(self):
+        with transaction.manager:
+            DBSession.query(Oauth2Client).filter_by(
+                client_id=self.client.client_id).one().revoke()
+        kdf_pool.reset_stats()
+        self._set_credentials(self.client.client_id, self.client_secret)
+        token = self._process_view()
+        self.assertTrue(isinstance(token, jsonerrors.HTTPBadRequest))
+        self.assertEqual(kdf_pool.stats()['completed'], 0)
+
+    def testThrottleFailedAttempts(self):
+        client_failures.configure(max_failures=3, window=60)
+        for i in range(3):
+            self._set_credentials(self.client.client_id, 'wrong')
+            token = self._process_view()
+            self.assertTrue(isinstance(token, jsonerrors.HTTPBadRequest))
+
+        # Even the right secret is rejected, without running the KDF.
+        kdf_pool.reset_stats()
+        self._set_credentials(self.client.client_id, self.client_secret)
+        token = self._process_view()
+        self.assertTrue(isinstance(token, jsonerrors.HTTPTooManyRequests))
+        self.assertEqual(token.status_int, 429)
+        self.assertTrue(0 < int(token.headers['Retry-After']) <= 60)
+        self.assertEqual(kdf_pool.stats()['completed'], 0)
+
+    def testThrottlePerAddress(self):
+        client_failures.configure(max_failures=2, window=60)
+        for i in range(2):
+            self._set_credentials(self.client.client_id, 'wrong')
+            self.request.client_addr = '198.51.100.7'
+            self._process_view()
+
+        # The client itself, from its own address, is not locked out.
+        self._set_credentials(self.client.client_id, self.client_secret)
+        self._validate_token(self._process_view())
+        self._set_credentials(self.client.client_id, self.client_secret)
+        self.request.client_addr = '198.51.100.7'
+        token = self._process_view()
+        self.assertTrue(isinstance(token, jsonerrors.HTTPTooManyRequests))
+
+    def testThrottleResetOnSuccess(self):
+        client_failures.configure(max_failures=2, window=60)
+        self._set_credentials(self.client.client_id, 'wrong')
+        self._process_view()
+        self._set_credentials(self.client.client_id, self.client_secret)
+        self._validate_token(self._process_view())
+        self._set_credentials(self.client.client_id, 'wrong')
+        token = self._process_view()
+        self.assertTrue(isinstance(token, jsonerrors.HTTPBadRequest))
+
+
+    def testRateLimitClient(self):
+        ratelimit.configure(ratelimit.RateLimiter(
+            ratelimit.MemoryRateLimitBackend(), {'client': (2, 60)}))
+        try:
+            for i in range(2):
+                self.request = self._create_request()
+                self._validate_token(self._process_view())
+            kdf_pool.reset_stats()
+            self.request = self._create_request()
+            token = self._process_view()
+        finally:
+            ratelimit.configure(ratelimit.RateLimiter(
+                ratelimit.MemoryRateLimitBackend(), {}))
+        self.assertTrue(isinstance(token, jsonerrors.HTTPTooManyRequests))
+        self.assertEqual(token.detail['error'], 'temporarily_unavailable')
+        self.assertEqual(token.headers['Retry-After'], '30')
+        self.assertEqual(kdf_pool.stats()['completed'], 0)
+
+    def testRateLimitClientAfterAuthentication(self):
+        ratelimit.configure(ratelimit.RateLimiter(
+            ratelimit.MemoryRateLimitBackend(), {'client': (2, 60)}))
+        try:
+            # Requests with a wrong secret do not use up the client limit.
+            for i in range(3):
+                self._set_credentials(self.client.client_id, 'wrong')
+                token = self._process_view()
+                self.assertTrue(isinstance(token, jsonerrors.HTTPBadRequest))
+            self.request = self._create_request()
+            self._validate_token(self._process_view())
+        finally:
+            ratelimit.configure(ratelimit.RateLimiter(
+                ratelimit.MemoryRateLimitBackend(), {}))
+
+    def testRateLimitUsername(self):
+        ratelimit.configure(ratelimit.RateLimiter(
+            ratelimit.MemoryRateLimitBackend(), {'username': (1, 60)}))
+        try:
+            self._validate_token(self._process_view())
+            self.request = self._create_request()
+            self.request.POST['username'] = 'jane'
+            self._validate_token(self._process_view())
+            self.request = self._create_request()
+            token = self._process_view()
+        finally:
+            ratelimit.configure(ratelimit.RateLimiter(
+                ratelimit.MemoryRateLimitBackend(), {}))
+        self.assertTrue(isinstance(token, jsonerrors.HTTPTooManyRequests))
+
+class TestFailureCounter(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        self.counter = FailureCounter(max_failures=2, window=10,
+                                      clock=lambda: self.now)
+
+    def testBlocksUntilWindowEnds(self):
+        self.assertEqual(self.counter.failed('a'), 1)
+        self.assertEqual(self.counter.blocked('a'), 0)
+        self.now += 4
+        self.assertEqual(self.counter.failed('a'), 2)
+        self.assertEqual(self.counter.blocked('a'), 6)
+        self.assertEqual(self.counter.blocked('b'), 0)
+        self.now += 6
+        self.assertEqual(self.counter.blocked('a'), 0)
+        self.assertEqual(self.counter.failed('a'), 1)
+
+    def testReset(self):
+        self.counter.failed('a')
+        self.counter.failed('a')
+        self.counter.reset('a')
+        self.assertEqual(self.counter.blocked('a'), 0)
+
+    def testDisabled(self):
+        self.counter.configure(max_failures=0)
+        for i in range(5):
+            self.assertEqual(self.counter.failed('a'), 0)
+        self.assertEqual(self.counter.blocked('a'), 0)
+
+class TestKDFPool(unittest.TestCase):
+    salt = b'0123456789abcdef'
+
+    def testProcessExecutor(self):
+        pool = KDFPool(executor='process', workers=1)
+        hasher = hashers.get_hasher('scrypt')
+        try:
+            encoded = pool.run(hasher.encode, b'secret')
+            self.assertTrue(pool.run(hasher.verify, b'secret', encoded))
+            self.assertFalse(pool.run(hasher.verify, b'other', encoded))
+        finally:
+            pool.configure()
+
+    def testInlineExecutor(self):
+        pool = KDFPool(executor='inline')
+        self.assertEqual(pool.run(len, 'abc'), 3)
+        self.assertEqual(pool.stats()['completed'], 1)
+
+    def testQueueLimit(self):
+        pool = KDFPool(workers=1, max_queue=1)
+        pool.pending = 2
+        self.assertRaises(KDFPoolSaturated, pool.run, len, 'abc')
+        self.assertEqual(pool.stats()['rejected'], 1)
+
+    def testUnknownExecutor(self):
+        self.assertRaises(ValueError, KDFPool, executor='foo')
+
+
+class TestHashers(TestCase):
+    def tearDown(self):
+        hashers.configure()
+        TestCase.tearDown(self)
+
+    def _create_client(self):
+        with transaction.manager:
+            client = Oauth2Client()
+            client_secret = client.new_client_secret()
+            DBSession.add(client)
+            client_id = client.client_id
+        return client_id, client_secret
+
+    def _get_client(self, client_id):
+        return DBSession.query(Oauth2Client).filter_by(
+            client_id=client_id).first()
+
+    def testRoundTrip(self):
+        for algorithm in hashers.available_hashers():
+            hasher = hashers.get_hasher(algorithm)
+            encoded = hasher.encode(b'secret')
+            self.assertTrue(encoded.startswith(
+                algorithm.encode('ascii') + b'$'))
+            self.assertTrue(hasher.verify(b'secret', encoded))
+            self.assertFalse(hasher.verify(b'wrong', encoded))
+            self.assertFalse(hasher.needs_upgrade(encoded))
+
+    def testPerRowSalt(self):
+        hasher = hashers.get_hasher('scrypt')
+        self.assertNotEqual(hasher.encode(b'secret'), hasher.encode(b'secret'))
+
+    def testParamsStored(self):
+        hasher = hashers.get_hasher('scrypt', n=2 ** 10)
+        encoded = hasher.encode(b'secret')
+        self.assertTrue(b'n=1024' in encoded)
+        self.assertTrue(hashers.get_hasher('scrypt').verify(b'secret', encoded))
+        self.assertTrue(hashers.get_hasher('scrypt').needs_upgrade(encoded))
+
+    def testUnknownHasher(self):
+        self.assertRaises(ValueError, hashers.configure, 'foo')
+        self.assertRaises(ValueError, hashers.configure, 'scrypt', foo=1)
+
+    def testUpgradeOnVerify(self):
+        hashers.configure('scrypt', n=2 ** 10)
+        client_id, client_secret = self._create_client()
+        self.assertTrue(b'n=1024' in self._get_client(client_id).client_secret)
+
+        hashers.configure('hmac_sha256')
+        with transaction.manager:
+            client = self._get_client(client_id)
+            self.assertFalse(client.check_secret('wrong'))
+            self.assertTrue(client.client_secret.startswith(b'scrypt$'))
+            self.assertTrue(client.check_secret(client_secret))
+        client = self._get_client(client_id)
+        self.assertTrue(client.client_secret.startswith(b'hmac_sha256$'))
+        self.assertTrue(client.check_secret(client_secret))
+
+    def testLegacyHash(self):
+        from base64 import b64decode
+        from cryptography.hazmat.primitives.kdf.scrypt import Scrypt
+        salt = b64decode(self.config.get_settings()['oauth2_provider.salt'])
+        legacy = Scrypt(salt=salt, length=64, n=2 ** 14, r=8, p=1,
+                        backend=None).derive(b'secret')
+        client_id, client_secret = self._create_client()
+        with transaction.manager:
+            self._get_client(client_id)._client_secret = legacy
+        with transaction.manager:
+            client = self._get_client(client_id)
+            self.assertFalse(client.check_secret('wrong'))
+            self.assertEqual(client.client_secret, legacy)
+            self.assertTrue(client.check_secret('secret'))
+        client = self._get_client(client_id)
+        self.assertTrue(client.client_secret.startswith(b'scrypt$'))
+
+    def testLegacyHashRequiresSalt(self):
+        self.assertRaises(ValueError, hashers.identify_hasher, b'x' * 64)
+
+
+class TokenTestCase(TestCase):
+    def setUp(self):
+        TestCase.setUp(self)
+        self.policy = OauthAuthenticationPolicy()
+        with transaction.manager:
+            client = Oauth2Client()
+            DBSession.add(client)
+            token = Oauth2Token(client, 42)
+            DBSession.add(token)
+            DBSession.flush()
+            self.access_token = token.access_token
+
+    def _create_request(self, access_token=None):
+        token = base64.b64encode(
+            (access_token or self.access_token).encode('utf8'))
+        return testing.DummyRequest(headers={
+            'Authorization': 'Bearer %s' % token.decode('utf8')})
+
+    def _get_token(self):
+        return Oauth2Token.lookup_access_token(self.access_token)
+
+
+class TestTokenStorage(TokenTestCase):
+    def tearDown(self):
+        configure_token_storage('hashed')
+        TokenTestCase.tearDown(self)
+
+    def _insert_legacy(self, access_token):
+        # A row written before its digest was backfilled.
+        with transaction.manager:
+            client = DBSession.query(Oauth2Client).first()
+            DBSession.execute(Oauth2Token.__table__.insert(), [{
+                'user_id': 7, 'access_token': access_token,
+                'refresh_token': access_token + 'r', 'expires_in': 3600,
+                'revoked': False, 'creation_date': datetime.utcnow(),
+                'expires_at': datetime.utcnow() + timedelta(hours=1),
+                'client_id': client.id}])
+            mark_changed(DBSession())
+
+    def testHashedAtRest(self):
+        row = self.engine.execute(
+            'SELECT access_token, refresh_token, access_token_hash '
+            'FROM oauth2_provider_tokens').fetchone()
+        self.assertEqual(row[:2], (None, None))
+        self.assertEqual(len(row[2]), 32)
+        self.assertEqual(row[2], hash_token(self.access_token))
+
+    def testLookupByDigest(self):
+        del self.queries[:]
+        self.assertEqual(self._get_token().user_id, 42)
+        self.assertEqual(len(self.queries), 1)
+        self.assertTrue('access_token_hash' in self.queries[0])
+        self.assertEqual(Oauth2Token.lookup_access_token('unknown'), None)
+
+    def testDualStorage(self):
+        configure_token_storage('dual')
+        with transaction.manager:
+            client = DBSession.query(Oauth2Client).first()
+            token = Oauth2Token(client, 43)
+            DBSession.add(token)
+            access_token = token.access_token
+        row = self.engine.execute(
+            'SELECT access_token, access_token_hash FROM '
+            'oauth2_provider_tokens WHERE user_id = 43').fetchone()
+        self.assertEqual(row[0], access_token)
+        self.assertEqual(row[1], hash_token(access_token))
+
+    def testDualRead(self):
+        self._insert_legacy('legacy')
+        self.assertEqual(Oauth2Token.lookup_access_token('legacy'), None)
+
+        configure_token_storage('dual')
+        token = Oauth2Token.lookup_access_token('legacy')
+        self.assertEqual(token.user_id, 7)
+        self.assertEqual(token.token_digest, revocation.token_key('legacy'))
+        self.assertEqual(
+            self.policy.unauthenticated_userid(self._create_request('legacy')),
+            7)
+
+    def testClearPlaintext(self):
+        configure_token_storage('dual')
+        with transaction.manager:
+            client = DBSession.query(Oauth2Client).first()
+            token = Oauth2Token(client, 43)
+            DBSession.add(token)
+            access_token = token.access_token
+        self.assertEqual(migrations.clear_plaintext_tokens(self.engine), 1)
+        configure_token_storage('hashed')
+        token = Oauth2Token.lookup_access_token(access_token)
+        self.assertEqual(token.user_id, 43)
+        self.assertEqual(token.access_token, None)
+
+    def testRevokeLegacyInBulk(self):
+        self._insert_legacy('legacy')
+        configure_token_storage('dual')
+        with transaction.manager:
+            client = DBSession.query(Oauth2Client).first()
+            self.assertEqual(
+                admin.revoke_all_for_client(client)['tokens'], 2)
+        self.assertTrue(token_cache.is_revoked_digest(
+            revocation.token_key('legacy')))
+        self.assertTrue(token_cache.is_revoked_digest(
+            revocation.token_key(self.access_token)))
+
+    def testUnknownStorage(self):
+        self.assertRaises(ValueError, configure_token_storage, 'plain')
+
+
+class TestAuthenticationPolicy(TokenTestCase):
+    def testUserId(self):
+        request = self._create_request()
+        self.assertEqual(self.policy.unauthenticated_userid(request), 42)
+
+    def testRequestMemo(self):
+        request = self._create_request()
+        del self.queries[:]
+        for i in range(3):
+            self.policy.unauthenticated_userid(request)
+        self.assertEqual(len(self.queries), 1)
+
+    def testMalformedBearer(self):
+        request = testing.DummyRequest(headers={
+            'Authorization': 'Bearer not/base64!'})
+        self.assertRaises(HTTPBadRequest,
+                          self.policy.unauthenticated_userid, request)
+
+    def testCrossRequestCache(self):
+        self.policy.unauthenticated_userid(self._create_request())
+        del self.queries[:]
+        self.assertEqual(
+            self.policy.unauthenticated_userid(self._create_request()), 42)
+        self.assertEqual(len(self.queries), 0)
+        self.assertEqual(token_cache.stats()['size'], 1)
+        self.assertEqual(token_cache.stats()['hit_ratio'], 0.5)
+
+    def testCacheHoldsDigest(self):
+        self.policy.unauthenticated_userid(self._create_request())
+        key = list(token_cache._cache._data)[0]
+        self.assertNotEqual(key, self.access_token)
+        self.assertEqual(len(key), 32)
+
+    def testNeverServedPastExpiry(self):
+        self.policy.unauthenticated_userid(self._create_request())
+        info = token_cache.get(self.access_token)
+        token_cache.add(self.access_token, info._replace(expires_at=1))
+        self.assertEqual(token_cache.get(self.access_token), None)
+
+    def testRevokedDuringLookup(self):
+        info = lookup_token_info(self.access_token)
+        # The revocation reaches this worker before the lookup is cached.
+        token_cache.revoke_digest(revocation.token_key(self.access_token))
+        token_cache.add(self.access_token, info)
+        self.assertEqual(len(token_cache), 0)
+        self.assertEqual(token_cache.get(self.access_token), None)
+
+    def testShortLivedToken(self):
+        with transaction.manager:
+            self._get_token().expires_in = 0
+        self.assertRaises(HTTPUnauthorized,
+            self.policy.unauthenticated_userid, self._create_request())
+        self.assertEqual(len(token_cache), 0)
+
+    def testRevokeEvicts(self):
+        self.policy.unauthenticated_userid(self._create_request())
+        with transaction.manager:
+            self._get_token().revoke()
+        self.assertEqual(len(token_cache), 0)
+        self.assertRaises(HTTPUnauthorized,
+            self.policy.unauthenticated_userid, self._create_request())
+
+    def testExpiredTokenNotWritten(self):
+        with transaction.manager:
+            self._get_token().expires_in = 0
+        del self.queries[:]
+        self.assertRaises(HTTPUnauthorized,
+            self.policy.unauthenticated_userid, self._create_request())
+        self.assertEqual([x for x in self.queries
+                          if not x.startswith('SELECT')], [])
+        self.assertFalse(self._get_token().revoked)
+
+    def testForgetEvicts(self):
+        request = self._create_request()
+        self.policy.unauthenticated_userid(request)
+        with transaction.manager:
+            self.policy.forget(request)
+        self.assertEqual(len(token_cache), 0)
+        self.assertRaises(HTTPUnauthorized,
+            self.policy.unauthenticated_userid, request)
+
+    def testUnknownToken(self):
+        self.assertRaises(HTTPBadRequest,
+            self.policy.unauthenticated_userid, self._create_request('abcd'))
+
+
+class TestExpiry(TokenTestCase):
+    def testExpiresAt(self):
+        token = self._get_token()
+        self.assertEqual((token.expires_at - token.creation_date).seconds,
+                         3600)
+        token.expires_in = 10
+        self.assertEqual((token.expires_at - token.creation_date).seconds,
+                         10)
+
+    def testIsRevokedReadOnly(self):
+        with transaction.manager:
+            self._get_token().expires_in = 0
+        token = self._get_token()
+        self.assertTrue(token.isRevoked())
+        self.assertFalse(token.revoked)
+        self.assertFalse(DBSession.dirty)
+
+    def testLegacyRowWithoutExpiresAt(self):
+        with transaction.manager:
+            DBSession.query(Oauth2Token).update({'expires_at': None})
+        token = self._get_token()
+        self.assertFalse(token.isRevoked())
+        self.assertEqual(self.policy.unauthenticated_userid(
+            self._create_request()), 42)
+
+    def testCodeExpiry(self):
+        with transaction.manager:
+            client = DBSession.query(Oauth2Client).first()
+            code = Oauth2Code(client, 42)
+            DBSession.add(code)
+            self.assertFalse(code.isRevoked())
+            code.expires_in = 0
+            self.assertTrue(code.isRevoked())
+            # Expiry is not revocation.
+            self.assertFalse(code.revoked)
+
+
+class TestPurge(TokenTestCase):
+    def setUp(self):
+        TokenTestCase.setUp(self)
+        old = datetime.utcnow() - timedelta(days=60)
+        with transaction.manager:
+            client = DBSession.query(Oauth2Client).first()
+            for i in range(4):
+                token = Oauth2Token(client, i)
+                token.creation_date = old
+                DBSession.add(token)
+            for i in range(2):
+                token = Oauth2Token(client, i)
+                token.revoke()
+                token.revocation_date = old
+                DBSession.add(token)
+            # Recently revoked tokens are kept for the retention window.
+            token = Oauth2Token(client, 10)
+            token.revoke()
+            DBSession.add(token)
+            code = Oauth2Code(client, 1)
+            code.creation_date = old
+            DBSession.add(code)
+            DBSession.add(Oauth2Revocation('token', 'abc'))
+
+    def testPurge(self):
+        batches = list(purge.purge(self.engine, timedelta(days=30),
+                                   batch_size=3))
+        tokens = [x for x in batches if x.table == 'oauth2_provider_tokens']
+        self.assertEqual(len(tokens), 3)
+        self.assertEqual(sum(x.deleted for x in tokens), 6)
+        self.assertEqual(DBSession.query(Oauth2Token).count(), 2)
+        self.assertEqual(DBSession.query(Oauth2Code).count(), 0)
+        self.assertEqual(DBSession.query(Oauth2Revocation).count(), 1)
+
+    def testResume(self):
+        cutoff = datetime.utcnow() - timedelta(days=30)
+        batches = list(purge.purge_table(self.engine, Oauth2Token, cutoff,
+                                         batch_size=2, start_id=4))
+        self.assertEqual(batches[0].first_id, 4)
+        # Ids 2 and 3 are before the resume point and are kept.
+        self.assertEqual(DBSession.query(Oauth2Token).filter(
+            Oauth2Token.id < 4).count(), 3)
+        self.assertEqual(DBSession.query(Oauth2Token).count(), 4)
+
+    def testScheduler(self):
+        scheduler = purge.PurgeScheduler(self.engine, 60)
+        self.assertEqual(scheduler.run_once(), 7)
+        self.assertEqual(scheduler.run_once(), 0)
+        self.assertEqual(scheduler.deleted, 7)
+
+
+class TestRequestDeduplicator(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        self.dedup = RequestDeduplicator(window=5, clock=lambda: self.now)
+        self.calls = []
+
+    def _func(self, response):
+        def func():
+            self.calls.append(response)
+            return response
+        return func
+
+    def testKey(self):
+        key = self.dedup.key('client', {'a': '1', 'b': '2'})
+        self.assertEqual(key, self.dedup.key('client', [('b', '2'),
+                                                         ('a', '1')]))
+        self.assertNotEqual(key, self.dedup.key('other', {'a': '1',
+                                                          'b': '2'}))
+        self.assertNotEqual(key, self.dedup.key('client', {'a': '1'}))
+        self.assertNotEqual(key, RequestDeduplicator().key(
+            'client', {'a': '1', 'b': '2'}))
+
+    def testDuplicate(self):
+        key = self.dedup.key('client', {'a': '1'})
+        with transaction.manager:
+            first = self.dedup.run(key, self._func({'token': 1}))
+        with transaction.manager:
+            second = self.dedup.run(key, self._func({'token': 2}))
+        self.assertEqual(first, {'token': 1})
+        self.assertEqual(second, {'token': 1})
+        self.assertEqual(len(self.calls), 1)
+
+        self.now += 6
+        with transaction.manager:
+            third = self.dedup.run(key, self._func({'token': 3}))
+        self.assertEqual(third, {'token': 3})
+
+    def testDisabled(self):
+        dedup = RequestDeduplicator()
+        self.assertFalse(dedup.enabled)
+        key = dedup.key('client', {'a': '1'})
+        for i in range(2):
+            with transaction.manager:
+                dedup.run(key, self._func({'token': i}))
+        self.assertEqual(len(self.calls), 2)
+
+    def testErrorsNotShared(self):
+        key = self.dedup.key('client', {'a': '1'})
+        error = HTTPUnauthorized()
+        with transaction.manager:
+            self.assertTrue(self.dedup.run(key, self._func(error)) is error)
+        def fail():
+            raise ValueError('failed')
+        with transaction.manager:
+            self.assertRaises(ValueError, self.dedup.run, key, fail)
+        with transaction.manager:
+            response = self.dedup.run(key, self._func({'token': 1}))
+        self.assertEqual(response, {'token': 1})
+        self.assertEqual(self.dedup._pending, {})
+
+    def testAbortNotShared(self):
+        key = self.dedup.key('client', {'a': '1'})
+        txn = transaction.begin()
+        self.dedup.run(key, self._func({'token': 1}))
+        self.assertEqual(len(self.dedup._pending), 1)
+        txn.abort()
+        self.assertEqual(self.dedup._pending, {})
+        with transaction.manager:
+            response = self.dedup.run(key, self._func({'token': 2}))
+        self.assertEqual(response, {'token': 2})
+
+    def testUnfinishedNotWaitedOn(self):
+        dedup = RequestDeduplicator(window=0.05)
+        key = dedup.key('client', {'a': '1'})
+        request = testing.DummyRequest()
+        txn = transaction.begin()
+        try:
+            dedup.run(key, self._func({'token': 1}), request=request)
+            # The request ends without its transaction committing.
+            request._process_finished_callbacks()
+            self.assertEqual(dedup._pending, {})
+
+            dedup.run(key, self._func({'token': 2}))
+            # An identical request stops waiting after the window and
+            # later ones no longer wait at all.
+            self.assertEqual(dedup.run(key, self._func({'token': 3})),
+                             {'token': 3})
+            self.assertEqual(dedup._pending, {})
+            started = time.time()
+            self.assertEqual(dedup.run(key, self._func({'token': 4})),
+                             {'token': 4})
+            self.assertTrue(time.time() - started < 0.05)
+        finally:
+            txn.abort()
+
+    def testWaitsForPending(self):
+        key = self.dedup.key('client', {'a': '1'})
+        started = threading.Event()
+        release = threading.Event()
+        responses = []
+        def slow():
+            started.set()
+            release.wait(5)
+            return {'token': 1}
+        def first():
+            with transaction.manager:
+                responses.append(self.dedup.run(key, slow))
+        def second():
+            with transaction.manager:
+                responses.append(self.dedup.run(key,
+                                                self._func({'token': 2})))
+        threads = [threading.Thread(target=first),
+                   threading.Thread(target=second)]
+        threads[0].start()
+        started.wait(5)
+        threads[1].start()
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(responses, [{'token': 1}, {'token': 1}])
+        self.assertEqual(self.calls, [])
+
+
+class TestConcurrentGrants(TestCase):
+    """
+    Identical token requests racing on separate threads, each with its own
+    session and transaction, against a database file.
+    """
+
+    threads = 8
+
+    def setUp(self):
+        TestCase.setUp(self)
+        self.tmpdir = tempfile.mkdtemp()
+        self.engine = self._create_engine(
+            os.path.join(self.tmpdir, 'oauth2.db'))
+        initialize_sql(self.engine, self.config)
+        with transaction.manager:
+            client = Oauth2Client()
+            self.client_secret = client.new_client_secret()
+            DBSession.add(client)
+            self.client_id = client.client_id
+        self.auth = 1
+
+    def tearDown(self):
+        request_dedup.configure(window=0)
+        TestCase.tearDown(self)
+        self.engine.dispose()
+        shutil.rmtree(self.tmpdir)
+
+    def _create_engine(self, path):
+        return create_engine('sqlite:///%s' % path)
+
+    def _request(self, **data):
+        request = testing.DummyRequest(post=data, headers=self.getAuthHeader(
+            self.client_id, self.client_secret))
+        request.scheme = 'https'
+        request.client_addr = '192.0.2.1'
+        request.registry = self.config.registry
+        return request
+
+    def _password(self):
+        return dict(grant_type='password', username='john', password='foo')
+
+    def _refresh(self, token):
+        return dict(grant_type='refresh_token',
+                    refresh_token=token['refresh_token'],
+                    user_id=str(token['user_id']))
+
+    def _grant(self, data):
+        try:
+            with transaction.manager:
+                return oauth2_token(self._request(**data))
+        finally:
+            DBSession.remove()
+
+    def _race(self, data):
+        barrier = threading.Barrier(self.threads)
+        results = []
+        def run():
+            barrier.wait()
+            results.append(self._grant(data))
+        threads = [threading.Thread(target=run) for i in range(self.threads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(results), self.threads)
+        granted = [x for x in results if isinstance(x, dict)]
+        for result in results:
+            if not isinstance(result, dict):
+                self.assertTrue(isinstance(result,
+                                           jsonerrors.HTTPUnauthorized))
+        return granted
+
+    def _set_rotation(self, rotation):
+        self.config.get_settings()['oauth2_provider.refresh_rotation'] = \
+            rotation
+        self.config.registry.oauth2_provider_settings = None
+
+    def _count(self):
+        return DBSession.query(Oauth2Token).count()
+
+    def testRefreshInPlace(self):
+        token = self._grant(self._password())
+        granted = self._race(self._refresh(token))
+        self.assertEqual(len(granted), 1)
+        self.assertEqual(self._count(), 1)
+        dbtoken = DBSession.query(Oauth2Token).one()
+        self.assertEqual(dbtoken.generation, 1)
+        self.assertEqual(dbtoken.access_token_hash,
+                         hash_token(granted[0]['access_token']))
+
+    def testRefreshNewRow(self):
+        self._set_rotation('new_row')
+        token = self._grant(self._password())
+        granted = self._race(self._refresh(token))
+        self.assertEqual(len(granted), 1)
+        self.assertEqual(self._count(), 2)
+        old = Oauth2Token.lookup_access_token(token['access_token'])
+        self.assertTrue(old.revoked)
+        self.assertEqual(old.refresh_token_hash, None)
+
+    def testDedupRefresh(self):
+        request_dedup.configure(window=5)
+        token = self._grant(self._password())
+        granted = self._race(self._refresh(token))
+        self.assertEqual(len(granted), self.threads)
+        for result in granted:
+            self.assertEqual(result, granted[0])
+        dbtoken = DBSession.query(Oauth2Token).one()
+        self.assertEqual(dbtoken.generation, 1)
+        self.assertFalse(dbtoken.isRevoked())
+
+    def testDedupPassword(self):
+        request_dedup.configure(window=5)
+        granted = self._race(self._password())
+        self.assertEqual(len(granted), self.threads)
+        for result in granted:
+            self.assertEqual(result, granted[0])
+        self.assertEqual(self._count(), 1)
+
+        # A retry within the window gets the same tokens, other requests
+        # do not.
+        self.assertEqual(self._grant(self._password()), granted[0])
+        data = self._password()
+        data['username'] = 'jane'
+        self.assertNotEqual(self._grant(data), granted[0])
+        self.assertEqual(self._count(), 2)
+
+    def testDedupDisabled(self):
+        granted = self._race(self._password())
+        self.assertEqual(len(granted), self.threads)
+        self.assertEqual(self._count(), self.threads)
+
+    def testDedupFailure(self):
+        request_dedup.configure(window=5)
+        self.auth = False
+        self.assertTrue(isinstance(self._grant(self._password()),
+                                   jsonerrors.HTTPUnauthorized))
+        self.auth = 1
+        self.assertTrue(isinstance(self._grant(self._password()), dict))
+
+
+class TestConcurrentGrantsWAL(TestConcurrentGrants):
+    """
+    The same races with the database in write ahead log mode, where, as
+    with a database server, readers are not blocked by a writer and
+    writers queue for the write lock rather than failing.
+    """
+
+    def _create_engine(self, path):
+        engine = create_engine('sqlite:///%s' % path,
+                               connect_args={'timeout': 30})
+        @event.listens_for(engine, 'connect')
+        def connect(dbapi_connection, connection_record):
+            dbapi_connection.execute('PRAGMA journal_mode = WAL')
+        return engine
+
+
+class TestReadReplicas(TestCase):
+    """
+    Read only lookups against two replicas, copies of the primary database
+    file taken before the rows of the second client were written.
+    """
+
+    def setUp(self):
+        TestCase.setUp(self)
+        self.reads = []
+        self.tmpdir = tempfile.mkdtemp()
+        self.primary = self._engine('primary')
+        initialize_sql(self.primary, self.config)
+        self.client_id, self.client_secret, self.token = self._populate()
+        self.replicas = []
+        for name in ('replica1', 'replica2'):
+            shutil.copy(os.path.join(self.tmpdir, 'primary.db'),
+                        os.path.join(self.tmpdir, '%s.db' % name))
+            self.replicas.append(self._engine(name))
+        DBSession.remove()
+        initialize_sql(self.primary, self.config, create_tables=False,
+                       replicas=self.replicas)
+        # Written after the replicas were copied, as if they lag behind.
+        self.lagging_client_id, self.lagging_secret, self.lagging_token = \
+            self._populate()
+        del self.reads[:]
+
+    def tearDown(self):
+        TestCase.tearDown(self)
+        for engine in [self.primary] + self.replicas:
+            engine.dispose()
+        shutil.rmtree(self.tmpdir)
+
+    def _engine(self, name):
+        engine = create_engine('sqlite:///%s' % os.path.join(
+            self.tmpdir, '%s.db' % name))
+        event.listen(engine, 'before_cursor_execute',
+                     lambda *args: self.reads.append(name))
+        return engine
+
+    def _populate(self):
+        with transaction.manager:
+            client = Oauth2Client()
+            client_secret = client.new_client_secret()
+            DBSession.add(client)
+            token = Oauth2Token(client, 1)
+            DBSession.add(token)
+            DBSession.flush()
+            return client.client_id, client_secret, token.access_token
+
+    def testReadsFromReplicas(self):
+        for i in range(4):
+            info = lookup_token_info(self.token)
+            self.assertEqual(info.client_id, self.client_id)
+        self.assertFalse('primary' in self.reads)
+        # The replicas take turns.
+        self.assertEqual(self.reads.count('replica1'),
+                         self.reads.count('replica2'))
+
+    def testFallbackToPrimary(self):
+        info = lookup_token_info(self.lagging_token)
+        self.assertEqual(info.client_id, self.lagging_client_id)
+        self.assertTrue('primary' in self.reads)
+
+    def testUnknownToken(self):
+        self.assertRaises(HTTPBadRequest, lookup_token_info, 'unknown')
+        self.assertEqual(len(set(self.reads)), 2)
+        self.assertTrue('primary' in self.reads)
+
+    def testClientLookups(self):
+        info = lookup_client(self.client_id)
+        self.assertEqual(info.client_id, self.client_id)
+        self.assertFalse('primary' in self.reads)
+
+        info = lookup_client(self.lagging_client_id)
+        self.assertEqual(info.client_id, self.lagging_client_id)
+        self.assertTrue('primary' in self.reads)
+        self.assertEqual(lookup_client('unknown'), None)
+
+    def testTokenEndpoint(self):
+        request = testing.DummyRequest(headers=self.getAuthHeader(
+            self.lagging_client_id, self.lagging_secret), post={
+                'grant_type': 'password',
+                'username': 'john',
+                'password': 'foo',
+            })
+        request.scheme = 'https'
+        request.client_addr = '192.0.2.1'
+        with transaction.manager:
+            token = oauth2_token(request)
+        self.assertTrue(isinstance(token, dict))
+
+        del self.reads[:]
+        info = lookup_token_info(token['access_token'])
+        self.assertEqual(info.client_id, self.lagging_client_id)
+        self.assertTrue('primary' in self.reads)
+
+
+class TestAsyncValidation(TestCase):
+    def setUp(self):
+        TestCase.setUp(self)
+        # Lookups run on other threads, which do not share the connection
+        # of an in memory database.
+        self.tmpdir = tempfile.mkdtemp()
+        self.engine = create_engine('sqlite:///%s' % os.path.join(
+            self.tmpdir, 'oauth2.db'))
+        initialize_sql(self.engine, self.config)
+        event.listen(self.engine, 'before_cursor_execute', self._count_query)
+        with transaction.manager:
+            client = Oauth2Client()
+            DBSession.add(client)
+            self.tokens = []
+            for user_id in (1, 2, 3):
+                token = Oauth2Token(client, user_id)
+                DBSession.add(token)
+                DBSession.flush()
+                self.tokens.append(token.access_token)
+            revoked = Oauth2Token(client, 4)
+            DBSession.add(revoked)
+            DBSession.flush()
+            revoked.revoke()
+            self.revoked = revoked.access_token
+        self.lookups = []
+        self.validator = AsyncTokenValidator(self._slow_lookup)
+
+    def tearDown(self):
+        TestCase.tearDown(self)
+        self.engine.dispose()
+        shutil.rmtree(self.tmpdir)
+
+    def _slow_lookup(self, token):
+        self.lookups.append(token)
+        time.sleep(0.05)
+        return lookup_token_info(token)
+
+    def _run(self, coro):
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(coro)
+        finally:
+            loop.close()
+
+    def testValidate(self):
+        info = self._run(self.validator.validate(self.tokens[0]))
+        self.assertEqual(info.user_id, 1)
+        self.assertTrue(info.expires_at > time.time())
+
+        # The second validation is served from the token cache.
+        del self.queries[:]
+        self.assertEqual(
+            self._run(self.validator.validate(self.tokens[0])), info)
+        self.assertEqual(len(self.queries), 0)
+        self.assertEqual(len(self.lookups), 1)
+
+    def testErrors(self):
+        self.assertRaises(HTTPUnauthorized, self._run,
+                          self.validator.validate(self.revoked))
+        self.assertRaises(HTTPBadRequest, self._run,
+                          self.validator.validate('unknown'))
+
+    def testCoalescing(self):
+        async def validate_all():
+            return await asyncio.gather(*[
+                self.validator.validate(self.tokens[i % 2])
+                for i in range(20)])
+
+        infos = self._run(validate_all())
+        self.assertEqual([x.user_id for x in infos], [1, 2] * 10)
+        self.assertEqual(sorted(self.lookups), sorted(self.tokens[:2]))
+        self.assertEqual(self.validator.pending(), 0)
+
+    def testValidateMany(self):
+        results = self._run(self.validator.validate_many(
+            self.tokens + [self.revoked, 'unknown']))
+        self.assertEqual([x.user_id for x in results[:3]], [1, 2, 3])
+        self.assertTrue(isinstance(results[3], HTTPUnauthorized))
+        self.assertTrue(isinstance(results[4], HTTPBadRequest))
+
+    def testCoroutineLookup(self):
+        async def lookup(token):
+            self.lookups.append(token)
+            return TokenInfo(7, 'client', time.time() + 60)
+
+        validator = AsyncTokenValidator(lookup)
+        info = self._run(validator.validate('async'))
+        self.assertEqual(info.user_id, 7)
+        self.assertEqual(self.lookups, ['async'])
+
+    def testRevokedDuringAsyncLookup(self):
+        async def lookup(token):
+            info = lookup_token_info(token)
+            token_cache.revoke(token)
+            return info
+
+        validator = AsyncTokenValidator(lookup)
+        self._run(validator.validate(self.tokens[0]))
+        self.assertEqual(token_cache.get(self.tokens[0]), None)
+        self.assertEqual(len(token_cache), 0)
+
+    def _call(self, auth=None, required=False):
+        scopes = []
+        messages = []
+
+        async def app(scope, receive, send):
+            scopes.append(scope)
+            await send({'type': 'http.response.start', 'status': 200,
+                        'headers': []})
+
+        async def receive():
+            return {'type': 'http.request'}
+
+        async def send(message):
+            messages.append(message)
+
+        headers = [(b'host', b'localhost')]
+        if auth is not None:
+            headers.append((b'authorization', auth.encode('latin-1')))
+        middleware = OauthMiddleware(app, self.validator, required=required)
+        self._run(middleware({'type': 'http', 'headers': headers},
+                             receive, send))
+        return scopes, messages
+
+    def _bearer(self, token):
+        return 'Bearer %s' % base64.b64encode(
+            token.encode('utf8')).decode('ascii')
+
+    def testMiddleware(self):
+        scopes, messages = self._call(self._bearer(self.tokens[2]))
+        self.assertEqual(scopes[0]['oauth2_token_info'].user_id, 3)
+        self.assertEqual(messages[0]['status'], 200)
+
+    def testMiddlewareNoToken(self):
+        scopes, messages = self._call()
+        self.assertEqual(scopes[0]['oauth2_token_info'], None)
+
+        scopes, messages = self._call(required=True)
+        self.assertEqual(scopes, [])
+        self.assertEqual(messages[0]['status'], 401)
+
+    def testMiddlewareRejects(self):
+        scopes, messages = self._call(self._bearer(self.revoked))
+        self.assertEqual(scopes, [])
+        self.assertEqual(messages[0]['status'], 401)
+        self.assertTrue((b'www-authenticate',
+                         b'Bearer error="invalid_token"')
+                        in messages[0]['headers'])
+        body = json.loads(messages[1]['body'].decode('utf-8'))
+        self.assertEqual(body['detail']['error'], 'invalid_token')
+
+        scopes, messages = self._call('Bearer !!!')
+        self.assertEqual(messages[0]['status'], 400)
+
+
+class TestRevocation(TokenTestCase):
+    def setUp(self):
+        TokenTestCase.setUp(self)
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        revocation.configure(None)
+        shutil.rmtree(self.tmpdir)
+        TokenTestCase.tearDown(self)
+
+    def _cache_token(self):
+        self.policy.unauthenticated_userid(self._create_request())
+        self.assertEqual(len(token_cache), 1)
+
+    def testFileTransport(self):
+        transport = revocation.FileRevocationTransport(
+            os.path.join(self.tmpdir, 'revocations'))
+        listener = revocation.RevocationListener(transport)
+        self.assertEqual(listener.poll_once(), 0)
+        self._cache_token()
+
+        # Another worker revokes the token.
+        transport.publish('token', revocation.token_key(self.access_token))
+        self.assertEqual(listener.poll_once(), 1)
+        self.assertEqual(len(token_cache), 0)
+        self.assertEqual(listener.poll_once(), 0)
+        stats = listener.stats()
+        self.assertEqual(stats['applied'], 1)
+        self.assertTrue(stats['lag'] >= 0)
+
+    def testSkipsHistory(self):
+        transport = revocation.FileRevocationTransport(
+            os.path.join(self.tmpdir, 'revocations'))
+        transport.publish('client', 'abc')
+        listener = revocation.RevocationListener(transport)
+        self.assertEqual(listener.poll_once(), 0)
+
+    def testFileReplay(self):
+        path = os.path.join(self.tmpdir, 'revocations')
+        with open(path, 'w') as fh:
+            fh.write(json.dumps({'kind': 'token',
+                                 'key': revocation.token_key('old'),
+                                 'created': time.time() - 7200}) + '\n')
+        transport = revocation.FileRevocationTransport(path)
+        transport.publish('token', revocation.token_key(self.access_token))
+        listener = revocation.RevocationListener(transport, replay=3600)
+        listener.start()
+        listener.stop()
+        self.assertEqual(listener.stats()['applied'], 1)
+        self.assertTrue(token_cache.is_revoked_digest(
+            revocation.token_key(self.access_token)))
+        self.assertEqual(listener.last_id, transport.head())
+
+    def testDBReplay(self):
+        transport = revocation.DBRevocationTransport(self.engine)
+        revocation.configure(transport)
+        with transaction.manager:
+            old = Oauth2Revocation('token', revocation.token_key('old'))
+            old.creation_date = datetime.utcnow() - timedelta(hours=2)
+            DBSession.add(old)
+        with transaction.manager:
+            self._get_token().revoke()
+        token_cache.clear()
+
+        # A worker starting after the revocation still denies the token.
+        listener = revocation.RevocationListener(transport, replay=3600)
+        self.assertEqual(listener.poll_once(), 1)
+        self.assertTrue(token_cache.is_revoked_digest(
+            revocation.token_key(self.access_token)))
+        self.assertFalse(token_cache.is_revoked_digest(
+            revocation.token_key('old')))
+        self.assertEqual(listener.poll_once(), 0)
+
+    def testBatches(self):
+        transport = revocation.FileRevocationTransport(
+            os.path.join(self.tmpdir, 'revocations'))
+        listener = revocation.RevocationListener(transport, batch_size=2)
+        listener.poll_once()
+        for i in range(5):
+            transport.publish('client', str(i))
+        self.assertEqual(listener.poll_once(), 5)
+        self.assertEqual(listener.stats()['batches'], 3)
+
+    def testDBTransport(self):
+        transport = revocation.DBRevocationTransport(self.engine)
+        revocation.configure(transport)
+        listener = revocation.RevocationListener(transport)
+        listener.poll_once()
+        self._cache_token()
+
+        with transaction.manager:
+            self._get_token().revoke()
+        # Simulate the revocation coming from another worker.
+        token_cache.add(self.access_token, TokenInfo(42, 1, 2 ** 32))
+
+        self.assertEqual(listener.poll_once(), 1)
+        self.assertEqual(len(token_cache), 0)
+        self.assertEqual(DBSession.query(Oauth2Revocation).count(), 1)
+
+    def testClientRevocation(self):
+        transport = revocation.FileRevocationTransport(
+            os.path.join(self.tmpdir, 'revocations'))
+        revocation.configure(transport)
+        listener = revocation.RevocationListener(transport)
+        listener.poll_once()
+        with transaction.manager:
+            client = DBSession.query(Oauth2Client).first()
+            client.revoke()
+        self.assertEqual(listener.poll_once(), 1)
+
+    def testTransportFromSettings(self):
+        path = os.path.join(self.tmpdir, 'revocations')
+        settings = {'oauth2_provider.revocation.transport': 'file',
+                    'oauth2_provider.revocation.path': path}
+        transport = revocation.transport_from_settings(
+            Oauth2Settings.from_settings(settings), settings, self.engine)
+        self.assertEqual(transport.path, path)
+
+        settings['oauth2_provider.revocation.transport'] = 'db'
+        transport = revocation.transport_from_settings(
+            Oauth2Settings.from_settings(settings), settings, self.engine)
+        self.assertTrue(transport.engine is self.engine)
+
+        settings = {}
+        self.assertEqual(revocation.transport_from_settings(
+            Oauth2Settings.from_settings(settings), settings, self.engine),
+            None)
+
+    def testListenerThread(self):
+        transport = revocation.FileRevocationTransport(
+            os.path.join(self.tmpdir, 'revocations'))
+        listener = revocation.RevocationListener(transport, interval=0.01)
+        listener.start()
+        try:
+            self._cache_token()
+            transport.publish('token',
+                              revocation.token_key(self.access_token))
+            for i in range(100):
+                if not len(token_cache):
+                    break
+                time.sleep(0.01)
+        finally:
+            listener.stop()
+        self.assertEqual(len(token_cache), 0)
+
+
+class TestBulkOperations(TokenTestCase):
+    def setUp(self):
+        TokenTestCase.setUp(self)
+        with transaction.manager:
+            self.client = DBSession.query(Oauth2Client).one()
+            other = Oauth2Client()
+            DBSession.add(other)
+            for i in range(3):
+                DBSession.add(Oauth2Token(self.client, 7))
+            DBSession.add(Oauth2Token(other, 7))
+            DBSession.add(Oauth2Code(self.client, 42))
+            DBSession.flush()
+            self.other_client_id = other.client_id
+        self.client = DBSession.query(Oauth2Client).filter(
+            Oauth2Client.client_id != self.other_client_id).one()
+
+    def _revoked(self, user_id=None):
+        query = DBSession.query(Oauth2Token).filter_by(revoked=True)
+        if user_id is not None:
+            query = query.filter_by(user_id=user_id)
+        return query.count()
+
+    def testRevokeAllForClient(self):
+        self._cache_token()
+        del self.queries[:]
+        with transaction.manager:
+            counts = admin.revoke_all_for_client(self.client)
+        self.assertEqual(counts, {'tokens': 4, 'codes': 1})
+        # One select and one update for each of tokens and codes.
+        self.assertEqual(len([x for x in self.queries
+                              if x.startswith('UPDATE')]), 2)
+        self.assertEqual(self._revoked(), 4)
+        self.assertEqual(len(token_cache), 0)
+        self.assertRaises(HTTPUnauthorized, self.policy.unauthenticated_userid,
+                          self._create_request())
+
+        with transaction.manager:
+            counts = admin.revoke_all_for_client(self.client)
+        self.assertEqual(counts, {'tokens': 0, 'codes': 0})
+
+    def testRevokeAllForUser(self):
+        with transaction.manager:
+            count = Oauth2Token.revoke_all_for_user(7, batch_size=2)
+        self.assertEqual(count, 4)
+        self.assertEqual(self._revoked(7), 4)
+        self.assertEqual(self._revoked(42), 0)
+
+    def testRevokeAllForUserAndClient(self):
+        with transaction.manager:
+            counts = admin.revoke_all_for_user(7, self.client)
+        self.assertEqual(counts, {'tokens': 3, 'codes': 0})
+
+    def testRevokeExpiresLoadedObjects(self):
+        with transaction.manager:
+            token = self._get_token()
+            self.assertFalse(token.revoked)
+            Oauth2Token.revoke_all_for_user(42)
+            self.assertTrue(token.revoked)
+
+    def testRevokePublishes(self):
+        transport = revocation.DBRevocationTransport(self.engine)
+        revocation.configure(transport)
+        try:
+            with transaction.manager:
+                Oauth2Token.revoke_all_for_user(7)
+        finally:
+            revocation.configure(None)
+        self.assertEqual(len(transport.poll(0, 100)), 4)
+
+    def testIssueBulk(self):
+        del self.queries[:]
+        with transaction.manager:
+            tokens = admin.issue_tokens(self.client, range(100, 110),
+                                        expires_in=60)
+        self.assertEqual(len([x for x in self.queries
+                              if x.startswith('INSERT')]), 1)
+        self.assertEqual([x['user_id'] for x in tokens],
+                         list(range(100, 110)))
+        self.assertEqual(len(set(x['access_token'] for x in tokens)), 10)
+
+        info = self.policy.unauthenticated_userid(
+            self._create_request(tokens[3]['access_token']))
+        self.assertEqual(info, 103)
+        token = Oauth2Token.lookup_access_token(
+            tokens[0]['access_token'])
+        self.assertEqual(token.client.client_id, self.client.client_id)
+        self.assertEqual(token.getExpiry(),
+                         token.creation_date + timedelta(seconds=60))
+
+    def _cache_token(self):
+        self.policy.unauthenticated_userid(self._create_request())
+        self.assertEqual(len(token_cache), 1)
+
+    def _admin_request(self, view, *params, **kwargs):
+        request = testing.DummyRequest()
+        request.method = 'POST'
+        request.POST = MultiDict(list(params) + list(kwargs.items()))
+        request.scheme = 'https'
+        return view(request)
+
+    def testAdminRevokeView(self):
+        resp = self._admin_request(admin.oauth2_admin_revoke, user_id='7',
+                                   client_id=self.client.client_id)
+        self.assertEqual(resp, {'tokens': 3, 'codes': 0})
+        resp = self._admin_request(admin.oauth2_admin_revoke)
+        self.assertTrue(isinstance(resp, jsonerrors.HTTPBadRequest))
+        resp = self._admin_request(admin.oauth2_admin_revoke,
+                                   client_id='unknown')
+        self.assertTrue(isinstance(resp, jsonerrors.HTTPBadRequest))
+        resp = self._admin_request(admin.oauth2_admin_revoke, user_id='x')
+        self.assertTrue(isinstance(resp, jsonerrors.HTTPBadRequest))
+
+    def testAdminIssueView(self):
+        resp = self._admin_request(admin.oauth2_admin_issue,
+            ('client_id', self.client.client_id),
+            ('user_id', '1'), ('user_id', '2'))
+        self.assertEqual([x['user_id'] for x in resp['tokens']], [1, 2])
+        resp = self._admin_request(admin.oauth2_admin_issue,
+                                   client_id=self.client.client_id)
+        self.assertTrue(isinstance(resp, jsonerrors.HTTPBadRequest))
+
+    def testAdminRoutesOptIn(self):
+        from pyramid.interfaces import IRoutesMapper
+        from . import includeme
+        for enabled in (False, True):
+            config = testing.setUp(settings={
+                'sqlalchemy.url': 'sqlite://',
+                'oauth2_provider.auth_checker':
+                    'pyramid_oauth2_provider.tests.AuthCheck',
+                'oauth2_provider.admin': str(enabled),
+            })
+            config.set_authorization_policy(ACLAuthorizationPolicy())
+            includeme(config)
+            config.commit()
+            routes = [x.name for x in
+                      config.registry.getUtility(IRoutesMapper).get_routes()]
+            self.assertEqual('oauth2_provider_admin_revoke' in routes, enabled)
+            testing.tearDown()
+
+
+class TestTokenSigner(unittest.TestCase):
+    claims = {'sub': 1, 'client_id': 'abc', 'exp': 2 ** 32, 'jti': 'x'}
+
+    def _signers(self):
+        return [
+            signing.TokenSigner({'a': b'k' * 32}, 'a', 'HS256'),
+            signing.TokenSigner({'a': b'k' * 32}, 'a', 'EdDSA'),
+        ]
+
+    def testRoundTrip(self):
+        for signer in self._signers():
+            token = signer.sign(self.claims)
+            self.assertTrue(signing.looks_signed(token))
+            self.assertEqual(signer.verify(token), self.claims)
+
+    def testTampered(self):
+        for signer in self._signers():
+            header, payload, sig = signer.sign(self.claims).split('.')
+            other = signer.sign(dict(self.claims, sub=2)).split('.')[1]
+            self.assertRaises(signing.InvalidSignedToken, signer.verify,
+                              '.'.join([header, other, sig]))
+            self.assertRaises(signing.InvalidSignedToken, signer.verify,
+                              'a.b.c')
+
+    def testExpired(self):
+        signer = self._signers()[0]
+        token = signer.sign(dict(self.claims, exp=1000))
+        self.assertRaises(signing.InvalidSignedToken, signer.verify, token)
+
+    def testKeyRotation(self):
+        old = signing.TokenSigner({'a': b'1' * 32}, 'a')
+        token = old.sign(self.claims)
+        new = signing.TokenSigner({'a': b'1' * 32, 'b': b'2' * 32}, 'b')
+        self.assertEqual(new.verify(token), self.claims)
+        self.assertTrue('"kid":"b"' in signing._b64decode(
+            new.sign(self.claims).split('.')[0].encode('ascii')).decode())
+        retired = signing.TokenSigner({'b': b'2' * 32}, 'b')
+        self.assertRaises(signing.InvalidSignedToken, retired.verify, token)
+
+    def testFromSettings(self):
+        self.assertEqual(signing.signer_from_settings(
+            Oauth2Settings.from_settings({})), None)
+        signer = signing.signer_from_settings(Oauth2Settings.from_settings({
+            'oauth2_provider.token_format': 'signed',
+            'oauth2_provider.signing.keys': 'a:' + base64.b64encode(
+                b'k' * 32).decode('ascii'),
+            'oauth2_provider.signing.kid': 'a',
+            'oauth2_provider.signing.algorithm': 'EdDSA',
+        }))
+        self.assertEqual(signer.algorithm, 'EdDSA')
+
+
+class TestSignedTokens(TokenTestCase):
+    def setUp(self):
+        TokenTestCase.setUp(self)
+        self.signer = signing.TokenSigner({'a': b'k' * 32}, 'a')
+        signing.configure(self.signer)
+        self.signed_token = self.signer.sign_token(self._get_token())
+
+    def tearDown(self):
+        signing.configure(None)
+        TokenTestCase.tearDown(self)
+
+    def testNoDatabase(self):
+        del self.queries[:]
+        request = self._create_request(self.signed_token)
+        self.assertEqual(self.policy.unauthenticated_userid(request), 42)
+        self.assertEqual(len(self.queries), 0)
+
+    def testOpaqueStillAccepted(self):
+        self.assertEqual(self.policy.unauthenticated_userid(
+            self._create_request()), 42)
+
+    def testBadSignature(self):
+        other = signing.TokenSigner({'a': b'x' * 32}, 'a')
+        request = self._create_request(other.sign_token(self._get_token()))
+        self.assertRaises(HTTPUnauthorized,
+            self.policy.unauthenticated_userid, request)
+
+    def testRevoked(self):
+        with transaction.manager:
+            self._get_token().revoke()
+        self.assertRaises(HTTPUnauthorized,
+            self.policy.unauthenticated_userid,
+            self._create_request(self.signed_token))
+
+    def testForget(self):
+        with transaction.manager:
+            self.policy.forget(self._create_request(self.signed_token))
+        self.assertTrue(self._get_token().revoked)
+        self.assertRaises(HTTPUnauthorized,
+            self.policy.unauthenticated_userid,
+            self._create_request(self.signed_token))
+
+
+class TestProvisioning(TestCase):
+    def setUp(self):
+        TestCase.setUp(self)
+        self.hasher = hashers.get_hasher('hmac_sha256')
+
+    def _provision(self, specs, **kwargs):
+        output = StringIO()
+        kwargs.setdefault('workers', 0)
+        count = provisioning.provision_clients(self.engine, specs, output,
+            hasher=self.hasher, **kwargs)
+        return count, [json.loads(x) for x in output.getvalue().splitlines()]
+
+    def testCount(self):
+        count, created = self._provision(provisioning.count_specs(7),
+                                         chunk_size=3)
+        self.assertEqual(count, 7)
+        self.assertEqual(len(set(x['client_id'] for x in created)), 7)
+        self.assertEqual(DBSession.query(Oauth2Client).count(), 7)
+
+        # Statements are per chunk, not per client.
+        inserts = [x for x in self.queries if x.startswith('INSERT')]
+        self.assertEqual(len(inserts), 3)
+
+    def testSecretsVerify(self):
+        count, created = self._provision(provisioning.count_specs(2))
+        for entry in created:
+            client = DBSession.query(Oauth2Client).filter_by(
+                client_id=entry['client_id']).one()
+            self.assertTrue(client.check_secret(entry['client_secret']))
+            self.assertFalse(client.check_secret('wrong'))
+
+    def testProcessPool(self):
+        count, created = self._provision(provisioning.count_specs(4),
+                                         workers=2)
+        client = DBSession.query(Oauth2Client).filter_by(
+            client_id=created[0]['client_id']).one()
+        self.assertTrue(client.check_secret(created[0]['client_secret']))
+
+    def testJSONLSpecs(self):
+        specs = provisioning.read_specs(StringIO(
+            '{"name": "a", "redirect_uris": ["https://a/cb", "https://a/2"]}'
+            '\n\n{"name": "b"}\n'))
+        count, created = self._provision(specs)
+        self.assertEqual([x['name'] for x in created], ['a', 'b'])
+        client = DBSession.query(Oauth2Client).filter_by(
+            client_id=created[0]['client_id']).one()
+        self.assertEqual(sorted(x.uri for x in client.redirect_uris),
+                         ['https://a/2', 'https://a/cb'])
+
+    def testCSVSpecs(self):
+        specs = list(provisioning.read_specs(StringIO(
+            'name,redirect_uris\n'
+            'a,https://a/cb https://a/2\n'
+            'b,\n'), 'csv'))
+        self.assertEqual(specs, [
+            provisioning.ClientSpec('a', ('https://a/cb', 'https://a/2')),
+            provisioning.ClientSpec('b', ()),
+        ])
+        self.assertRaises(ValueError, list,
+                          provisioning.read_specs(StringIO(''), 'xml'))
+
+    def testFailedChunkRollsBack(self):
+        specs = [provisioning.ClientSpec('a', ('https://dup',)),
+                 provisioning.ClientSpec('b', ('https://ok',)),
+                 provisioning.ClientSpec('c', ('https://dup',))]
+        output = StringIO()
+        self.assertRaises(Exception, provisioning.provision_clients,
+            self.engine, specs, output, chunk_size=2, workers=0,
+            hasher=self.hasher)
+        self.assertEqual(len(output.getvalue().splitlines()), 2)
+        self.assertEqual(DBSession.query(Oauth2Client).count(), 2)
+
+
+class TestMigrations(unittest.TestCase):
+    old_schema = [
+        """CREATE TABLE oauth2_provider_clients (
+            id INTEGER PRIMARY KEY, client_id VARCHAR(64) UNIQUE NOT NULL,
+            _client_secret BLOB NOT NULL, revoked BOOLEAN,
+            revocation_date DATETIME)""",
+        """CREATE TABLE oauth2_provider_tokens (
+            id INTEGER PRIMARY KEY, user_id INTEGER NOT NULL,
+            access_token VARCHAR(64) UNIQUE NOT NULL,
+            refresh_token VARCHAR(64) UNIQUE NOT NULL,
+            expires_in INTEGER NOT NULL, revoked BOOLEAN,
+            revocation_date DATETIME, creation_date DATETIME,
+            client_id INTEGER REFERENCES oauth2_provider_clients(id))""",
+        """CREATE TABLE oauth2_provider_codes (
+            id INTEGER PRIMARY KEY, user_id INTEGER NOT NULL,
+            authcode VARCHAR(64) UNIQUE NOT NULL,
+            expires_in INTEGER NOT NULL, revoked BOOLEAN,
+            revocation_date DATETIME, creation_date DATETIME,
+            client_id INTEGER REFERENCES oauth2_provider_clients(id))""",
+        """CREATE TABLE oauth2_provider_redirect_uris (
+            id INTEGER PRIMARY KEY, uri VARCHAR(256) UNIQUE NOT NULL,
+            client_id INTEGER REFERENCES oauth2_provider_clients(id))""",
+    ]
+
+    def setUp(self):
+        self.engine = create_engine('sqlite://')
+        for statement in self.old_schema:
+            self.engine.execute(statement)
+        for i in range(5):
+            self.engine.execute(
+                "INSERT INTO oauth2_provider_tokens (user_id, access_token, "
+                "refresh_token, expires_in, revoked, creation_date) VALUES "
+                "(1, 'a%d', 'r%d', 60, 0, '2020-01-01 00:00:00.000000')"
+                % (i, i))
+
+    def testUpgrade(self):
+        migrations.upgrade(self.engine, batch_size=2)
+        inspector = inspect(self.engine)
+        columns = [x['name'] for x in
+                   inspector.get_columns('oauth2_provider_tokens')]
+        self.assertTrue('expires_at' in columns)
+        indexes = [x['name'] for x in
+                   inspector.get_indexes('oauth2_provider_tokens')]
+        self.assertTrue('ix_oauth2_provider_tokens_client_user' in indexes)
+        self.assertTrue(
+            'ix_oauth2_provider_tokens_revoked_expires_at' in indexes)
+        self.assertTrue('ix_oauth2_provider_redirect_uris_client_uri' in
+            [x['name'] for x in
+             inspector.get_indexes('oauth2_provider_redirect_uris')])
+        self.assertTrue('oauth2_provider_revocations' in
+                        inspector.get_table_names())
+
+        rows = self.engine.execute('SELECT DISTINCT expires_at FROM '
+                                   'oauth2_provider_tokens').fetchall()
+        self.assertEqual(len(rows), 1)
+        self.assertTrue(rows[0][0].startswith('2020-01-01 00:01:00'))
+
+    def testBackfillTokenHashes(self):
+        migrations.upgrade(self.engine, batch_size=2)
+        rows = self.engine.execute(
+            'SELECT access_token, access_token_hash, refresh_token, '
+            'refresh_token_hash FROM oauth2_provider_tokens').fetchall()
+        self.assertEqual(len(rows), 5)
+        for access_token, access_hash, refresh_token, refresh_hash in rows:
+            self.assertEqual(access_hash, hash_token(access_token))
+            self.assertEqual(refresh_hash, hash_token(refresh_token))
+        self.assertTrue('ix_oauth2_provider_tokens_access_token_hash' in
+            [x['name'] for x in
+             inspect(self.engine).get_indexes('oauth2_provider_tokens')])
+
+    def testClearPlaintextNotNull(self):
+        # SQLite can not drop the NOT NULL of the old schema in place, the
+        # table is rebuilt.
+        migrations.upgrade(self.engine, clear_plaintext=True)
+        self.assertEqual(self.engine.execute(
+            'SELECT COUNT(*) FROM oauth2_provider_tokens '
+            'WHERE access_token IS NOT NULL').scalar(), 0)
+        self.assertEqual(self.engine.execute(
+            'SELECT COUNT(*) FROM oauth2_provider_tokens '
+            'WHERE access_token_hash IS NOT NULL').scalar(), 5)
+        inspector = inspect(self.engine)
+        columns = dict((x['name'], x) for x in
+                       inspector.get_columns('oauth2_provider_tokens'))
+        self.assertTrue(columns['access_token']['nullable'])
+        self.assertTrue('ix_oauth2_provider_tokens_access_token_hash' in
+            [x['name'] for x in
+             inspector.get_indexes('oauth2_provider_tokens')])
+        self.assertEqual(sorted(inspector.get_table_names()), [
+            'oauth2_provider_clients', 'oauth2_provider_codes',
+            'oauth2_provider_redirect_uris', 'oauth2_provider_revocations',
+            'oauth2_provider_tokens'])
+
+        # Tokens can be issued with only their digests stored.
+        configure_token_storage('hashed')
+        config = testing.setUp()
+        try:
+            initialize_sql(self.engine, config, create_tables=False)
+            with transaction.manager:
+                client = Oauth2Client()
+                DBSession.add(client)
+                token = Oauth2Token(client, 2)
+                DBSession.add(token)
+                DBSession.flush()
+                access_token = token.access_token
+            self.assertEqual(Oauth2Token.lookup_access_token(
+                access_token).user_id, 2)
+            migrations.upgrade(self.engine, clear_plaintext=True)
+        finally:
+            DBSession.remove()
+            testing.tearDown()
+
+    def testIdempotent(self):
+        migrations.upgrade(self.engine)
+        migrations.upgrade(self.engine)
+
+
+class TestTTLCache(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        self.cache = TTLCache(max_size=2, ttl=10, clock=lambda: self.now)
+
+    def testExpiry(self):
+        self.cache.set('a', 1)
+        self.assertEqual(self.cache.get('a'), 1)
+        self.now += 11
+        self.assertEqual(self.cache.get('a'), None)
+        self.assertEqual(self.cache.stats()['hits'], 1)
+        self.assertEqual(self.cache.stats()['misses'], 1)
+
+    def testShorterEntryTTL(self):
+        self.cache.set('a', 1, ttl=2)
+        self.now += 3
+        self.assertEqual(self.cache.get('a'), None)
+
+    def testBounded(self):
+        self.cache.set('a', 1)
+        self.cache.set('b', 2)
+        self.cache.get('a')
+        self.cache.set('c', 3)
+        self.assertEqual(len(self.cache), 2)
+        self.assertEqual(self.cache.get('b'), None)
+        self.assertEqual(self.cache.get('a'), 1)
+
+    def testDisabled(self):
+        self.cache.configure(ttl=0)
+        self.cache.set('a', 1)
+        self.assertEqual(len(self.cache), 0)
+
+
+class TestDenyList(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        self.denied = DenyList(ttl=10, clock=lambda: self.now)
+
+    def testExpiry(self):
+        self.denied.add('a')
+        self.assertTrue('a' in self.denied)
+        self.assertFalse('b' in self.denied)
+        self.now += 11
+        self.assertFalse('a' in self.denied)
+
+    def testNotBounded(self):
+        for i in range(5000):
+            self.denied.add(i)
+        self.assertEqual(len(self.denied), 5000)
+        for i in range(5000):
+            self.assertTrue(i in self.denied)
+
+    def testPrune(self):
+        for i in range(1000):
+            self.denied.add(i)
+        self.now += 11
+        for i in range(1000, 1100):
+            self.denied.add(i)
+        self.assertEqual(len(self.denied), 100)
+
+    def testBulkRevocation(self):
+        cache = TokenCache(max_size=10)
+        digests = [hash_token(str(x)).hex() for x in range(100)]
+        for digest in digests:
+            cache.revoke_digest(digest)
+        for digest in digests:
+            self.assertTrue(cache.is_revoked_digest(digest))
+
+
+class TestClientCache(TestCase):
+    def setUp(self):
+        TestCase.setUp(self)
+        with transaction.manager:
+            client = Oauth2Client()
+            DBSession.add(client)
+            DBSession.add(Oauth2RedirectUri(client, 'https://a/cb'))
+            self.client_id = client.client_id
+        DBSession.remove()
+
+    def _lookup(self, client_id=None):
+        del self.queries[:]
+        info = lookup_client(client_id or self.client_id)
+        return info, len(self.queries)
+
+    def testReadThrough(self):
+        info, queries = self._lookup()
+        self.assertEqual(queries, 1)
+        self.assertEqual(info.client_id, self.client_id)
+        self.assertEqual(info.redirect_uris, ('https://a/cb',))
+        self.assertEqual(info.match_redirect_uri('HTTPS://A/cb'),
+                         'https://a/cb')
+        self.assertFalse(info.revoked)
+        self.assertRaises(AttributeError, setattr, info, 'revoked', True)
+
+        info, queries = self._lookup()
+        self.assertEqual(queries, 0)
+        self.assertEqual(client_cache.stats()['hits'], 1)
+
+    def testNegativeCache(self):
+        self.assertEqual(self._lookup('unknown'), (None, 1))
+        self.assertEqual(self._lookup('unknown'), (None, 0))
+        client_cache.configure(negative_ttl=0)
+        self.assertEqual(self._lookup('unknown'), (None, 1))
+        self.assertEqual(self._lookup('unknown'), (None, 1))
+
+    def testNegativeCacheWithoutTtl(self):
+        client_cache.configure(ttl=0)
+        self.assertEqual(self._lookup()[1], 1)
+        self.assertEqual(self._lookup()[1], 1)
+        self.assertEqual(self._lookup('unknown'), (None, 1))
+        self.assertEqual(self._lookup('unknown'), (None, 0))
+
+    def testFromSnapshot(self):
+        info = lookup_client(self.client_id)
+        del self.queries[:]
+        client = Oauth2Client.from_snapshot(info)
+        self.assertEqual(client.id, info.id)
+        self.assertEqual(client.client_secret, info.secret_hash)
+        self.assertEqual(self.queries, [])
+        self.assertTrue(Oauth2Client.from_snapshot(info) is client)
+        self.assertEqual([x.uri for x in client.redirect_uris],
+                         ['https://a/cb'])
+
+    def _get_client(self):
+        return DBSession.query(Oauth2Client).filter_by(
+            client_id=self.client_id).one()
+
+    def testInvalidatedByRevoke(self):
+        lookup_client(self.client_id)
+        with transaction.manager:
+            self._get_client().revoke()
+        info, queries = self._lookup()
+        self.assertEqual(queries, 1)
+        self.assertTrue(info.revoked)
+
+    def testInvalidatedByNewSecret(self):
+        old = lookup_client(self.client_id).secret_hash
+        with transaction.manager:
+            self._get_client().new_client_secret()
+        info, queries = self._lookup()
+        self.assertEqual(queries, 1)
+        self.assertNotEqual(info.secret_hash, old)
+
+    def testInvalidatedByRedirectUriChanges(self):
+        lookup_client(self.client_id)
+        with transaction.manager:
+            DBSession.add(Oauth2RedirectUri(self._get_client(),
+                                            'https://b/cb'))
+        self.assertEqual(len(self._lookup()[0].redirect_uris), 2)
+
+        with transaction.manager:
+            uri = DBSession.query(Oauth2RedirectUri).filter_by(
+                uri='https://a/cb').one()
+            uri.uri = 'https://c/cb'
+        self.assertEqual(sorted(self._lookup()[0].redirect_uris),
+                         ['https://b/cb', 'https://c/cb'])
+
+        with transaction.manager:
+            DBSession.delete(DBSession.query(Oauth2RedirectUri).filter_by(
+                uri='https://b/cb').one())
+        self.assertEqual(self._lookup()[0].redirect_uris, ('https://c/cb',))
+
+    def testInvalidatedByRevocationEvent(self):
+        lookup_client(self.client_id)
+        revocation.apply_events([
+            revocation.RevocationEvent(1, 'client', self.client_id, 0)])
+        self.assertEqual(self._lookup()[1], 1)
+
+
+class TestJsonErrors(unittest.TestCase):
+    def _render(self, error, accept='application/json'):
+        return Request.blank('/', headers={'Accept': accept}).get_response(
+            error)
+
+    def testJsonBody(self):
+        response = self._render(jsonerrors.HTTPUnauthorized(InvalidToken()))
+        self.assertEqual(response.status_int, 401)
+        self.assertEqual(response.content_type, 'application/json')
+        body = json.loads(response.body.decode('utf-8'))
+        self.assertEqual(body['code'], 401)
+        self.assertEqual(body['status'], '401 Unauthorized')
+        self.assertEqual(body['detail'], InvalidToken())
+
+    def testEscaping(self):
+        detail = InvalidRequest(error_description='bad "uri"\n\u00e9')
+        response = self._render(jsonerrors.HTTPBadRequest(detail,
+                                                          comment='a "b"'))
+        body = json.loads(response.body.decode('utf-8'))
+        self.assertEqual(body['detail'], detail)
+        self.assertEqual(body['comment'], 'a "b"')
+
+    def testRenderedOnce(self):
+        first = jsonerrors.render_json(
+            jsonerrors.HTTPUnauthorized(InvalidToken()))
+        second = jsonerrors.render_json(
+            jsonerrors.HTTPUnauthorized(InvalidToken()))
+        self.assertTrue(first is second)
+        other = jsonerrors.render_json(jsonerrors.HTTPBadRequest(
+            InvalidRequest(error_description='Other')))
+        self.assertFalse(other is first)
+        self.assertTrue(len(jsonerrors._rendered) <= jsonerrors.MAX_RENDERED)
+
+    def testPlainText(self):
+        response = self._render(jsonerrors.HTTPBadRequest('oops'),
+                                accept='text/plain')
+        self.assertEqual(response.content_type, 'text/plain')
+        self.assertTrue(b'400 Bad Request' in response.body)
+        self.assertTrue(b'oops' in response.body)
+
+
+class TestCredentials(unittest.TestCase):
+    def _encode(self, value):
+        return base64.b64encode(value.encode('utf8')).decode('ascii')
+
+    def testBasic(self):
+        credentials = parse_authorization(
+            'Basic %s' % self._encode('client:sec:ret'))
+        self.assertTrue(credentials.valid)
+        self.assertEqual(credentials.token_type, 'basic')
+        self.assertEqual(credentials.client_id, 'client')
+        self.assertEqual(credentials.client_secret, 'sec:ret')
+
+    def testBearer(self):
+        credentials = parse_authorization(
+            'bearer  %s ' % self._encode('abc'))
+        self.assertEqual(credentials, ('bearer', 'abc', None, None))
+
+    def testNonUtf8(self):
+        credentials = parse_authorization('Basic %s' % base64.b64encode(
+            b'\xff\xfe:x').decode('ascii'))
+        self.assertFalse(credentials.valid)
+        credentials = parse_authorization('Basic %s' % self._encode(
+            '\u00e9:\u00e8'))
+        self.assertEqual(credentials.client_id, '\u00e9')
+
+    def testMalformed(self):
+        for auth in ('Basic', 'Basic a b', 'Basic ***', 'Basic abc',
+                     'Basic %s' % self._encode('nocolon'),
+                     'Bearer \u00e9\u00e9\u00e9\u00e9'):
+            credentials = parse_authorization(auth)
+            self.assertEqual(credentials.token_type,
+                             auth.split()[0].lower())
+            self.assertFalse(credentials.valid)
+
+    def testOtherSchemes(self):
+        for auth in ('', '   ', 'Digest abc', 'Bearerx abc'):
+            self.assertEqual(parse_authorization(auth), None)
+
+    def testMemoized(self):
+        request = testing.DummyRequest(headers={
+            'Authorization': 'Basic %s' % self._encode('a:b')})
+        credentials = get_credentials(request)
+        self.assertTrue(get_credentials(request) is credentials)
+        self.assertEqual(getClientCredentials(request), ('basic', 'a:b'))
+        self.assertEqual((request.client_id, request.client_secret),
+                         ('a', 'b'))
+
+        request.headers = {'Authorization': 'Bearer %s' % self._encode('t')}
+        self.assertEqual(get_credentials(request).token, 't')
+        request.headers = {}
+        self.assertEqual(get_credentials(request), None)
+        self.assertEqual(getClientCredentials(request), False)
+
+
+class TestRateLimit(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        self.clock = lambda: self.now
+
+    def testAsRate(self):
+        self.assertEqual(asrate('100/1m'), (100, 60))
+        self.assertEqual(asrate('5'), (5, 1))
+        self.assertEqual(asrate('10 / 30s'), (10, 30))
+        self.assertRaises(ValueError, asrate, '0/1m')
+        self.assertRaises(ValueError, asrate, 'many')
+
+    def testTokenBucket(self):
+        backend = ratelimit.MemoryRateLimitBackend(clock=self.clock)
+        for i in range(3):
+            self.assertEqual(backend.hit('a', 3, 30), 0)
+        self.assertEqual(backend.hit('a', 3, 30), 10)
+        self.assertEqual(backend.hit('b', 3, 30), 0)
+        self.now += 10
+        self.assertEqual(backend.hit('a', 3, 30), 0)
+        self.assertEqual(backend.hit('a', 3, 30), 10)
+
+    def testTokenBucketEviction(self):
+        backend = ratelimit.MemoryRateLimitBackend(max_size=2,
+                                                   clock=self.clock)
+        backend.hit('a', 1, 60)
+        backend.hit('b', 1, 60)
+        backend.hit('c', 1, 60)
+        self.assertEqual(len(backend), 2)
+        # a was evicted and starts with a full bucket again.
+        self.assertEqual(backend.hit('a', 1, 60), 0)
+        self.assertTrue(backend.hit('c', 1, 60) > 0)
+
+    def testLocalCounterStore(self):
+        store = ratelimit.LocalCounterStore(max_size=2, clock=self.clock)
+        self.assertEqual(store.incr('a', 10), 1)
+        self.assertEqual(store.incr('a', 10), 2)
+        self.assertEqual(store.get('a'), 2)
+        self.now += 10
+        self.assertEqual(store.get('a'), 0)
+        self.assertEqual(store.incr('a', 10), 1)
+        store.incr('b', 10)
+        store.incr('c', 10)
+        self.assertEqual(len(store), 2)
+        self.assertEqual(store.get('a'), 0)
+
+    def testSlidingWindow(self):
+        backend = ratelimit.SharedRateLimitBackend(
+            ratelimit.LocalCounterStore(clock=self.clock), clock=self.clock)
+        self.now = 1200.0
+        for i in range(4):
+            self.assertEqual(backend.hit('a', 4, 60), 0)
+        self.assertEqual(backend.hit('a', 4, 60), 60)
+        # Half way into the next window half of the previous one counts.
+        self.now += 90
+        self.assertEqual(backend.hit('a', 4, 60), 0)
+        self.assertEqual(backend.hit('a', 4, 60), 30)
+
+    def testRedisCounterStore(self):
+        class FakeRedis(object):
+            def __init__(self):
+                self.data = {}
+                self.expires = {}
+            def pipeline(self):
+                return FakePipeline(self)
+            def get(self, key):
+                return self.data.get(key)
+
+        class FakePipeline(object):
+            def __init__(self, redis):
+                self.redis = redis
+                self.results = []
+            def incr(self, key):
+                self.redis.data[key] = self.redis.data.get(key, 0) + 1
+                self.results.append(self.redis.data[key])
+            def expire(self, key, ttl):
+                self.redis.expires[key] = ttl
+                self.results.append(True)
+            def execute(self):
+                return self.results
+
+        redis = FakeRedis()
+        store = ratelimit.RedisCounterStore(redis, prefix='rl:')
+        self.assertEqual(store.incr('a', 60), 1)
+        self.assertEqual(store.incr('a', 60), 2)
+        self.assertEqual(store.get('a'), 2)
+        self.assertEqual(store.get('b'), 0)
+        self.assertEqual(redis.expires['rl:a'], 61)
+
+    def testRateLimiter(self):
+        limiter = ratelimit.RateLimiter(
+            ratelimit.MemoryRateLimitBackend(clock=self.clock),
+            {'client': (10, 60), 'ip': (1, 60)})
+        self.assertEqual(limiter.check('token', client='a', ip='1.2.3.4'), 0)
+        self.assertEqual(limiter.check('token', client='a', ip='1.2.3.4'), 60)
+        self.assertEqual(limiter.check('token', client='a', ip='1.2.3.5'), 0)
+        # Other endpoints have their own buckets.
+        self.assertEqual(
+            limiter.check('authorize', client='a', ip='1.2.3.4'), 0)
+        self.assertRaises(ValueError, ratelimit.RateLimiter, None,
+                          {'user': (1, 1)})
+
+    def testFromSettings(self):
+        limiter = ratelimit.limiter_from_settings(
+            Oauth2Settings.from_settings({
+                'oauth2_provider.ratelimit.backend': 'shared',
+                'oauth2_provider.ratelimit.ip': '100/1m',
+            }))
+        self.assertEqual(limiter.limits, {'ip': (100, 60)})
+        self.assertTrue(isinstance(limiter.backend,
+                                   ratelimit.SharedRateLimitBackend))
+        self.assertFalse(ratelimit.limiter_from_settings(
+            Oauth2Settings.from_settings({})).enabled)
+
+
+class TestGenerators(unittest.TestCase):
+    def testTokenFormat(self):
+        token = generators.TokenGenerator().gen_token()
+        self.assertEqual(len(token), 43)
+        self.assertEqual(len(base64.urlsafe_b64decode(token + '=')), 32)
+        self.assertTrue(set(token) <= set(
+            'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz'
+            '0123456789-_'))
+
+    def testLength(self):
+        self.assertEqual(len(generators.TokenGenerator(16).gen_token()), 22)
+        self.assertEqual(len(generators.TokenGenerator(35).gen_token()), 47)
+        self.assertRaises(ValueError, generators.TokenGenerator, 8)
+        self.assertRaises(ValueError, generators.TokenGenerator, 36)
+        refresh_token = '%s.%s' % (generators.gen_family_id(),
+            generators.TokenGenerator(35).gen_token())
+        self.assertEqual(len(refresh_token), generators.MAX_TOKEN_LENGTH)
+
+    def testBufferRefill(self):
+        generator = generators.TokenGenerator(32, buffer_size=64)
+        tokens = [generator.gen_token() for _ in range(10)]
+        self.assertEqual(len(set(tokens)), 10)
+
+    def testGenTokens(self):
+        generator = generators.TokenGenerator(32, buffer_size=256)
+        tokens = generator.gen_tokens(1000)
+        self.assertEqual(len(tokens), 1000)
+        self.assertEqual(len(set(tokens)), 1000)
+        self.assertEqual(generator.gen_tokens(0), [])
+
+    def testGenTokensCollisionFree(self):
+        class RepeatingGenerator(generators.TokenGenerator):
+            calls = 0
+            def _read(self, size):
+                self.calls += 1
+                if self.calls == 1:
+                    return b'\0' * size
+                return generators.TokenGenerator._read(self, size)
+
+        tokens = RepeatingGenerator(16).gen_tokens(5)
+        self.assertEqual(len(set(tokens)), 5)
+
+    def testConfigure(self):
+        class Counter(object):
+            count = 0
+            def gen_token(self):
+                self.count += 1
+                return 'token-%d' % self.count
+            def gen_tokens(self, count):
+                return [self.gen_token() for _ in range(count)]
+
+        default = generators.get_generator()
+        generators.configure(Counter())
+        try:
+            self.assertEqual(generators.gen_client_id(), 'token-1')
+            self.assertEqual(generators.gen_tokens(2), ['token-2', 'token-3'])
+        finally:
+            generators.configure(default)
+
+
+class TestSettings(TestCase):
+    def testAsDuration(self):
+        self.assertEqual(asduration(5), 5)
+        self.assertEqual(asduration('30'), 30)
+        self.assertEqual(asduration('1.5s'), 1.5)
+        self.assertEqual(asduration('10m'), 600)
+        self.assertEqual(asduration('2h'), 7200)
+        self.assertEqual(asduration('7d'), 7 * 24 * 60 * 60)
+        self.assertRaises(ValueError, asduration, '1w')
+
+    def testDefaults(self):
+        settings = Oauth2Settings.from_settings({})
+        self.assertEqual(settings.require_ssl, True)
+        self.assertEqual(settings.salt, None)
+        self.assertEqual(settings.secret_cache_ttl, 0)
+        self.assertEqual(settings.kdf_executor, 'thread')
+        self.assertEqual(settings.token_format, 'opaque')
+
+    def testCacheDefaults(self):
+        settings = Oauth2Settings.from_settings({
+            'oauth2_provider.revocation.transport': 'db'})
+        self.assertEqual(settings.secret_cache_ttl, 300)
+        self.assertEqual(settings.client_cache_ttl, 300)
+        self.assertEqual(settings.token_cache_ttl, 60)
+        settings = Oauth2Settings.from_settings({
+            'oauth2_provider.token_cache.ttl': '30'})
+        self.assertEqual(settings.token_cache_ttl, 30)
+        self.assertEqual(settings.client_cache_ttl, 0)
+
+    def testConversion(self):
+        settings = Oauth2Settings.from_settings({
+            'oauth2_provider.require_ssl': 'false',
+            'oauth2_provider.token_cache.max_size': '500',
+            'oauth2_provider.purge.retention': '7d',
+            'oauth2_provider.hasher.n': '1024',
+            'other.setting': 'ignored',
+        })
+        self.assertEqual(settings.require_ssl, False)
+        self.assertEqual(settings.token_cache_max_size, 500)
+        self.assertEqual(settings.purge_retention, 7 * 24 * 60 * 60)
+        self.assertEqual(settings.prefixed('hasher.'), {'n': '1024'})
+        self.assertFalse('other.setting' in settings.raw)
+
+    def testPoolSettings(self):
+        settings = Oauth2Settings.from_settings({})
+        self.assertEqual(settings.create_tables, False)
+        self.assertEqual(settings.pool_size, None)
+        self.assertEqual(settings.replicas, ())
+        settings = Oauth2Settings.from_settings({
+            'oauth2_provider.create_tables': 'true',
+            'oauth2_provider.pool.size': '20',
+            'oauth2_provider.pool.recycle': '1h',
+            'oauth2_provider.pool.pre_ping': 'true',
+            'oauth2_provider.replicas': 'sqlite:///a.db\n sqlite:///b.db',
+        })
+        self.assertEqual(settings.create_tables, True)
+        self.assertEqual(settings.pool_size, 20)
+        self.assertEqual(settings.pool_recycle, 3600)
+        self.assertEqual(settings.pool_pre_ping, True)
+        self.assertEqual(settings.replicas, ('sqlite:///a.db',
+                                             'sqlite:///b.db'))
+
+    def testInvalidValue(self):
+        try:
+            Oauth2Settings.from_settings(
+                {'oauth2_provider.kdf.workers': 'many'})
+        except ValueError as e:
+            self.assertTrue('oauth2_provider.kdf.workers' in str(e))
+        else:
+            self.fail('expected ValueError')
+
+    def testChoices(self):
+        convert = aschoice('a', 'b')
+        self.assertEqual(convert(' b '), 'b')
+        self.assertRaises(ValueError, convert, 'c')
+        convert = aschoice('a', dotted=True)
+        self.assertEqual(convert('pkg.mod:factory'), 'pkg.mod:factory')
+        self.assertRaises(ValueError, convert, 'other')
+
+        for name, value in (('refresh_rotation', 'new-row'),
+                            ('token_format', 'jwt'),
+                            ('hasher', 'md5'),
+                            ('kdf.executor', 'threads'),
+                            ('ratelimit.backend', 'redis'),
+                            ('token_storage', 'plain'),
+                            ('signing.algorithm', 'RS256')):
+            try:
+                Oauth2Settings.from_settings(
+                    {'oauth2_provider.%s' % name: value})
+            except ValueError as e:
+                self.assertTrue(name in str(e))
+            else:
+                self.fail('expected ValueError for %s' % name)
+        settings = Oauth2Settings.from_settings({
+            'oauth2_provider.refresh_rotation': 'new_row',
+            'oauth2_provider.hasher': 'hmac_sha256'})
+        self.assertEqual(settings.refresh_rotation, 'new_row')
+
+    def testLookupDefault(self):
+        self.assertEqual(oauth2_settings('token_cache.max_size'), 10000)
+        self.assertEqual(oauth2_settings('token_cache.max_size', 5), 5)
+        self.assertEqual(oauth2_settings('salt', 'other'),
+                         'r+H5LT6EvgSSKFMZ2brdzQ==')
+        self.assertEqual(oauth2_settings('unknown', 'x'), 'x')
+        self.assertEqual(oauth2_settings('unknown'), None)
+
+
+class TestIncludeme(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.primary = 'sqlite:///%s' % os.path.join(self.tmpdir, 'primary.db')
+        self.replica = 'sqlite:///%s' % os.path.join(self.tmpdir, 'replica.db')
+
+    def tearDown(self):
+        DBSession.remove()
+        ReadOnlySession.remove()
+        testing.tearDown()
+        shutil.rmtree(self.tmpdir)
+
+    def _include(self, **settings):
+        from . import includeme
+        settings = dict(('oauth2_provider.%s' % x, y)
+                        for x, y in settings.items())
+        settings['sqlalchemy.url'] = self.primary
+        settings['oauth2_provider.auth_checker'] = \
+            'pyramid_oauth2_provider.tests.AuthCheck'
+        config = testing.setUp(settings=settings)
+        config.set_authorization_policy(ACLAuthorizationPolicy())
+        includeme(config)
+        config.commit()
+        return config
+
+    def _tables(self, url):
+        return inspect(create_engine(url)).get_table_names()
+
+    def testCreateTablesOptIn(self):
+        self._include()
+        self.assertEqual(self._tables(self.primary), [])
+        self._include(create_tables='true')
+        self.assertTrue(Oauth2Token.__tablename__ in
+                        self._tables(self.primary))
+
+    def testPoolSettings(self):
+        config = self._include(**{'pool.recycle': '30m',
+                                  'pool.pre_ping': 'true',
+                                  'replicas': self.replica})
+        engines = [DBSession.get_bind()] + \
+            config.registry.oauth2_replica_engines
+        for engine in engines:
+            self.assertEqual(engine.pool._recycle, 1800)
+            self.assertEqual(engine.pool._pre_ping, True)
+
+    def testReplicas(self):
+        config = self._include(replicas=self.replica)
+        replicas = config.registry.oauth2_replica_engines
+        self.assertEqual([str(x.url) for x in replicas], [self.replica])
+        self.assertEqual(ReadOnlySession().replicas, tuple(replicas))
+        self.assertTrue(ReadOnlySession().get_bind() is replicas[0])
+        self.assertEqual(str(DBSession.get_bind().url), self.primary)
+
+        DBSession.remove()
+        self._include()
+        self.assertEqual(ReadOnlySession().replicas, ())
+        self.assertTrue(ReadOnlySession().get_bind() is
+                        DBSession.get_bind())
+
+    def testBackgroundStartedOnFirstRequest(self):
+        from pyramid.events import NewRequest
+        config = self._include(**{
+            'revocation.transport': 'file',
+            'revocation.path': os.path.join(self.tmpdir, 'revocations'),
+            'purge.interval': '1h'})
+        listener = config.registry.oauth2_revocation_listener
+        scheduler = config.registry.oauth2_purge_scheduler
+        # Nothing runs until a request, which preforking servers only see
+        # in their workers.
+        self.assertEqual(listener._thread, None)
+        self.assertEqual(scheduler._thread, None)
+        try:
+            config.registry.notify(NewRequest(testing.DummyRequest()))
+            thread = listener._thread
+            self.assertTrue(thread.is_alive())
+            self.assertTrue(scheduler._thread.is_alive())
+            config.registry.notify(NewRequest(testing.DummyRequest()))
+            self.assertTrue(listener._thread is thread)
+        finally:
+            listener.stop()
+            scheduler.stop()
+            revocation.configure(None)
+
+    def testSignedTokenChecks(self):
+        keys = 'k1:%s' % base64.b64encode(b'k' * 32).decode('ascii')
+        self.assertRaises(ConfigurationError, self._include, **{
+            'token_format': 'signed', 'signing.keys': keys,
+            'signing.kid': 'k1', 'token_cache.revoked_ttl': '10m'})
+        with self.assertLogs('pyramid_oauth2_provider', 'WARNING') as logs:
+            self._include(**{'token_format': 'signed', 'signing.keys': keys,
+                             'signing.kid': 'k1'})
+        self.assertTrue(any('revocation.transport' in x
+                            for x in logs.output))
+
+    def testStartupTimings(self):
+        config = self._include()
+        timings = config.registry.oauth2_startup_timings
+        self.assertEqual([x[0] for x in timings],
+                         ['settings', 'engines', 'database', 'caches',
+                          'keys', 'background', 'views'])
+        for step, seconds in timings:
+            self.assertTrue(seconds >= 0)
@@ -0,0 +1,95 @@
+#
+# Copyright (c) Elliot Peele <elliot@bentlogic.net>
+#
+# This program is distributed under the terms of the MIT License as found
+# in a file called LICENSE. If it is not present, the license
+# is always available at http://www.opensource.org/licenses/mit-license.php.
+#
+# This program is distributed in the hope that it will be useful, but
+# without any warrenty; without even the implied warranty of merchantability
+# or fitness for a particular purpose. See the MIT License for full details.
+#
+
+"""
+Throttling of clients that repeatedly fail to authenticate.
+"""
+
+import time
+import logging
+import threading
+
+from .cache import TTLCache
+
+log = logging.getLogger('pyramid_oauth2_provider.throttle')
+
+
+class FailureCounter(object):
+    """
+    Counts failed authentication attempts per key in fixed windows of
+    window seconds. Once a key reaches max_failures in a window it is
+    blocked until the window ends. A max_failures of zero disables
+    throttling. Counts are kept in a bounded LRU, so a flood of distinct
+    keys evicts the oldest rather than growing without bound.
+    """
+
+    def __init__(self, max_failures=20, window=60, max_size=10000,
+                 clock=time.time):
+        self.max_failures = max_failures
+        self.window = window
+        self.clock = clock
+        self._counts = TTLCache(max_size=max_size, ttl=window, clock=clock)
+        self._lock = threading.Lock()
+
+    def configure(self, max_failures=None, window=None, max_size=None):
+        if max_failures is not None:
+            self.max_failures = max_failures
+        if window is not None:
+            self.window = window
+        self._counts.configure(max_size=max_size, ttl=window)
+
+    @property
+    def enabled(self):
+        return self.max_failures > 0 and self.window > 0
+
+    def failed(self, key):
+        """
+        Record a failed attempt for key. Returns the number of failures in
+        the current window.
+        """
+
+        if not self.enabled:
+            return 0
+        with self._lock:
+            now = self.clock()
+            count, started = self._counts.get(key, (0, now))
+            count += 1
+            self._counts.set(key, (count, started),
+                             ttl=started + self.window - now)
+        if count == self.max_failures:
+            log.warning('throttling %s after %d failed attempts'
+                        % (key, count))
+        return count
+
+    def reset(self, key):
+        self._counts.invalidate(key)
+
+    def blocked(self, key):
+        """
+        Return the number of seconds key remains blocked for, or 0.
+        """
+
+        if not self.enabled:
+            return 0
+        count, started = self._counts.get(key, (0, None))
+        if count < self.max_failures:
+            return 0
+        return max(started + self.window - self.clock(), 0)
+
+    def clear(self):
+        self._counts.clear()
+
+    def stats(self):
+        return self._counts.stats()
+
+
+client_failures = FailureCounter()
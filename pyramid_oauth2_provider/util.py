@@ -10,53 +10,326 @@
 # or fitness for a particular purpose. See the MIT License for full details.
 #
 
+import re
 import base64
+import binascii
 import logging
+from collections import namedtuple
 
+from six.moves.urllib.parse import urlsplit
+from six.moves.urllib.parse import urlunsplit
+
+from pyramid.settings import asbool
+from pyramid.settings import aslist
 from pyramid.threadlocal import get_current_registry
 
 log = logging.getLogger('pyramid_oauth2_provider.util')
 
-def oauth2_settings(key=None, default=None):
-    settings = get_current_registry().settings
+_duration_units = {'': 1, 's': 1, 'm': 60, 'h': 60 * 60, 'd': 24 * 60 * 60}
+_duration_re = re.compile(r'^\s*(\d+(?:\.\d+)?)\s*([smhd]?)\s*$')
 
-    if key:
-        value = settings.get('oauth2_provider.%s' % key, default)
-        if value == 'true':
-            return True
-        elif value == 'false':
-            return False
+def asduration(value):
+    """
+    Convert a number of seconds, optionally suffixed with s, m, h or d, to
+    seconds.
+    """
+
+    if isinstance(value, (int, float)):
+        return value
+    match = _duration_re.match(value)
+    if not match:
+        raise ValueError('invalid duration: %r' % value)
+    number, unit = match.groups()
+    number = float(number) * _duration_units[unit]
+    return int(number) if number.is_integer() else number
+
+_rate_re = re.compile(r'^\s*(\d+)\s*/\s*(.+?)\s*$')
+
+def asrate(value):
+    """
+    Convert a rate like 100/1m, a number of requests per duration, to a
+    tuple of the number of requests and the period in seconds. A bare
+    number is requests per second.
+    """
+
+    if isinstance(value, tuple):
+        limit, period = value
+    else:
+        match = _rate_re.match(str(value))
+        if match:
+            limit, period = match.groups()
         else:
+            limit, period = value, 1
+    limit, period = int(limit), asduration(period)
+    if limit < 1 or period <= 0:
+        raise ValueError('invalid rate: %r' % (value,))
+    return limit, period
+
+def _optional(value):
+    return value or None
+
+def _aslist(value):
+    return tuple(aslist(value))
+
+def aschoice(*choices, dotted=False):
+    """
+    Return a converter that accepts one of choices. With dotted=True dotted
+    names of factories are accepted as well.
+    """
+
+    def convert(value):
+        value = str(value).strip()
+        if value in choices or (dotted and ('.' in value or ':' in value)):
             return value
-    else:
-        return dict((x.split('.', 1)[1], y) for x, y in settings.items()
-            if x.startswith('oauth2_provider.'))
+        raise ValueError('expected one of %s%s' % (', '.join(choices),
+            dotted and ' or a dotted name' or ''))
+    return convert
 
-def getClientCredentials(request):
-    if 'Authorization' in request.headers:
-        auth = request.headers.get('Authorization')
-    elif 'authorization' in request.headers:
-        auth = request.headers.get('authorization')
+def _ashasher(value):
+    # Hashers register themselves on import, so only check when parsing.
+    from .hashers import available_hashers
+    return aschoice(*available_hashers())(value)
+
+# Setting name (after the oauth2_provider. prefix), conversion and default.
+_settings_schema = (
+    ('require_ssl', asbool, True),
+    ('create_tables', asbool, False),
+    ('pool.size', int, None),
+    ('pool.max_overflow', int, None),
+    ('pool.timeout', asduration, None),
+    ('pool.recycle', asduration, None),
+    ('pool.pre_ping', asbool, None),
+    ('replicas', _aslist, ()),
+    ('salt', _optional, None),
+    ('auth_checker', _optional, None),
+    ('admin', asbool, False),
+    ('secret_cache.max_size', int, 1024),
+    ('secret_cache.ttl', asduration, 300),
+    ('client_cache.max_size', int, 1024),
+    ('client_cache.ttl', asduration, 300),
+    ('client_cache.negative_ttl', asduration, 30),
+    ('token_cache.max_size', int, 10000),
+    ('token_cache.ttl', asduration, 60),
+    ('token_cache.revoked_ttl', asduration, 3600),
+    ('throttle.max_failures', int, 20),
+    ('throttle.window', asduration, 60),
+    ('throttle.max_size', int, 10000),
+    ('ratelimit.backend', aschoice('memory', 'shared', dotted=True),
+     'memory'),
+    ('ratelimit.max_size', int, 10000),
+    ('ratelimit.client', asrate, None),
+    ('ratelimit.ip', asrate, None),
+    ('ratelimit.username', asrate, None),
+    ('kdf.executor', aschoice('thread', 'process', 'inline'), 'thread'),
+    ('kdf.workers', int, 2),
+    ('kdf.max_queue', int, 16),
+    ('token_storage', aschoice('hashed', 'dual'), 'hashed'),
+    ('refresh_rotation', aschoice('in_place', 'new_row'), 'in_place'),
+    ('dedup.window', asduration, 0),
+    ('dedup.max_size', int, 10000),
+    ('hasher', _ashasher, 'scrypt'),
+    ('generator', _optional, None),
+    ('generator.nbytes', int, 32),
+    ('generator.buffer_size', int, 4096),
+    ('token_format', aschoice('opaque', 'signed'), 'opaque'),
+    ('signing.algorithm', aschoice('HS256', 'EdDSA'), 'HS256'),
+    ('signing.keys', str, ''),
+    ('signing.kid', _optional, None),
+    ('revocation.transport', _optional, None),
+    ('revocation.path', _optional, None),
+    ('revocation.interval', asduration, 1),
+    ('revocation.batch_size', int, 500),
+    ('purge.interval', asduration, 0),
+    ('purge.retention', asduration, 30 * 24 * 60 * 60),
+    ('purge.batch_size', int, 1000),
+)
+
+# Caches that would serve revoked clients and tokens until they expire if
+# revocations are not propagated between workers. Unless set explicitly,
+# they are only enabled together with a revocation transport.
+_revocable_cache_ttls = ('secret_cache.ttl', 'client_cache.ttl',
+                         'token_cache.ttl')
+
+
+class Oauth2Settings(namedtuple('Oauth2Settings',
+        [x[0].replace('.', '_') for x in _settings_schema] + ['raw'])):
+    """
+    Immutable, typed view of the oauth2_provider.* settings. Attribute names
+    are the setting names with dots replaced by underscores, raw holds every
+    oauth2_provider.* setting as given, without the prefix.
+    """
+    __slots__ = ()
+
+    @classmethod
+    def from_settings(cls, settings):
+        raw = dict((x.split('.', 1)[1], y) for x, y in settings.items()
+                   if x.startswith('oauth2_provider.'))
+        values = []
+        for name, convert, default in _settings_schema:
+            value = raw.get(name)
+            if value is None:
+                if (name in _revocable_cache_ttls and
+                        not raw.get('revocation.transport')):
+                    default = 0
+                values.append(default)
+                continue
+            try:
+                values.append(convert(value))
+            except ValueError as e:
+                raise ValueError('invalid value for oauth2_provider.%s: %r, '
+                                 '%s' % (name, value, e))
+        return cls(*values, raw=raw)
+
+    def get(self, key, default=None):
+        attr = key.replace('.', '_')
+        if attr in self._fields and attr != 'raw':
+            return getattr(self, attr)
+        return self.raw.get(key, default)
+
+    def prefixed(self, prefix):
+        """
+        Return the raw settings starting with prefix, without the prefix.
+        """
+
+        return dict((x[len(prefix):], y) for x, y in self.raw.items()
+                    if x.startswith(prefix))
+
+
+def get_oauth2_settings(registry=None):
+    """
+    Return the parsed settings of registry, or the current registry. They
+    are parsed by includeme, registries configured some other way have
+    them parsed on first use.
+    """
+
+    if registry is None:
+        registry = get_current_registry()
+    parsed = getattr(registry, 'oauth2_provider_settings', None)
+    if parsed is None:
+        parsed = Oauth2Settings.from_settings(registry.settings or {})
+        registry.oauth2_provider_settings = parsed
+    return parsed
+
+def oauth2_settings(key=None, default=None):
+    settings = get_oauth2_settings()
+
+    if key:
+        # The default of the caller wins over the schema default.
+        if default is not None and key not in settings.raw:
+            return default
+        value = settings.get(key, default)
+        return default if value is None else value
     else:
-        log.debug('no authorization header found')
-        return False
+        return dict(settings.raw)
 
-    if (not auth.lower().startswith('bearer') and
-        not auth.lower().startswith('basic')):
-        log.debug('authorization header not of type bearer or basic: %s'
-            % auth.lower())
-        return False
+_default_ports = {'http': 80, 'https': 443}
+
+def normalize_uri(uri):
+    """
+    Normalize a redirect uri for comparison. The scheme and host are
+    lowercased, default ports dropped and an empty path becomes /, the
+    rest of the uri is compared as is.
+    """
+
+    try:
+        parts = urlsplit(uri)
+        port = parts.port
+    except ValueError:
+        return uri
+    scheme = parts.scheme.lower()
+    netloc = (parts.hostname or '').lower()
+    if ':' in netloc:
+        netloc = '[%s]' % netloc
+    if port is not None and port != _default_ports.get(scheme):
+        netloc = '%s:%d' % (netloc, port)
+    if parts.username is not None:
+        userinfo = parts.netloc.rsplit('@', 1)[0]
+        netloc = '%s@%s' % (userinfo, netloc)
+    return urlunsplit((scheme, netloc, parts.path or '/', parts.query,
+                       parts.fragment))
+
+class ClientCredentials(namedtuple('ClientCredentials',
+        'token_type token client_id client_secret')):
+    """
+    Credentials from an Authorization header. token_type is 'basic' or
+    'bearer' and token the decoded header value, or None when the value
+    could not be decoded. client_id and client_secret are only set for
+    well formed basic credentials.
+    """
+    __slots__ = ()
+
+    @property
+    def valid(self):
+        return self.token is not None
+
+
+def parse_authorization(auth):
+    """
+    Parse an Authorization header value. Returns None unless it uses the
+    basic or bearer scheme. Malformed base64, non ascii input and basic
+    credentials without a ':' give credentials that are not valid rather
+    than raising. The client_secret of basic credentials is everything
+    after the first ':' and may itself contain ':'.
+    """
 
     parts = auth.split()
+    if not parts:
+        return None
+    token_type = parts[0].lower()
+    if token_type not in ('basic', 'bearer'):
+        return None
+    invalid = ClientCredentials(token_type, None, None, None)
     if len(parts) != 2:
-        return False
+        return invalid
 
-    token_type = parts[0].lower()
-    token = base64.b64decode(parts[1]).decode('utf8')
+    try:
+        token = base64.b64decode(parts[1], validate=True).decode('utf8')
+    except (binascii.Error, ValueError):
+        return invalid
+
+    if token_type == 'bearer':
+        return ClientCredentials(token_type, token, None, None)
+    client_id, sep, client_secret = token.partition(':')
+    if not sep:
+        return invalid
+    return ClientCredentials(token_type, token, client_id, client_secret)
+
+def get_credentials(request):
+    """
+    Return the ClientCredentials of the Authorization header of request,
+    or None when there is no basic or bearer Authorization header. The
+    result is memoized on the request for as long as the header is
+    unchanged, so the header is decoded once however many times it is
+    asked for.
+    """
+
+    headers = request.headers
+    auth = headers.get('Authorization') or headers.get('authorization')
+    memo = getattr(request, '_oauth2_credentials', None)
+    if memo is not None and memo[0] == auth:
+        return memo[1]
+
+    if auth:
+        credentials = parse_authorization(auth)
+    else:
+        log.debug('no authorization header found')
+        credentials = None
+    request._oauth2_credentials = (auth, credentials)
+    return credentials
+
+def getClientCredentials(request):
+    """
+    Return the token type and token of the Authorization header of
+    request, or False when it is missing or malformed. For basic
+    credentials request.client_id and request.client_secret are set.
+    """
+
+    credentials = get_credentials(request)
+    if credentials is None or not credentials.valid:
+        return False
 
-    if token_type == 'basic':
-        client_id, client_secret = token.split(':')
-        request.client_id = client_id
-        request.client_secret = client_secret
+    if credentials.token_type == 'basic':
+        request.client_id = credentials.client_id
+        request.client_secret = credentials.client_secret
 
-    return token_type, token
+    return credentials.token_type, credentials.token
@@ -10,10 +10,9 @@
 # or fitness for a particular purpose. See the MIT License for full details.
 #
 
+import math
 import logging
 
-from base64 import b64decode
-
 from pyramid.view import view_config
 from pyramid.security import NO_PERMISSION_REQUIRED
 from pyramid.security import authenticated_userid
@@ -23,25 +22,33 @@ from six.moves.urllib.parse import urlparse
 from six.moves.urllib.parse import parse_qsl
 from six.moves.urllib.parse import ParseResult
 from six.moves.urllib.parse import urlencode
-from cryptography.hazmat.primitives.kdf.scrypt import Scrypt
-from cryptography.exceptions import InvalidKey
 
 from .models import DBSession as db
 from .models import Oauth2Token
 from .models import Oauth2Code
-from .models import Oauth2RedirectUri
 from .models import Oauth2Client
-from .models import backend
+from .models import lookup_client
+from .cache import secret_cache
+from .hashers import dummy_verify
+from .throttle import client_failures
+from .dedup import request_dedup
+from .ratelimit import get_limiter
+from .kdf import KDFPoolSaturated
+from .signing import get_signer
 from .errors import InvalidToken
 from .errors import InvalidClient
+from .errors import InvalidGrant
 from .errors import InvalidRequest
 from .errors import UnsupportedGrantType
-from .util import oauth2_settings
+from .errors import TemporarilyUnavailable
+from .util import get_oauth2_settings
 from .util import getClientCredentials
 from .interfaces import IAuthCheck
 from .jsonerrors import HTTPBadRequest
 from .jsonerrors import HTTPUnauthorized
 from .jsonerrors import HTTPMethodNotAllowed
+from .jsonerrors import HTTPTooManyRequests
+from .jsonerrors import HTTPServiceUnavailable
 
 
 def require_https(handler):
@@ -53,7 +60,7 @@ def require_https(handler):
     """
     def wrapped(request):
         if (request.scheme != 'https' and
-                oauth2_settings('require_ssl', default=True)):
+                get_oauth2_settings(request.registry).require_ssl):
             log.info('rejected request due to unsupported scheme: %s'
                      % request.scheme)
             return HTTPBadRequest(InvalidRequest(
@@ -98,28 +105,28 @@ def oauth2_authorize(request):
     """
     request.client_id = request.params.get('client_id')
 
-    client = db.query(Oauth2Client).filter_by(
-        client_id=request.client_id).first()
+    # Nothing authenticates the client here, so its limit is counted per
+    # address, one address can not use up the limit of a client.
+    error = check_rate_limits(request, 'authorize', ip=request.client_addr,
+        client='%s %s' % (request.client_id, request.client_addr))
+    if error is not None:
+        return error
+
+    client_info = lookup_client(request.client_id)
 
-    if not client:
+    if not client_info:
         log.info('received invalid client credentials')
         return HTTPBadRequest(InvalidRequest(
             error_description='Invalid client credentials'))
 
-    redirect_uri = request.params.get('redirect_uri')
-    redirection_uri = None
-    if len(client.redirect_uris) == 1 and (
-        not redirect_uri or redirect_uri == client.redirect_uris[0]):
-        redirection_uri = client.redirect_uris[0]
-    elif len(client.redirect_uris) > 0:
-        redirection_uri = db.query(Oauth2RedirectUri)\
-            .filter_by(client_id=client.id, uri=redirect_uri).first()
-
+    redirection_uri = client_info.match_redirect_uri(
+        request.params.get('redirect_uri'))
     if redirection_uri is None:
         return HTTPBadRequest(InvalidRequest(
             error_description='Redirection URI validation failed'))
 
     resp = None
+    client = Oauth2Client.from_snapshot(client_info)
     response_type = request.params.get('response_type')
     state = request.params.get('state')
     if 'code' == response_type:
@@ -133,7 +140,7 @@ def oauth2_authorize(request):
     return resp
 
 def handle_authcode(request, client, redirection_uri, state=None):
-    parts = urlparse(redirection_uri.uri)
+    parts = urlparse(redirection_uri)
     qparams = dict(parse_qsl(parts.query))
 
     user_id = authenticated_userid(request)
@@ -219,54 +226,128 @@ def oauth2_token(request):
         log.info('did not receive client credentials')
         return HTTPUnauthorized('Invalid client credentials')
 
-    client = db.query(Oauth2Client).filter_by(
-        client_id=request.client_id).first()
-
-    # Again, the authorization policy should catch this, but check again.
-    if not oauth2_settings('salt'):
-        raise ValueError('oauth2_provider.salt configuration required.')
-    salt = b64decode(oauth2_settings('salt').encode('utf-8'))
-    kdf = Scrypt(
-        salt=salt,
-        length=64,
-        n=2 ** 14,
-        r=8,
-        p=1,
-        backend=backend
-    )
-
-    try:
-        client_secret = request.client_secret
-        try:
-            client_secret = bytes(client_secret, 'utf-8')
-        except TypeError:
-            client_secret = client_secret.encode('utf-8')
-        kdf.verify(client_secret, client.client_secret)
-        bad_secret = False
-    except (AttributeError, InvalidKey):
-        bad_secret = True
-    if not client or bad_secret:
-        log.info('received invalid client credentials')
-        return HTTPBadRequest(InvalidRequest(
-            error_description='Invalid client credentials'))
+    # Only the address is limited before the client is authenticated, so
+    # that others can not use up the limits of a client.
+    error = check_rate_limits(request, 'token', ip=request.client_addr)
+    if error is None:
+        client, error = authenticate_client(request)
+    if error is None:
+        username = None
+        if request.POST.get('grant_type') == 'password':
+            username = request.POST.get('username')
+        error = check_rate_limits(request, 'token', client=client.client_id,
+                                  username=username)
+    if error is not None:
+        return error
 
     # Check for supported grant type. This is a required field of the form
     # submission.
-    resp = None
     grant_type = request.POST.get('grant_type')
-    if grant_type == 'password':
-        resp = handle_password(request, client)
-    elif grant_type == 'refresh_token':
-        resp = handle_refresh_token(request, client)
-    else:
+    handler = _grant_handlers.get(grant_type)
+    if handler is None:
         log.info('invalid grant type: %s' % grant_type)
         return HTTPBadRequest(UnsupportedGrantType(error_description='Only '
             'password and refresh_token grant types are supported by this '
             'authentication server'))
 
+    if request_dedup.enabled:
+        # Retried and racing copies of a request get the same tokens.
+        key = request_dedup.key(client.client_id, request.POST.items())
+        resp = request_dedup.run(key, lambda: handler(request, client),
+                                 request=request)
+    else:
+        resp = handler(request, client)
+
     add_cache_headers(request)
     return resp
 
+def too_many_requests(retry_after, description):
+    resp = HTTPTooManyRequests(TemporarilyUnavailable(
+        error_description=description))
+    resp.headers['Retry-After'] = str(max(int(math.ceil(retry_after)), 1))
+    return resp
+
+def check_rate_limits(request, endpoint, **values):
+    """
+    Return a 429 response if the request is over any of the configured
+    rate limits of the given client, ip and username values, otherwise
+    None.
+    """
+
+    limiter = get_limiter()
+    if not limiter.enabled:
+        return None
+    retry_after = limiter.check(endpoint, **values)
+    if retry_after:
+        return too_many_requests(retry_after,
+            'Rate limit exceeded, please retry later.')
+
+def _client_error():
+    return HTTPBadRequest(InvalidRequest(
+        error_description='Invalid client credentials'))
+
+def authenticate_client(request):
+    """
+    Verify the client credentials of a token request. Returns the client
+    and None, or None and an error response.
+
+    Throttled, unknown and revoked clients are rejected before the key
+    derivation function runs for their secret. Unknown clients go through
+    a dummy verification of the same cost instead, so that response times
+    do not reveal which client_ids exist. Failures are counted per
+    client_id and address, so that guessing the secret of a client from one
+    address does not lock the client out everywhere, and clients with too
+    many recent failures from an address are throttled there.
+    """
+
+    client_id = request.client_id
+    failure_key = (client_id, request.client_addr)
+    client_secret = request.client_secret
+    try:
+        client_secret = bytes(client_secret, 'utf-8')
+    except TypeError:
+        client_secret = client_secret.encode('utf-8')
+
+    retry_after = client_failures.blocked(failure_key)
+    if retry_after:
+        log.info('throttled client %s' % client_id)
+        return None, too_many_requests(retry_after,
+            'Too many failed authentication attempts, please retry later.')
+
+    client_info = lookup_client(client_id)
+    client = None
+    try:
+        if client_info is None:
+            log.info('received unknown client_id')
+            valid = dummy_verify(client_secret)
+        elif client_info.revoked:
+            log.info('received credentials of a revoked client')
+            valid = False
+        elif secret_cache.check(client_id, client_info.secret_hash,
+                                client_secret):
+            valid = True
+        else:
+            client = Oauth2Client.from_snapshot(client_info)
+            valid = client.check_secret(client_secret)
+            if valid:
+                secret_cache.add(client_id, client.client_secret,
+                                 client_secret)
+    except KDFPoolSaturated:
+        log.warning('rejected request, kdf pool is saturated')
+        resp = HTTPServiceUnavailable(TemporarilyUnavailable(
+            error_description='The server is too busy to verify client '
+                              'credentials, please retry.'))
+        resp.headers['Retry-After'] = '1'
+        return None, resp
+
+    if not valid:
+        client_failures.failed(failure_key)
+        log.info('received invalid client credentials')
+        return None, _client_error()
+
+    client_failures.reset(failure_key)
+    return client or Oauth2Client.from_snapshot(client_info), None
+
 def handle_password(request, client):
     if 'username' not in request.POST or 'password' not in request.POST:
         log.info('missing username or password')
@@ -285,7 +366,7 @@ def handle_password(request, client):
     auth_token = Oauth2Token(client, user_id)
     db.add(auth_token)
     db.flush()
-    return auth_token.asJSON(token_type='bearer')
+    return token_response(auth_token)
 
 def handle_refresh_token(request, client):
     if 'refresh_token' not in request.POST:
@@ -298,8 +379,8 @@ def handle_refresh_token(request, client):
         return HTTPBadRequest(InvalidRequest(error_description='user_id '
             'field required'))
 
-    auth_token = db.query(Oauth2Token).filter_by(
-        refresh_token=request.POST.get('refresh_token')).first()
+    refresh_token = request.POST.get('refresh_token')
+    auth_token = Oauth2Token.lookup_refresh_family(refresh_token)
 
     if not auth_token:
         log.info('invalid refresh_token')
@@ -316,10 +397,54 @@ def handle_refresh_token(request, client):
         return HTTPBadRequest(InvalidClient(error_description='The given '
             'user_id does not match the given refresh_token.'))
 
-    new_token = auth_token.refresh()
-    db.add(new_token)
+    if auth_token.revoked:
+        # Revoked sessions, one by one or in bulk, can not be refreshed.
+        log.info('refresh_token of a revoked token')
+        return HTTPUnauthorized(InvalidGrant(error_description='Provided '
+            'refresh_token has been revoked.'))
+
+    if not auth_token.is_current_refresh_token(refresh_token):
+        # An earlier refresh token of the family has been presented, so
+        # one of its tokens has leaked. Revoke the family, the legitimate
+        # client has to authenticate again.
+        log.warning('refresh_token reused, revoking token family')
+        auth_token.revoke_family()
+        return HTTPUnauthorized(InvalidToken(error_description='Provided '
+            'refresh_token is not valid.'))
+
+    if get_oauth2_settings(request.registry).refresh_rotation == 'new_row':
+        new_token = auth_token.refresh()
+        if new_token is not None:
+            db.add(new_token)
+    else:
+        new_token = auth_token.rotate()
+
+    if new_token is None:
+        # A concurrent request with the same refresh token got there first.
+        # That is a duplicate rather than a reuse, the family stays valid.
+        log.info('refresh_token used by a concurrent request')
+        return HTTPUnauthorized(InvalidToken(error_description='Provided '
+            'refresh_token is not valid.'))
     db.flush()
-    return new_token.asJSON(token_type='bearer')
+    return token_response(new_token)
+
+_grant_handlers = {
+    'password': handle_password,
+    'refresh_token': handle_refresh_token,
+}
+
+def token_response(auth_token):
+    """
+    Render a token grant. When signed tokens are configured the opaque
+    access token is replaced with a signed one, the stored row stays behind
+    as the anchor for the refresh token.
+    """
+
+    resp = auth_token.asJSON(token_type='bearer')
+    signer = get_signer()
+    if signer is not None:
+        resp['access_token'] = signer.sign_token(auth_token)
+    return resp
 
 def add_cache_headers(request):
     """
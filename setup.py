@@ -24,6 +24,8 @@ setup(name='pyramid_oauth2_provider',
       long_description=README,
       classifiers=[
         "Programming Language :: Python",
+        "Programming Language :: Python :: 3",
+        "Programming Language :: Python :: 3 :: Only",
         "Framework :: Pyramid",
         "Topic :: Internet :: WWW/HTTP",
         "Topic :: Internet :: WWW/HTTP :: WSGI :: Application",
@@ -35,6 +37,7 @@ setup(name='pyramid_oauth2_provider',
       packages=find_packages(),
       include_package_data=True,
       zip_safe=False,
+      python_requires='>=3.7',
       test_suite='pyramid_oauth2_provider',
       install_requires=requires,
       entry_points="""\
@@ -42,6 +45,9 @@ setup(name='pyramid_oauth2_provider',
       main = pyramid_oauth2_provider:main
       [console_scripts]
       initialize_pyramid_oauth2_provider_db = pyramid_oauth2_provider.scripts.initializedb:main
+      upgrade_pyramid_oauth2_provider_db = pyramid_oauth2_provider.scripts.upgradedb:main
+      purge_pyramid_oauth2_provider_db = pyramid_oauth2_provider.scripts.purgedb:main
+      manage_pyramid_oauth2_provider_tokens = pyramid_oauth2_provider.scripts.tokens:main
       create_client_credentials=pyramid_oauth2_provider.scripts.create_client_credentials:main
       """,
       )